@@ -1,4 +1,5 @@
 import math
+import numpy as np
 class BM25:
     """
     Best Match 25.
@@ -16,7 +17,7 @@ class BM25:
 
     doc_len_ : dict[int]
         Number of terms per document. So [3] = 10 means the
-        document 3 contains 10 terms.
+        document 3 contains 10 terms. Can also be a doc_table.DocColumn.
 
     df_ : dict[str, int]
         Document Frequency per term. i.e. Number of documents in the
@@ -25,6 +26,12 @@ class BM25:
     avgdl_ : float
         Average number of terms for documents in the corpus.
 
+    norm_doc_ids_ : np.ndarray
+        Sorted ids of the documents with a non zero length (built lazily).
+
+    norm_ : np.ndarray
+        Length normalization (1 - b + b * dl / avgdl) of each doc in norm_doc_ids_.
+
     """
 
     def __init__(self,doc_len,df,N,total_terms,k1=1.5, b=0.75):
@@ -34,8 +41,12 @@ class BM25:
         self.df_ = df
         self.N_ = N
         self.avgdl_ = total_terms / N
+        self.norm_doc_ids_ = None
+        self.norm_ = None
+        # the b value norm_ was computed with, b is tuned after the object is created.
+        self._norm_b = None
 
-    def calc_idf(self, query):
+    def calc_idf(self, query, df=None):
         """
         This function calculate the idf values according to the BM25 idf formula for each term in the query.
 
@@ -43,6 +54,9 @@ class BM25:
         -----------
         query: list of token representing the query. For example: ['look', 'blue', 'sky']
 
+        df: optional dict of term -> document frequency used instead of df_ (a shard of a
+            sharded index gets the collection wide ones from the coordinator).
+
         Returns:
         -----------
         idf: dictionary of idf scores. As follows:
@@ -52,10 +66,11 @@ class BM25:
         # YOUR CODE HERE
         # i create the idf dict
         idf = {}
+        df = self.df_ if df is None else df
         # i go over each term
         for term in query:
             # i get the number of docs containing that term (0 if none)
-            num_of_docs_containing_term = self.df_.get(term, 0)
+            num_of_docs_containing_term = df.get(term, 0)
             # i calculate the the idf value of that term using the idf equation provided in the beginning of the task.
             idf[term] = math.log( (self.N_ - num_of_docs_containing_term + 0.5) / (num_of_docs_containing_term + 0.5)) + 1
         return idf
@@ -71,3 +86,73 @@ class BM25:
         B = 1 - self.b + self.b * (dl / self.avgdl_)
         return idf * ((tf * (self.k1 + 1)) / (tf + self.k1 * B))
 
+    def _length_norm(self):
+        """
+        Returns the sorted doc ids and their length normalization arrays, (re)building
+        them the first time they are needed or when b was changed.
+        """
+        if self._norm_b != self.b:
+            if hasattr(self.doc_len_, 'arrays'):
+                # a document table column already holds the lengths as arrays
+                doc_ids, lengths = self.doc_len_.arrays()
+                doc_ids, lengths = np.asarray(doc_ids, dtype=np.int64), np.asarray(lengths, dtype=np.float64)
+            else:
+                doc_ids = np.fromiter(self.doc_len_.keys(), dtype=np.int64, count=len(self.doc_len_))
+                lengths = np.fromiter(self.doc_len_.values(), dtype=np.float64, count=len(self.doc_len_))
+            order = np.argsort(doc_ids, kind='stable')
+            doc_ids, lengths = doc_ids[order], lengths[order]
+            # documents of length 0 always score 0, so i just leave them out
+            non_empty = lengths > 0
+            doc_ids, lengths = doc_ids[non_empty], lengths[non_empty]
+            self.norm_ = 1 - self.b + self.b * (lengths / self.avgdl_)
+            self.norm_doc_ids_ = doc_ids
+            self._norm_b = self.b
+        return self.norm_doc_ids_, self.norm_
+
+    def score_batch(self, doc_ids, tfs, idf):
+        """
+        BM25 contribution of a single term to every document of its posting list.
+        Gives exactly the same values as calling score_term for each posting.
+
+        Parameters:
+        -----------
+        doc_ids: numpy array of document ids.
+        tfs: numpy array of the term frequency in each of these documents.
+        idf: the bm25 idf score of the term.
+
+        Returns:
+        -----------
+        numpy float64 array of scores, aligned with doc_ids.
+        """
+        norm_doc_ids, norm = self._length_norm()
+        if len(doc_ids) == 0 or len(norm_doc_ids) == 0:
+            return np.zeros(len(doc_ids), dtype=np.float64)
+        pos = np.searchsorted(norm_doc_ids, doc_ids).clip(0, len(norm_doc_ids) - 1)
+        found = norm_doc_ids[pos] == doc_ids
+        scores = idf * ((tfs * (self.k1 + 1)) / (tfs + self.k1 * norm[pos]))
+        scores[~found] = 0.0
+        return scores
+
+
+def accumulate_scores(doc_id_arrays, score_arrays):
+    """
+    Sums the scores of several terms per document. The arrays are summed in the
+    order they are given, so the result is the same as adding them one by one
+    into a dict.
+
+    Parameters:
+    -----------
+    doc_id_arrays: list of numpy arrays of document ids (one per term).
+    score_arrays: list of numpy arrays of scores aligned with doc_id_arrays.
+
+    Returns:
+    -----------
+    doc_ids: sorted numpy array of the unique document ids.
+    scores: numpy float64 array of the summed score of each document.
+    """
+    if len(doc_id_arrays) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    all_ids = np.concatenate(doc_id_arrays)
+    all_scores = np.concatenate(score_arrays)
+    doc_ids, inverse = np.unique(all_ids, return_inverse=True)
+    return doc_ids, np.bincount(inverse, weights=all_scores, minlength=len(doc_ids))
@@ -0,0 +1,646 @@
+""" Micro-benchmarks for the hot parts of the search engine.
+
+Run all of them with:
+    python benchmarks.py
+or a single one with:
+    python benchmarks.py decode
+"""
+import json
+import pickle
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+import numpy as np
+from BM25 import BM25, accumulate_scores
+from posting_cache import PostingCache, ResultCache, normalized_query
+from query_engine import QueryEngine, lookup, rank_by_distinct_terms
+from doc_table import DocColumn, DocTable
+from startup import approx_size
+from metrics import RequestProfile
+from term_dictionary import TermDictionary
+from text_Modification import analyze, tokenize
+from contextlib import closing
+import inverted_index_gcp
+from inverted_index_gcp import (BLOCK_SIZE, TUPLE_SIZE, TF_MASK, InvertedIndex, LocalBlockCache, LocalBucket,
+                                MultiFileReader, PostingReader, decode_posting_list, encode_posting_list)
+
+
+def _timeit(fn, repeat=3):
+    """ Returns the best wall time (in seconds) of `repeat` runs of fn(). """
+    best = float('inf')
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t_start)
+    return best
+
+
+def random_postings(n, seed=0):
+    """ Returns sorted doc ids and tfs that look like a high-df body term. """
+    rng = np.random.default_rng(seed)
+    doc_ids = np.sort(rng.choice(70_000_000, size=n, replace=False))
+    tfs = rng.zipf(2.0, size=n).clip(1, TF_MASK)
+    return doc_ids, tfs
+
+
+def encode_postings(doc_ids, tfs):
+    """ Encodes postings exactly like InvertedIndex.write_a_posting_list(compressed=False). """
+    return b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
+                     for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist())])
+
+
+def _decode_loop(b, n):
+    """ The original per-posting decoder, kept here as the baseline. """
+    posting_list = []
+    for i in range(n):
+        doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
+        tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
+        posting_list.append((doc_id, tf))
+    return posting_list
+
+
+def bench_decode(sizes=(1_000_000, 4_000_000)):
+    """ Compares the python loop decoder with the numpy decoder. """
+    for n in sizes:
+        doc_ids, tfs = random_postings(n)
+        b = encode_postings(doc_ids, tfs)
+        decoded_ids, decoded_tfs = decode_posting_list(b, n)
+        assert np.array_equal(decoded_ids, doc_ids) and np.array_equal(decoded_tfs, tfs)
+        loop_time = _timeit(lambda: _decode_loop(b, n), repeat=1)
+        numpy_time = _timeit(lambda: decode_posting_list(b, n))
+        print(f"decode n={n:>9,}  loop={loop_time * 1000:9.1f}ms  "
+              f"numpy={numpy_time * 1000:7.2f}ms  speedup={loop_time / numpy_time:7.1f}x")
+
+
+def bench_bm25(n_docs=2_000_000, term_dfs=(1_500_000, 400_000, 50_000)):
+    """ Compares per-posting score_term calls with score_batch + accumulate_scores
+        on a multi term query, and checks that both give identical scores.
+    """
+    rng = np.random.default_rng(1)
+    all_doc_ids = np.sort(rng.choice(70_000_000, size=n_docs, replace=False))
+    lengths = rng.integers(1, 3000, size=n_docs)
+    doc_len = dict(zip(all_doc_ids.tolist(), lengths.tolist()))
+    bm25 = BM25(doc_len=doc_len, df={}, N=n_docs, total_terms=int(lengths.sum()), k1=0.7)
+    postings = []
+    for df in term_dfs:
+        doc_ids = np.sort(rng.choice(all_doc_ids, size=df, replace=False))
+        postings.append((doc_ids, rng.zipf(2.0, size=df).clip(1, TF_MASK), 1.0 + rng.random()))
+    as_lists = [(doc_ids.tolist(), tfs.tolist(), idf) for doc_ids, tfs, idf in postings]
+    n_postings = sum(term_dfs)
+
+    def per_posting():
+        scores = defaultdict(float)
+        for doc_ids, tfs, idf in as_lists:
+            for doc_id, tf in zip(doc_ids, tfs):
+                scores[doc_id] += bm25.score_term(tf, doc_id, idf)
+        return scores
+
+    def batch():
+        return accumulate_scores([doc_ids for doc_ids, _, _ in postings],
+                                 [bm25.score_batch(doc_ids, tfs, idf) for doc_ids, tfs, idf in postings])
+
+    expected = per_posting()
+    doc_ids, scores = batch()
+    assert dict(zip(doc_ids.tolist(), scores.tolist())) == dict(expected)
+    loop_time = _timeit(per_posting, repeat=1)
+    batch_time = _timeit(batch)
+    print(f"bm25 postings={n_postings:>9,}  loop={n_postings / loop_time / 1e6:6.2f}M postings/s  "
+          f"batch={n_postings / batch_time / 1e6:6.2f}M postings/s  speedup={loop_time / batch_time:5.1f}x")
+
+
+def build_random_index(base_dir, n_terms=2000, bucket_name=None, n_buckets=4, max_df=20_000, seed=2, compressed=False):
+    """ Writes the posting lists of `n_terms` random terms with write_a_posting_list and
+        returns an InvertedIndex with their df and posting_locs.
+    """
+    rng = np.random.default_rng(seed)
+    index = InvertedIndex()
+    buckets = [[] for _ in range(n_buckets)]
+    for i in range(n_terms):
+        df = int(min(rng.zipf(1.3), max_df))
+        doc_ids = np.sort(rng.choice(1_000_000, size=df, replace=False))
+        tfs = rng.zipf(2.0, size=df).clip(1, 1000)
+        w = f'term{i}'
+        index.df[w] = df
+        buckets[i % n_buckets].append((w, list(zip(doc_ids.tolist(), tfs.tolist()))))
+    for bucket_id, list_w_pl in enumerate(buckets):
+        InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), base_dir, bucket_name, compressed=compressed)
+    for bucket_id in range(n_buckets):
+        b = LocalBucket(base_dir) if bucket_name is None else bucket_name
+        with b.blob(f'{base_dir}/{bucket_id}_posting_locs.pickle' if bucket_name else
+                    f'{bucket_id}_posting_locs.pickle').open('rb') as f:
+            index.posting_locs.update(pickle.load(f))
+    index.load_posting_nbytes(base_dir, bucket_name)
+    return index
+
+
+def bench_reader(n_queries=300, terms_per_query=4):
+    """ Compares a MultiFileReader per term (the old read_a_posting_list) with the
+        shared PostingReader on random multi term queries over a fake blob store.
+    """
+    rng = np.random.default_rng(3)
+    with tempfile.TemporaryDirectory() as root:
+        bucket = LocalBucket(root)
+        index = build_random_index('postings', bucket_name=bucket)
+        terms = list(index.posting_locs)
+        queries = [rng.choice(terms, size=terms_per_query).tolist() for _ in range(n_queries)]
+
+        def per_term():
+            for query in queries:
+                for w in query:
+                    with closing(MultiFileReader('postings', bucket)) as reader:
+                        decode_posting_list(reader.read(index.posting_locs[w], index.posting_nbytes_of(w)), index.df[w])
+
+        def pooled():
+            for query in queries:
+                index.read_posting_arrays('postings', query, bucket)
+
+        bucket.n_opens = 0
+        per_term_time = _timeit(per_term, repeat=1)
+        per_term_opens = bucket.n_opens
+        bucket.n_opens = 0
+        pooled_time = _timeit(pooled, repeat=1)
+        stats = index.posting_reader('postings', bucket).stats()
+        print(f"reader queries={n_queries}  per-term: {per_term_time * 1000:7.1f}ms {per_term_opens} opens  "
+              f"pooled: {pooled_time * 1000:7.1f}ms {bucket.n_opens} opens")
+        print(f"reader pooled stats: {stats}")
+
+
+def bench_mmap(n_reads=3000):
+    """ Compares open/seek/read with mmap reads of local posting files, and a bucket
+        read through a warm LocalBlockCache mirror.
+    """
+    rng = np.random.default_rng(4)
+    with tempfile.TemporaryDirectory() as root:
+        index = build_random_index(root)
+        terms = rng.choice(list(index.posting_locs), size=n_reads).tolist()
+        requests = [(index.posting_locs[w], index.posting_nbytes_of(w)) for w in terms]
+        bucket = LocalBucket(root)
+        readers = {
+            'read': PostingReader(root),
+            'mmap': PostingReader(root, use_mmap=True),
+            'block cache': PostingReader('.', bucket, block_cache=LocalBlockCache(f'{root}/cache', 2 ** 30)),
+        }
+        for name, reader in readers.items():
+            reader.read_many(requests)  # warm up (fills the block cache)
+            elapsed = _timeit(lambda: [reader.read(locs, n) for locs, n in requests])
+            print(f"mmap {name:>12}: {n_reads / elapsed / 1000:8.1f}k posting lists/s")
+
+
+def bench_cache(n_queries=2000, terms_per_query=3, budget=64 * 2 ** 20):
+    """ Replays zipf distributed (head heavy) queries over a fake blob store with and
+        without a PostingCache and reports p50/p95 fetch latency and the hit rate.
+    """
+    rng = np.random.default_rng(5)
+    with tempfile.TemporaryDirectory() as root:
+        bucket = LocalBucket(root)
+        index = build_random_index('postings', bucket_name=bucket)
+        terms = list(index.posting_locs)
+        picks = (rng.zipf(1.2, size=(n_queries, terms_per_query)) - 1) % len(terms)
+        queries = [[terms[i] for i in row] for row in picks]
+        cache = PostingCache(budget)
+
+        def replay(fetch):
+            latencies = []
+            for query in queries:
+                t_start = time.perf_counter()
+                fetch(query)
+                latencies.append(time.perf_counter() - t_start)
+            return np.percentile(latencies, [50, 95]) * 1000
+
+        load = lambda missing: index.read_posting_arrays('postings', missing, bucket)
+        no_cache = replay(load)
+        with_cache = replay(lambda query: cache.get_many('postings', query, load))
+        print(f"cache p50/p95 without cache: {no_cache[0]:.3f}/{no_cache[1]:.3f}ms  "
+              f"with cache: {with_cache[0]:.3f}/{with_cache[1]:.3f}ms")
+        print(f"cache stats: {cache.stats()}")
+
+
+def build_random_engine(root, n_docs=200_000, n_terms=300, seed=6):
+    """ Builds small random body and title indices (with block-max bounds, and document
+        norms for the body), PageRank and
+        page views under `root` and returns a QueryEngine over them and the list of terms.
+    """
+    rng = np.random.default_rng(seed)
+    all_doc_ids = np.sort(rng.choice(10_000_000, size=n_docs, replace=False))
+    pagerank = dict(zip(all_doc_ids.tolist(), (rng.pareto(2.0, n_docs) * 0.1).tolist()))
+    page_views = dict(zip(all_doc_ids.tolist(), (rng.pareto(1.5, n_docs) * 0.05).tolist()))
+    engines_args = []
+    for name, max_df, mean_len in (('body', 60_000, 400), ('title', 2_000, 4)):
+        index = InvertedIndex()
+        index.doc_len = dict(zip(all_doc_ids.tolist(), (rng.poisson(mean_len, n_docs) + 1).tolist()))
+        index.N = n_docs
+        index.unique_terms = sum(index.doc_len.values())
+        buckets = [[] for _ in range(4)]
+        for i in range(n_terms):
+            df = int(min(rng.zipf(1.2) * 20, max_df))
+            doc_ids = np.sort(rng.choice(all_doc_ids, size=df, replace=False))
+            tfs = rng.zipf(2.0, size=df).clip(1, 1000)
+            index.df[f'term{i}'] = df
+            buckets[i % 4].append((f'term{i}', list(zip(doc_ids.tolist(), tfs.tolist()))))
+        base_dir = f'{root}/{name}'
+        Path(base_dir).mkdir()
+        for bucket_id, list_w_pl in enumerate(buckets):
+            InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), base_dir, None,
+                                               index.doc_len, pagerank, page_views)
+            with open(f'{base_dir}/{bucket_id}_posting_locs.pickle', 'rb') as f:
+                index.posting_locs.update(pickle.load(f))
+        index.load_block_max(base_dir)
+        index.load_posting_nbytes(base_dir)
+        if name == 'body':
+            index.compute_doc_norms(base_dir)
+        bm25 = BM25(index.doc_len, index.df, index.N, index.unique_terms)
+        engines_args += [index, base_dir, bm25]
+    body_index, body_dir, bm25_body, title_index, title_dir, bm25_title = engines_args
+    bm25_body.k1 = 0.7
+    bm25_title.b = 0.7
+    fetch = lambda index, terms, dir_name: index.read_posting_arrays(dir_name, terms)
+    engine = QueryEngine(body_index, body_dir, title_index, title_dir, bm25_body, bm25_title,
+                         page_views, pagerank, fetch)
+    return engine, [f'term{i}' for i in range(n_terms)]
+
+
+def bench_bmw(n_queries=100):
+    """ Compares exhaustive scoring with block-max pruning on random multi term queries:
+        checks that both return the same top 100 and reports the postings scored and latency.
+    """
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        for n_terms in (1, 2, 4):
+            queries = [rng.choice(terms[:60], size=n_terms, replace=False).tolist() for _ in range(n_queries)]
+            res = {}
+            for method in ('exhaustive', 'bmw'):
+                stats = Counter()
+                t_start = time.perf_counter()
+                res[method] = [engine.search(query, 100, method, stats) for query in queries]
+                elapsed = (time.perf_counter() - t_start) / n_queries
+                print(f"bmw {n_terms} terms {method:>10}: {stats['postings_scored'] / n_queries:10,.0f} postings scored/query "
+                      f"{elapsed * 1000:7.2f}ms/query")
+            assert res['bmw'] == res['exhaustive']
+
+
+def bench_champions(n_queries=200, sizes=(500, 2_000, 8_000), min_df=10_000):
+    """ Compares the champion tiers with exhaustive scoring on random queries of high df terms:
+        reports the share of the exhaustive top 10 / top 100 they find (the quality loss), the
+        postings scored, the latency and how often the full lists had to be read.
+    """
+    rng = np.random.default_rng(12)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        body_dir = engine.body_dir
+        high_df = [term for term in terms if engine.body_index.df[term] >= min_df]
+        queries = [rng.choice(high_df, size=rng.integers(1, 4), replace=False).tolist()
+                   + rng.choice(terms, size=rng.integers(0, 2), replace=False).tolist() for _ in range(n_queries)]
+        stats = Counter()
+        t_start = time.perf_counter()
+        exhaustive = [engine.search(query, 100, 'exhaustive', stats) for query in queries]
+        elapsed = (time.perf_counter() - t_start) / n_queries
+        print(f"champions {len(high_df)} terms with df >= {min_df:,}  exhaustive: "
+              f"{stats['postings_scored'] / n_queries:10,.0f} postings scored/query {elapsed * 1000:7.2f}ms/query")
+        for size in sizes:
+            out_dir = f'{root}/body_champions_{size}'
+            Path(out_dir).mkdir()
+            engine.body_index.convert_postings(body_dir, out_dir, pagerank=engine.pagerank_scores,
+                                               page_views=engine.page_views, champion_size=size, champion_min_df=min_df)
+            body_dir = engine.body_dir = out_dir
+            stats = Counter()
+            t_start = time.perf_counter()
+            res = [engine.search(query, 100, 'champions', stats) for query in queries]
+            elapsed = (time.perf_counter() - t_start) / n_queries
+            top10 = np.mean([len(set(got[:10]) & set(ref[:10])) / max(len(ref[:10]), 1) for got, ref in zip(res, exhaustive)])
+            top100 = np.mean([len(set(got) & set(ref)) / max(len(ref), 1) for got, ref in zip(res, exhaustive)])
+            print(f"champions r={size:>6,}: {stats['postings_scored'] / n_queries:10,.0f} postings scored/query "
+                  f"{elapsed * 1000:7.2f}ms/query  top 10 found {top10:6.1%}  top 100 found {top100:6.1%}  "
+                  f"fallbacks {stats['champion_fallbacks'] / n_queries:6.1%}")
+
+
+def bench_batch(n_queries=300, terms_per_query=3):
+    """ Compares one search() call per query with search_batch() on zipf distributed
+        queries (like an evaluation set, where the head terms repeat), and checks that
+        both return the same results.
+    """
+    rng = np.random.default_rng(11)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        picks = (rng.zipf(1.3, size=(n_queries, terms_per_query)) - 1) % len(terms)
+        queries = [[terms[i] for i in row] for row in picks]
+        for method in QueryEngine.METHODS:
+            one_stats, batch_stats = Counter(), Counter()
+            t_start = time.perf_counter()
+            one_by_one = [engine.search(query, 100, method, one_stats) for query in queries]
+            one_time = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            batch = engine.search_batch(queries, 100, method, batch_stats)
+            batch_time = time.perf_counter() - t_start
+            assert batch == one_by_one
+            print(f"batch {method:>10} {n_queries} queries  one by one: {one_time * 1000:7.1f}ms "
+                  f"{one_stats['postings_scored']:>10,} postings scored  batch: {batch_time * 1000:7.1f}ms "
+                  f"{batch_stats['postings_scored']:>10,} postings scored")
+
+
+def bench_result_cache(n_queries=3000, n_distinct=500, size=200, ttl=600):
+    """ Replays a zipf distributed query log (head queries repeat, often with their words in
+        another order or case) through tokenize + search and through the memoized analyzer +
+        ResultCache, and reports the latency, the hit rates and that both return the same results.
+    """
+    rng = np.random.default_rng(13)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        pool = [rng.choice(terms[:100], size=rng.integers(1, 4), replace=False).tolist() for _ in range(n_distinct)]
+        log = []
+        for i in (rng.zipf(1.3, size=n_queries) - 1) % n_distinct:
+            words = [word.upper() if rng.random() < 0.2 else word for word in rng.permutation(pool[i]).tolist()]
+            log.append(' '.join(words))
+        analyze.cache_clear()
+        cache = ResultCache(size, ttl)
+
+        def uncached(query):
+            return engine.search(tokenize(query), 100)
+
+        def cached(query):
+            tokens = list(analyze(query))
+            key = normalized_query(tokens)
+            doc_ids = cache.get(key, engine.ranking_version())
+            if doc_ids is None:
+                doc_ids = engine.search(tokens, 100)
+                cache.put(key, engine.ranking_version(), doc_ids)
+            return doc_ids
+
+        for name, search in (('uncached', uncached), ('cached', cached)):
+            latencies, results = [], []
+            for query in log:
+                t_start = time.perf_counter()
+                results.append(search(query))
+                latencies.append(time.perf_counter() - t_start)
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+            print(f"result cache {name:>8}: {np.mean(latencies) * 1000:7.3f}ms/query p50 {p50:7.3f}ms p95 {p95:7.3f}ms")
+            if name == 'uncached':
+                reference = results
+        same = np.mean([list(got) == list(ref) for got, ref in zip(results, reference)])
+        info = analyze.cache_info()
+        print(f"result cache stats: {cache.stats()}  analyzer hits {info.hits / max(info.hits + info.misses, 1):.1%}  "
+              f"same results {same:.1%}")
+        engine.page_rank_tuner += 0.1
+        cached(log[0])
+        print(f"result cache after a tuning change: {cache.stats()['invalidations']} stale entry miss(es)")
+
+
+def _cosine_loop(engine, tokens, k=100):
+    """ The dict based TF-IDF cosine similarity, kept here as the reference. """
+    index = engine.body_index
+    query_tf = Counter(tokens)
+    query_weights = {w: tf * np.log10(index.N / index.df[w]) for w, tf in query_tf.items()}
+    dot = defaultdict(float)
+    for w, (doc_ids, tfs) in index.read_posting_arrays(engine.body_dir, list(query_tf)).items():
+        for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist()):
+            dot[doc_id] += tf * np.log10(index.N / index.df[w]) * query_weights[w]
+    query_norm = np.sqrt(sum(weight ** 2 for weight in query_weights.values()))
+    return {doc_id: score / (index.doc_norm[doc_id] * query_norm) for doc_id, score in dot.items()}
+
+
+def bench_cosine(n_queries=100):
+    """ Compares the latency of the TF-IDF cosine engine (/search_body) with the fused BM25
+        engine (/search) on random multi term queries, and checks the cosine scores of the
+        top 100 against the dict based scorer.
+    """
+    rng = np.random.default_rng(13)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        for n_terms in (1, 2, 4):
+            queries = [rng.choice(terms[:60], size=n_terms, replace=False).tolist() for _ in range(n_queries)]
+            for query in queries[:5]:
+                expected = _cosine_loop(engine, query)
+                res = engine.search_body(query)
+                best = sorted(expected.values(), reverse=True)[:len(res)]
+                assert np.allclose([expected[doc_id] for doc_id in res], best, rtol=1e-5)
+            for name, search in (('search_body', engine.search_body), ('search', engine.search)):
+                stats = Counter()
+                t_start = time.perf_counter()
+                for query in queries:
+                    search(query, 100, stats=stats)
+                elapsed = (time.perf_counter() - t_start) / n_queries
+                print(f"cosine {n_terms} terms {name:>12}: {stats['postings_scored'] / n_queries:10,.0f} postings scored/query "
+                      f"{elapsed * 1000:7.2f}ms/query")
+
+
+def bench_distinct(n_terms=4, df=2_000_000):
+    """ Ranks the documents of a few long posting lists by the number of distinct query terms
+        they contain (/search_title and /search_anchor), vectorized vs a Counter over the postings.
+    """
+    arrays = [random_postings(df, seed)[0] for seed in range(n_terms)]
+    t_vec = _timeit(lambda: rank_by_distinct_terms(arrays))
+
+    def counter_loop():
+        counts = Counter()
+        for doc_ids in arrays:
+            counts.update(doc_ids.tolist())
+        return sorted(counts, key=lambda doc_id: (-counts[doc_id], doc_id))
+    t_loop = _timeit(counter_loop, repeat=1)
+    assert rank_by_distinct_terms(arrays)[0].tolist() == counter_loop()
+    print(f"distinct {n_terms} terms x {df:,} postings  Counter: {t_loop * 1000:8.1f}ms  "
+          f"vectorized: {t_vec * 1000:7.1f}ms  ({t_loop / t_vec:.0f}x)")
+
+
+def bench_bulk(n_docs=6_000_000, sizes=(10_000, 100_000)):
+    """ /get_pagerank and /get_pageview payloads: a dict lookup per id with a json response vs the
+        vectorized DocColumn.take with a json or a binary (little-endian float32) response.
+    """
+    rng = np.random.default_rng(17)
+    doc_ids = rng.choice(70_000_000, size=n_docs, replace=False)
+    pagerank = dict(zip(doc_ids.tolist(), rng.pareto(2.0, n_docs).tolist()))
+    column = DocColumn.from_dict(pagerank)
+    for size in sizes:
+        # a tenth of the asked ids are not in the table
+        wiki_ids = np.concatenate([rng.choice(doc_ids, size - size // 10), rng.integers(0, 70_000_000, size // 10)])
+        payload = json.dumps(wiki_ids.tolist())
+        ids = np.array(json.loads(payload), dtype=np.int64)
+        t_dict = _timeit(lambda: json.dumps([pagerank.get(wiki_id, 0) for wiki_id in json.loads(payload)]))
+        t_json = _timeit(lambda: json.dumps(column.take(np.array(json.loads(payload), dtype=np.int64)).tolist()))
+        t_binary = _timeit(lambda: column.take(ids).astype('<f4').tobytes())
+        assert np.allclose(column.take(ids), [pagerank.get(wiki_id, 0) for wiki_id in ids.tolist()], rtol=1e-6)
+        print(f"bulk {size:>7,} ids  dict+json: {size / t_dict / 1e6:6.2f}M ids/s  take+json: {size / t_json / 1e6:6.2f}M ids/s  "
+              f"take+binary: {size / t_binary / 1e6:7.2f}M ids/s")
+
+
+def bench_profile(n_queries=300):
+    """ The cost of the per stage timings: search() with a plain Counter (no stage timings)
+        vs a RequestProfile, on the same queries.
+    """
+    rng = np.random.default_rng(19)
+    with tempfile.TemporaryDirectory() as root:
+        engine, terms = build_random_engine(root)
+        queries = [rng.choice(terms[:100], size=2, replace=False).tolist() for _ in range(n_queries)]
+        for query in queries:
+            engine.search(query)
+        times = {}
+        for name, make_stats in (('Counter', Counter), ('RequestProfile', RequestProfile)):
+            times[name] = _timeit(lambda: [engine.search(query, stats=make_stats()) for query in queries]) / n_queries
+        profile = RequestProfile()
+        engine.search(queries[0], stats=profile)
+        print(f"profile {n_queries} queries  Counter: {times['Counter'] * 1000:6.3f}ms/query  "
+              f"RequestProfile: {times['RequestProfile'] * 1000:6.3f}ms/query  stages: {list(profile.stages)}")
+
+
+def bench_doctable(n_docs=2_000_000, n_lookups=1_000_000):
+    """ Compares dict lookups of page views / titles with the memory mapped DocTable. """
+    rng = np.random.default_rng(8)
+    doc_ids = np.sort(rng.choice(70_000_000, size=n_docs, replace=False))
+    ids = doc_ids.tolist()
+    page_views = dict(zip(ids, rng.pareto(1.5, n_docs).astype(np.float32).tolist()))
+    titles = {doc_id: f'Article number {doc_id}' for doc_id in ids}
+    queries = rng.choice(doc_ids, size=n_lookups)
+    with tempfile.TemporaryDirectory() as root:
+        table = DocTable.build(root, page_views=page_views, titles=titles)
+        column = table.column('page_views')
+        assert np.array_equal(lookup(page_views, queries), lookup(column, queries))
+        dict_time = _timeit(lambda: lookup(page_views, queries))
+        table_time = _timeit(lambda: lookup(column, queries))
+        print(f"doctable {n_lookups:,} page view lookups  dict={dict_time * 1000:7.1f}ms  table={table_time * 1000:6.1f}ms")
+        top = queries[:100]
+        assert table.titles().lookup(top) == [titles[doc_id] for doc_id in top.tolist()]
+        on_disk = sum(f.stat().st_size for f in Path(root).iterdir())
+        print(f"doctable {n_docs:,} docs on disk (all columns + titles): {on_disk / 2 ** 20:.0f}MB")
+
+
+class ThrottledBucket(LocalBucket):
+    """ A LocalBucket whose reads take len(bytes) / bandwidth seconds more, like a blob store
+        that streams at `bandwidth` bytes/s (None reads at the speed of the local disk).
+    """
+    def __init__(self, root, bandwidth=None):
+        super().__init__(root)
+        self.bandwidth = bandwidth
+
+    def blob(self, name):
+        bucket = self
+
+        class Blob:
+            def open(self, mode):
+                f = LocalBucket.blob(bucket, name).open(mode)
+                return f if 'w' in mode or bucket.bandwidth is None else _ThrottledFile(f, bucket.bandwidth)
+        return Blob()
+
+
+class _ThrottledFile:
+    def __init__(self, f, bandwidth):
+        self._f = f
+        self._bandwidth = bandwidth
+
+    def read(self, n=-1):
+        b = self._f.read(n)
+        time.sleep(len(b) / self._bandwidth)
+        return b
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+def bench_compressed(sizes=(1_000, 10_000, 100_000, 1_000_000), bandwidths=(None, 400e6, 100e6)):
+    """ Compares the size and decode speed of the 6 bytes format and the compressed
+        (delta + block packed) format, and the end to end time to read and decode a random
+        multi term workload from a fake blob store at several bandwidths, with every list in
+        the 6 bytes format, every list compressed, and only the lists of at least
+        PACKED_MIN_POSTINGS postings compressed (what write_a_posting_list(compressed=True) does).
+    """
+    rng = np.random.default_rng(9)
+    for n in sizes:
+        doc_ids, tfs = random_postings(n)
+        fixed = encode_postings(doc_ids, tfs)
+        compressed = encode_posting_list(doc_ids, tfs)
+        for b in (fixed, compressed):
+            decoded_ids, decoded_tfs = decode_posting_list(b, n)
+            assert np.array_equal(decoded_ids, doc_ids) and np.array_equal(decoded_tfs, tfs)
+        fixed_time = _timeit(lambda: decode_posting_list(fixed, n))
+        compressed_time = _timeit(lambda: decode_posting_list(compressed, n))
+        print(f"compressed postings={n:>9,}  bytes/posting 6B={len(fixed) / n:4.2f} packed={len(compressed) / n:4.2f}  "
+              f"decode 6B={n / fixed_time / 1e6:7.1f}M/s packed={n / compressed_time / 1e6:6.1f}M/s")
+    with tempfile.TemporaryDirectory() as root:
+        bucket = ThrottledBucket(root)
+        indices = {}
+        for name, compressed, min_postings in (('6B', False, None), ('packed', True, 0),
+                                               ('hybrid', True, inverted_index_gcp.PACKED_MIN_POSTINGS)):
+            default = inverted_index_gcp.PACKED_MIN_POSTINGS
+            inverted_index_gcp.PACKED_MIN_POSTINGS = default if min_postings is None else min_postings
+            try:
+                indices[name] = build_random_index(f'postings_{name}', n_terms=1000, bucket_name=bucket,
+                                                   max_df=300_000, compressed=compressed)
+            finally:
+                inverted_index_gcp.PACKED_MIN_POSTINGS = default
+        terms = rng.choice(list(indices['6B'].posting_locs), size=(200, 4)).tolist()
+        for bandwidth in bandwidths:
+            bucket.bandwidth = bandwidth
+            line = []
+            for name, index in indices.items():
+                index.__dict__.pop('_readers', None)
+                elapsed = _timeit(lambda: [index.read_posting_arrays(f'postings_{name}', query, bucket)
+                                           for query in terms], repeat=1)
+                stats = index.posting_reader(f'postings_{name}', bucket).stats()
+                line.append(f"{name}={elapsed * 1000:7.1f}ms/{stats['bytes_read'] / 2 ** 20:5.1f}MB")
+            print(f"compressed read+decode at {'disk speed' if bandwidth is None else f'{bandwidth / 1e6:.0f}MB/s':>10}: "
+                  + '  '.join(line))
+
+
+def bench_termdict(n_terms=1_000_000, n_lookups=20_000):
+    """ Compares loading and looking up posting_locs and df pickled as dicts with the memory
+        mapped TermDictionary.
+    """
+    rng = np.random.default_rng(10)
+    letters = np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype=np.uint8)
+    lengths = rng.integers(3, 14, n_terms)
+    heap = letters[rng.integers(0, 26, int(lengths.sum()))].tobytes().decode()
+    ends = np.cumsum(lengths).tolist()
+    terms = list(dict.fromkeys(heap[end - n:end] for end, n in zip(ends, lengths.tolist())))
+    posting_locs = {w: [(f'{i % 124}_{i % 300:03d}.bin', i * 7 % BLOCK_SIZE)] for i, w in enumerate(terms)}
+    df = dict(zip(terms, rng.zipf(1.5, len(terms)).clip(1, 6_000_000).tolist()))
+    queries = rng.choice(terms, size=n_lookups).tolist()
+    with tempfile.TemporaryDirectory() as root:
+        with open(f'{root}/index.pkl', 'wb') as f:
+            pickle.dump((posting_locs, df), f)
+        TermDictionary.build(f'{root}/terms', posting_locs, df, lambda w: df[w] * TUPLE_SIZE)
+
+        def load_pickle():
+            with open(f'{root}/index.pkl', 'rb') as f:
+                return pickle.load(f)
+        pickle_time = _timeit(load_pickle, repeat=1)
+        open_time = _timeit(lambda: TermDictionary(f'{root}/terms'), repeat=1)
+        loaded_locs, loaded_df = load_pickle()
+        terms_dict = TermDictionary(f'{root}/terms')
+        assert all(terms_dict.posting_locs[w] == loaded_locs[w] and terms_dict.df[w] == loaded_df[w] for w in queries)
+        dict_time = _timeit(lambda: [(loaded_locs[w], loaded_df[w]) for w in queries])
+        mapped_time = _timeit(lambda: [(terms_dict.posting_locs[w], terms_dict.df[w]) for w in queries])
+        sizes = approx_size(loaded_locs) + approx_size(loaded_df), approx_size(terms_dict)
+        print(f"termdict {len(terms):,} terms  load: pickle={pickle_time * 1000:7.1f}ms mmap={open_time * 1000:6.1f}ms  "
+              f"memory: dicts={sizes[0] / 2 ** 20:6.1f}MB mmap={sizes[1] / 2 ** 20:5.1f}MB")
+        print(f"termdict lookup (locs + df): dict={dict_time / n_lookups * 1e6:5.2f}us  mmap={mapped_time / n_lookups * 1e6:5.2f}us")
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'bm25': bench_bm25,
+    'reader': bench_reader,
+    'mmap': bench_mmap,
+    'cache': bench_cache,
+    'bmw': bench_bmw,
+    'batch': bench_batch,
+    'resultcache': bench_result_cache,
+    'champions': bench_champions,
+    'cosine': bench_cosine,
+    'distinct': bench_distinct,
+    'bulk': bench_bulk,
+    'profile': bench_profile,
+    'doctable': bench_doctable,
+    'compressed': bench_compressed,
+    'termdict': bench_termdict,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,62 @@
+""" Rewrites the posting files of an index, with their block-max bounds and sizes.
+
+    python convert_postings.py BASE_DIR NAME OUT_DIR [--bucket BUCKET_NAME] [--compressed] [--norms]
+                               [--champions R [--pagerank PATH] [--page-views PATH]]
+
+reads `NAME`.pkl and the posting files from BASE_DIR, writes the posting files, their locations,
+sizes and block-max bounds to OUT_DIR, and saves the converted index as OUT_DIR/`NAME`.pkl. The
+posting lists are written in the 6 bytes format, with --compressed the long ones are written in the
+compressed format (fewer bytes to read, slower to decode, see benchmarks.py compressed). Both
+formats can be read, so the old files can be removed once the server uses the new directory. With --norms the TF-IDF norms of the documents (used by
+/search_body) are computed from the converted posting lists and saved in the index too.
+With --champions R, the terms with at least --champion-min-df postings also get a champion
+tier of their R highest impact postings (used by /search?engine=champions). The impact counts
+the PageRank and page views of the documents when their files are given (read from the same
+bucket or the local disk).
+"""
+import argparse
+from contextlib import closing
+import pickle
+from doc_table import read_pagerank_csv
+from inverted_index_gcp import CHAMPION_MIN_DF, InvertedIndex, _open, get_bucket
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite the posting files of an index.")
+    parser.add_argument('base_dir')
+    parser.add_argument('name')
+    parser.add_argument('out_dir')
+    parser.add_argument('--bucket', help="read and write the files in this bucket instead of the local disk")
+    parser.add_argument('--compressed', action='store_true', help="write the long posting lists in the compressed format")
+    parser.add_argument('--norms', action='store_true', help="also compute the TF-IDF norms of the documents")
+    parser.add_argument('--champions', type=int, default=None, metavar='R',
+                        help="write a champion tier of the R highest impact postings of the high df terms")
+    parser.add_argument('--champion-min-df', type=int, default=CHAMPION_MIN_DF)
+    parser.add_argument('--pagerank', help="PageRank csv.gz, used by the block-max bounds and the champion tiers")
+    parser.add_argument('--page-views', help="page views pickle, used by the block-max bounds and the champion tiers")
+    args = parser.parse_args()
+    bucket = None if args.bucket is None else get_bucket(args.bucket)
+    pagerank = page_views = None
+    if args.pagerank:
+        with closing(_open(args.pagerank, 'rb', bucket)) as f:
+            pagerank = read_pagerank_csv(f)
+    if args.page_views:
+        with closing(_open(args.page_views, 'rb', bucket)) as f:
+            page_views = pickle.load(f)
+    index = InvertedIndex.read_index(args.base_dir, args.name, args.bucket)
+    before = sum(index.posting_nbytes_of(w) for w in index.posting_locs)
+    index.convert_postings(args.base_dir, args.out_dir, args.bucket, args.bucket, compressed=args.compressed,
+                           pagerank=pagerank, page_views=page_views, champion_size=args.champions,
+                           champion_min_df=args.champion_min_df)
+    after = sum(index.posting_nbytes_of(w) for w in index.posting_locs)
+    if args.norms:
+        index.compute_doc_norms(args.out_dir, args.bucket)
+    index.write_index(args.out_dir, args.name, args.bucket)
+    print(f"converted {len(index.posting_locs):,} posting lists: {before / 2 ** 20:,.1f}MB -> {after / 2 ** 20:,.1f}MB")
+    if args.champions:
+        tier_bytes = sum(n_bytes for _, n_bytes, _ in index.champions.values())
+        print(f"champion tiers of {len(index.champions):,} terms: {tier_bytes / 2 ** 20:,.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+""" Columnar, memory-mapped table of the per document data used at query time.
+
+The table is a directory of .npy files:
+    doc_id.npy        sorted uint32 doc ids, every other column is aligned with it
+    body_len.npy      int32 body length (number of terms)
+    title_len.npy     int32 title length
+    pagerank.npy      float64 PageRank (exact, /get_pagerank returns its values as they are)
+    page_views.npy    float32 (or int32 when all values are integers) page views
+    title_offsets.npy int64 offsets of each title in the heap (one more than the number of docs)
+    title_heap.npy    uint8 utf-8 bytes of all the titles one after the other
+
+It replaces the doc_len, page_views, pagerank_scores and doc_id_title dicts. The columns are
+memory mapped, so loading is instant and forked workers share the same pages.
+
+Build it from the existing pickles and the PageRank csv with:
+    python doc_table.py OUT_DIR [--bucket BUCKET_NAME | --local-dir DIR]
+"""
+import argparse
+import gzip
+from pathlib import Path
+import pickle
+import numpy as np
+
+DOC_ID_DTYPE = np.uint32
+# lookups of at least this many ids sort them first, which is several times faster on big columns
+SORTED_SEARCH_MIN = 4096
+NUMERIC_COLUMNS = {'body_len': np.int32, 'title_len': np.int32, 'pagerank': np.float64, 'page_views': np.float32}
+
+
+def _positions(sorted_ids, doc_ids):
+    """ Returns the positions of doc_ids in sorted_ids and a mask of the ones that were found. """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(doc_ids), dtype=np.int64), np.zeros(len(doc_ids), dtype=bool)
+    # the queries are cast to the column dtype so searchsorted does not copy the column
+    valid = (doc_ids >= 0) & (doc_ids <= np.iinfo(DOC_ID_DTYPE).max)
+    ids = np.where(valid, doc_ids, 0).astype(DOC_ID_DTYPE)
+    if len(ids) >= SORTED_SEARCH_MIN:
+        # searching the ids in sorted order walks the column once instead of jumping around it
+        order = np.argsort(ids)
+        pos = np.empty(len(ids), dtype=np.int64)
+        pos[order] = np.searchsorted(sorted_ids, ids[order])
+    else:
+        pos = np.searchsorted(sorted_ids, ids)
+    pos = pos.clip(0, len(sorted_ids) - 1)
+    return pos, valid & (sorted_ids[pos] == ids)
+
+
+def _integer_dtype(values, dtype):
+    """ Returns int32 when all the values are whole numbers that fit in it, dtype otherwise. """
+    if np.array_equal(values, np.round(values)) and np.abs(values).max(initial=0) < 2 ** 31:
+        return np.int32
+    return dtype
+
+
+class DocColumn:
+    """ A read only, dict like view of one numeric column (doc_id -> value). get() works
+        like dict.get, and lookup() returns the values of a whole array of doc ids at once,
+        with `default` for the missing ones.
+    """
+    def __init__(self, doc_ids, values, default=0):
+        self._doc_ids = doc_ids
+        self._values = values
+        self.default = default
+
+    def lookup(self, doc_ids):
+        pos, found = _positions(self._doc_ids, doc_ids)
+        if len(self._doc_ids) == 0:
+            return np.full(len(pos), self.default, dtype=np.float64)
+        res = np.asarray(self._values[pos], dtype=np.float64) if len(pos) else np.zeros(0)
+        res[~found] = self.default
+        return res
+
+    def take(self, doc_ids):
+        """ Like lookup, but returns the values in the dtype of the column. """
+        pos, found = _positions(self._doc_ids, doc_ids)
+        if len(self._doc_ids) == 0:
+            return np.full(len(pos), self.default, dtype=self._values.dtype)
+        return np.where(found, self._values[pos], self.default).astype(self._values.dtype, copy=False)
+
+    def arrays(self):
+        """ Returns the (sorted doc ids, values) arrays of the column. """
+        return self._doc_ids, self._values
+
+    @staticmethod
+    def from_dict(mapping, dtype=np.float32, keep_integers=False, default=0):
+        """ Builds an in memory column from a dict of doc_id -> value. With keep_integers the
+            values are stored as int32 when they are all whole numbers.
+        """
+        doc_ids = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+        values = np.fromiter(mapping.values(), dtype=np.float64, count=len(mapping))
+        order = np.argsort(doc_ids)
+        values = values[order]
+        if keep_integers:
+            dtype = _integer_dtype(values, dtype)
+        return DocColumn(doc_ids[order].astype(DOC_ID_DTYPE), values.astype(dtype), default)
+
+    def get(self, doc_id, default=None):
+        pos, found = _positions(self._doc_ids, [doc_id])
+        return self._values[pos[0]].item() if found[0] else default
+
+    def __getitem__(self, doc_id):
+        value = self.get(doc_id)
+        if value is None:
+            raise KeyError(doc_id)
+        return value
+
+    def __contains__(self, doc_id):
+        return bool(_positions(self._doc_ids, [doc_id])[1][0])
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def keys(self):
+        return self._doc_ids
+
+    def values(self):
+        return self._values
+
+
+class TitleColumn:
+    """ A read only, dict like view of the titles (doc_id -> str) stored in the string heap. """
+    def __init__(self, doc_ids, offsets, heap):
+        self._doc_ids = doc_ids
+        self._offsets = offsets
+        self._heap = heap
+
+    def _title_at(self, pos):
+        return bytes(self._heap[self._offsets[pos]:self._offsets[pos + 1]]).decode('utf-8')
+
+    def lookup(self, doc_ids, default=""):
+        """ Returns the titles of a list of doc ids (`default` for the missing ones). """
+        pos, found = _positions(self._doc_ids, doc_ids)
+        return [self._title_at(p) if f else default for p, f in zip(pos.tolist(), found.tolist())]
+
+    def get(self, doc_id, default=None):
+        return self.lookup([doc_id], default)[0]
+
+    def __contains__(self, doc_id):
+        return bool(_positions(self._doc_ids, [doc_id])[1][0])
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+
+class DocTable:
+    """ The memory mapped document table of a directory written by DocTable.build. """
+    def __init__(self, directory, mmap=True):
+        self.directory = Path(directory)
+        mode = 'r' if mmap else None
+        self.doc_ids = np.load(self.directory / 'doc_id.npy', mmap_mode=mode)
+        self.columns = {name: np.load(self.directory / f'{name}.npy', mmap_mode=mode) for name in NUMERIC_COLUMNS}
+        self.title_offsets = np.load(self.directory / 'title_offsets.npy', mmap_mode=mode)
+        self.title_heap = np.load(self.directory / 'title_heap.npy', mmap_mode=mode)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def column(self, name, default=0):
+        """ Returns a DocColumn (dict like) view of a numeric column. """
+        return DocColumn(self.doc_ids, self.columns[name], default)
+
+    def titles(self):
+        """ Returns a TitleColumn (dict like) view of the titles. """
+        return TitleColumn(self.doc_ids, self.title_offsets, self.title_heap)
+
+    @staticmethod
+    def build(out_dir, body_len=None, title_len=None, pagerank=None, page_views=None, titles=None):
+        """ Writes a document table. Every argument is an optional dict of doc_id -> value,
+            a document that is missing from a dict gets 0 (or an empty title). The table holds
+            the union of the doc ids of all the dicts. Returns the DocTable.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        sources = {'body_len': body_len, 'title_len': title_len, 'pagerank': pagerank, 'page_views': page_views}
+        all_ids = [np.fromiter(d.keys(), dtype=np.int64, count=len(d)) for d in list(sources.values()) + [titles] if d]
+        doc_ids = np.unique(np.concatenate(all_ids)) if all_ids else np.empty(0, dtype=np.int64)
+        ids = doc_ids.tolist()
+        np.save(out_dir / 'doc_id.npy', doc_ids.astype(DOC_ID_DTYPE))
+        for name, dtype in NUMERIC_COLUMNS.items():
+            source = sources[name] or {}
+            values = np.fromiter((source.get(doc_id, 0) for doc_id in ids), dtype=np.float64, count=len(ids))
+            # page views are kept as integers when they are whole numbers
+            if name == 'page_views':
+                dtype = _integer_dtype(values, dtype)
+            np.save(out_dir / f'{name}.npy', values.astype(dtype))
+        titles = titles or {}
+        encoded = [titles.get(doc_id, "").encode('utf-8') for doc_id in ids]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        np.save(out_dir / 'title_offsets.npy', offsets)
+        np.save(out_dir / 'title_heap.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        return DocTable(out_dir)
+
+
+def read_pagerank_csv(f):
+    """ Reads a gzipped `doc_id,rank` csv (a binary file object) into a dict. """
+    pagerank = {}
+    with gzip.open(f, "rt") as gz:
+        for line in gz:
+            try:
+                doc_id, rank = line.strip().split(',')
+                pagerank[int(doc_id)] = float(rank)
+            except ValueError:
+                continue
+    return pagerank
+
+
+def main():
+    # these are the same artifacts search_frontend.py loads
+    from inverted_index_gcp import InvertedIndex, _open, get_bucket
+    parser = argparse.ArgumentParser(description="Build the document table from the index pickles.")
+    parser.add_argument('out_dir')
+    parser.add_argument('--bucket', default="214682189")
+    parser.add_argument('--local-dir', help="read the artifacts from this directory instead of the bucket")
+    parser.add_argument('--page-views', default="page_views_august_2021_log.pkl")
+    parser.add_argument('--pagerank', default="pr/part-00000-dfa568ba-d8f3-4828-9ded-c144a863ddec-c000_log.csv.gz")
+    parser.add_argument('--titles', default="docID_title_mapper.pkl")
+    parser.add_argument('--slim', action='store_true',
+                        help="also write <name>_slim.pkl copies of the index pickles without doc_len")
+    args = parser.parse_args()
+    bucket_name = None if args.local_dir else args.bucket
+    bucket = None if bucket_name is None else get_bucket(bucket_name)
+    root = Path(args.local_dir) if args.local_dir else None
+    path = lambda name: name if root is None else str(root / name)
+
+    indices = {}
+    for index_dir, name in (("body_index", "body"), ("title_index", "title")):
+        base_dir = index_dir if root is None else root / index_dir
+        indices[name] = (InvertedIndex.read_index(base_dir, name, bucket_name), base_dir)
+    with _open(path(args.page_views), 'rb', bucket) as f:
+        page_views = pickle.load(f)
+    with _open(path(args.pagerank), 'rb', bucket) as f:
+        pagerank = read_pagerank_csv(f)
+    with _open(path(args.titles), 'rb', bucket) as f:
+        titles = pickle.load(f)
+    table = DocTable.build(args.out_dir, body_len=indices['body'][0].doc_len, title_len=indices['title'][0].doc_len,
+                           pagerank=pagerank, page_views=page_views, titles=titles)
+    print(f"wrote {len(table):,} documents to {args.out_dir}")
+    if args.slim:
+        for name, (index, base_dir) in indices.items():
+            index.write_slim(base_dir, name, bucket_name, ['doc_len'])
+
+
+if __name__ == '__main__':
+    main()
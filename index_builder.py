@@ -0,0 +1,435 @@
+""" Streaming, multi-process builder of an InvertedIndex on the local disk.
+
+InvertedIndex.add_doc keeps every posting in memory, so a full corpus needs a Spark job. This
+builder works in two phases, both spread over a pool of processes:
+
+1. tokenize: the documents are sent in chunks to worker processes, which tokenize them with
+   text_Modification.tokenize and collect their postings. When a worker's share of the memory
+   budget is full it spills a sorted run to disk: the postings of every bucket, sorted by term
+   and doc id.
+2. merge: every bucket is merged on its own, a k-way merge of the bucket's part of every run,
+   and written with InvertedIndex.write_a_posting_list (with the document lengths, so the
+   block-max bounds are as tight as the in-memory writer's). The runs are read one block at a time
+   and the norms are flushed to disk as they grow, so a merge holds a few blocks per run.
+
+The output is the same as the Spark pipeline's: `bucket_id`_NNN.bin posting files, the
+`bucket_id`_posting_locs / _posting_nbytes / _block_max pickles, and the `name`.pkl globals,
+which also hold the TF-IDF norm of every document (doc_norm, used by /search_body).
+
+    python index_builder.py OUT_DIR NAME INPUT [INPUT ...] [--field text] [--workers N]
+
+INPUT is a .jsonl file of {"id": ..., "<field>": ...} documents, or a parquet file (needs pyarrow).
+With --anchor the field holds the outgoing links of every document, a list of {"id": ..., "text": ...},
+and the text of every link is indexed under the document it points to (the anchor text index).
+"""
+import argparse
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import queue
+import shutil
+import numpy as np
+from doc_table import DOC_ID_DTYPE, DocColumn
+from inverted_index_gcp import InvertedIndex, tfidf_weights
+from text_Modification import tokenize
+
+# the number of buckets the terms are hashed into, as in the Spark pipeline
+NUM_BUCKETS = 124
+# number of documents sent to a worker at a time
+CHUNK_SIZE = 512
+# memory budget of all the tokenize workers together
+MEMORY_BUDGET = 2 * 2 ** 30
+# rough python memory of a posting in the worker's buffers (three array slots) and of a term
+POSTING_BYTES = 24
+TERM_BYTES = 120
+# a spilled section is written in blocks of up to this many postings, which the merge reads one at a time
+SPILL_BLOCK_POSTINGS = 2 ** 16
+# read buffer of every run the merge of a bucket streams from
+RUN_READ_BUFFER = 2 ** 20
+# the merge of a bucket saves its part of the document norms every this many postings
+NORM_FLUSH_POSTINGS = 2 ** 22
+# seconds between two checks that the tokenize workers are alive, while waiting on their queues
+WORKER_POLL_SECONDS = 1
+
+
+def _hash(s):
+    return hashlib.blake2b(bytes(s, encoding='utf8'), digest_size=5).hexdigest()
+
+
+def token2bucket_id(token, num_buckets=NUM_BUCKETS):
+    return int(_hash(token), 16) % num_buckets
+
+
+class _RunWriter:
+    """ Buffers the postings of one tokenize worker and spills them as sorted runs. """
+    def __init__(self, run_dir, worker_id, max_bytes, num_buckets):
+        self.run_dir = Path(run_dir)
+        self.worker_id = worker_id
+        self.max_bytes = max_bytes
+        self.num_buckets = num_buckets
+        self.runs = []
+        self.doc_len = {}
+        self._reset()
+
+    def _reset(self):
+        self.vocab = {}
+        self.term_ids = array('q')
+        self.doc_ids = array('q')
+        self.tfs = array('q')
+
+    def add(self, doc_id, tokens):
+        # a document can come more than once (one time per link pointing to it in the anchor
+        # text index), its postings are summed up by the merge
+        self.doc_len[doc_id] = self.doc_len.get(doc_id, 0) + len(tokens)
+        for w, tf in Counter(tokens).items():
+            self.term_ids.append(self.vocab.setdefault(w, len(self.vocab)))
+            self.doc_ids.append(doc_id)
+            self.tfs.append(tf)
+        if len(self.term_ids) * POSTING_BYTES + len(self.vocab) * TERM_BYTES >= self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        """ Writes the buffered postings as a run: one section per bucket, sorted by term and
+            then doc id, made of pickled (terms, posting counts, doc_ids, tfs) blocks of up to
+            SPILL_BLOCK_POSTINGS postings (a term with more postings is split over blocks).
+        """
+        if not self.term_ids:
+            return
+        terms = list(self.vocab)
+        buckets = np.array([token2bucket_id(w, self.num_buckets) for w in terms], dtype=np.int64)
+        # rank of every term in (bucket, term) order
+        term_order = sorted(range(len(terms)), key=lambda i: (buckets[i], terms[i]))
+        rank = np.empty(len(terms), dtype=np.int64)
+        rank[term_order] = np.arange(len(terms))
+        term_ids = np.frombuffer(self.term_ids, dtype=np.int64)
+        doc_ids = np.frombuffer(self.doc_ids, dtype=np.int64)
+        tfs = np.frombuffer(self.tfs, dtype=np.int64)
+        order = np.lexsort((doc_ids, rank[term_ids]))
+        sorted_ranks = rank[term_ids][order]
+        counts = np.bincount(sorted_ranks, minlength=len(terms))
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        sorted_terms = [terms[i] for i in term_order]
+        sorted_buckets = buckets[term_order]
+        bucket_bounds = np.searchsorted(sorted_buckets, np.arange(self.num_buckets + 1))
+        path = self.run_dir / f'run_{self.worker_id}_{len(self.runs)}.bin'
+        sections = {}
+        with open(path, 'wb') as f:
+            for bucket_id in range(self.num_buckets):
+                lo, hi = bucket_bounds[bucket_id], bucket_bounds[bucket_id + 1]
+                if lo == hi:
+                    continue
+                offset = f.tell()
+                for terms_block, counts_block, start, end in _blocks(sorted_terms[lo:hi], counts[lo:hi], starts[lo]):
+                    block = (terms_block, counts_block, doc_ids[order[start:end]], tfs[order[start:end]])
+                    pickle.dump(block, f, protocol=pickle.HIGHEST_PROTOCOL)
+                sections[bucket_id] = (offset, f.tell() - offset)
+        self.runs.append((str(path), sections))
+        self._reset()
+
+
+def _blocks(terms, counts, start):
+    """ Splits the sorted terms of a section and their posting counts into blocks of up to
+        SPILL_BLOCK_POSTINGS postings. Yields (terms, counts, first posting, end posting).
+    """
+    block_terms, block_counts, block_start = [], [], start
+    for w, count in zip(terms, counts.tolist()):
+        while count:
+            take = min(count, SPILL_BLOCK_POSTINGS - (start - block_start))
+            block_terms.append(w)
+            block_counts.append(take)
+            start += take
+            count -= take
+            if start - block_start == SPILL_BLOCK_POSTINGS:
+                yield block_terms, np.array(block_counts, dtype=np.int64), block_start, start
+                block_terms, block_counts, block_start = [], [], start
+    if block_terms:
+        yield block_terms, np.array(block_counts, dtype=np.int64), block_start, start
+
+
+def _tokenize_worker(worker_id, tasks, results, run_dir, max_bytes, num_buckets):
+    writer = _RunWriter(run_dir, worker_id, max_bytes, num_buckets)
+    for chunk in iter(tasks.get, None):
+        for doc_id, text in chunk:
+            writer.add(doc_id, tokenize(text))
+    writer.spill()
+    results.put((writer.runs, writer.doc_len))
+
+
+def _check_workers(procs):
+    """ Raises if a tokenize worker died (e.g. killed when out of memory), the queues would wait for it forever. """
+    for proc in procs:
+        if proc.exitcode not in (None, 0):
+            raise RuntimeError(f"a tokenize worker exited with code {proc.exitcode}")
+
+
+def _put(tasks, item, procs):
+    while True:
+        try:
+            return tasks.put(item, timeout=WORKER_POLL_SECONDS)
+        except queue.Full:
+            _check_workers(procs)
+
+
+def _get(results, procs):
+    while True:
+        try:
+            return results.get(timeout=WORKER_POLL_SECONDS)
+        except queue.Empty:
+            _check_workers(procs)
+
+
+def _read_section(path, offset, nbytes):
+    """ Streams the postings of a spilled section, yields (term, doc_ids, tfs) one block at a time. """
+    with open(path, 'rb', buffering=RUN_READ_BUFFER) as f:
+        f.seek(offset)
+        while f.tell() < offset + nbytes:
+            terms, counts, doc_ids, tfs = pickle.load(f)
+            start = 0
+            for w, count in zip(terms, counts.tolist()):
+                yield w, doc_ids[start:start + count], tfs[start:start + count]
+                start += count
+
+
+def _sum_duplicates(doc_ids, tfs):
+    """ Sums the tfs of the repeated doc ids of a posting list sorted by doc id. """
+    if len(doc_ids) < 2 or not np.any(doc_ids[1:] == doc_ids[:-1]):
+        return doc_ids, tfs
+    starts = np.flatnonzero(np.concatenate([[True], doc_ids[1:] != doc_ids[:-1]]))
+    return doc_ids[starts], np.add.reduceat(tfs, starts)
+
+
+def _merged_postings(sections):
+    """ k-way merges the sections of a bucket (iterables of (term, doc_ids, tfs) in term order,
+        like _read_section), yields (term, (doc_ids, tfs)) in term order.
+    """
+    merged = heapq.merge(*sections, key=lambda posting: posting[0])
+    for w, group in itertools.groupby(merged, key=lambda posting: posting[0]):
+        parts = list(group)
+        if len(parts) == 1:
+            yield w, _sum_duplicates(parts[0][1], parts[0][2])
+            continue
+        doc_ids = np.concatenate([part[1] for part in parts])
+        tfs = np.concatenate([part[2] for part in parts])
+        # every run is sorted by doc id, the runs of different workers interleave
+        order = np.argsort(doc_ids, kind='stable')
+        yield w, _sum_duplicates(doc_ids[order], tfs[order])
+
+
+# the document lengths of the index, loaded once by every merge worker (see _init_merge_worker)
+_merge_doc_len = None
+
+
+def _init_merge_worker(run_dir):
+    # the lengths are memory mapped, so the workers share one copy in the page cache
+    global _merge_doc_len
+    _merge_doc_len = DocColumn(np.load(Path(run_dir) / 'doc_ids.npy', mmap_mode='r'),
+                               np.load(Path(run_dir) / 'doc_lengths.npy', mmap_mode='r'))
+
+
+def _merge_bucket(args):
+    """ Merges and writes one bucket, streaming the runs, returns its df, term totals, locations,
+        sizes and the files with the bucket's part of the squared TF-IDF norms of the documents.
+        The block-max bounds use the document lengths loaded by _init_merge_worker.
+    """
+    bucket_id, section_locs, out_dir, run_dir, n_docs, compressed = args
+    df, term_total = {}, {}
+    norm_ids, norm_squares, norms_paths = [], [], []
+
+    def flush_norms():
+        # the squares are summed per document and saved, so they never hold more than NORM_FLUSH_POSTINGS
+        if norm_ids:
+            doc_ids, inverse = np.unique(np.concatenate(norm_ids), return_inverse=True)
+            norms_paths.append(str(Path(run_dir) / f'norms_{bucket_id}_{len(norms_paths)}.npz'))
+            np.savez(norms_paths[-1], doc_ids=doc_ids, squares=np.bincount(inverse, weights=np.concatenate(norm_squares)))
+            norm_ids.clear()
+            norm_squares.clear()
+
+    def postings():
+        n_buffered = 0
+        for w, (doc_ids, tfs) in _merged_postings([_read_section(*loc) for loc in section_locs]):
+            df[w] = len(doc_ids)
+            term_total[w] = int(tfs.sum())
+            norm_ids.append(doc_ids)
+            norm_squares.append(tfidf_weights(tfs, len(doc_ids), n_docs) ** 2)
+            n_buffered += len(doc_ids)
+            if n_buffered >= NORM_FLUSH_POSTINGS:
+                flush_norms()
+                n_buffered = 0
+            yield w, (doc_ids, tfs)
+    InvertedIndex.write_a_posting_list((bucket_id, postings()), out_dir, doc_len=_merge_doc_len, compressed=compressed)
+    flush_norms()
+    posting_locs = InvertedIndex._read_bucket_pickle(out_dir, bucket_id, 'posting_locs')
+    posting_nbytes = InvertedIndex._read_bucket_pickle(out_dir, bucket_id, 'posting_nbytes')
+    return bucket_id, df, term_total, dict(posting_locs), posting_nbytes, norms_paths
+
+
+def build_index(docs, out_dir, name, workers=None, memory_budget=MEMORY_BUDGET, num_buckets=NUM_BUCKETS,
+                compressed=False, chunk_size=CHUNK_SIZE):
+    """ Builds the index of `docs`, an iterable of (doc_id, text) pairs, into `out_dir`.
+        Returns the InvertedIndex, which is also saved as `out_dir`/`name`.pkl.
+        Parameters:
+        -----------
+            workers: number of processes (default: the number of cores).
+            memory_budget: bytes of postings buffered by all the workers together before
+                           they spill to disk.
+            compressed: write the long posting lists in the compressed format (see
+                        encode_posting_list and PACKED_MIN_POSTINGS).
+    """
+    workers = workers or os.cpu_count() or 1
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    run_dir = out_dir / f'_{name}_runs'
+    run_dir.mkdir(exist_ok=True)
+    procs = []
+    try:
+        # phase 1: tokenize and spill sorted runs
+        tasks = multiprocessing.Queue(maxsize=4 * workers)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_tokenize_worker,
+                                         args=(i, tasks, results, str(run_dir), memory_budget // workers, num_buckets))
+                 for i in range(workers)]
+        for proc in procs:
+            proc.start()
+        docs = iter(docs)
+        for chunk in iter(lambda: list(itertools.islice(docs, chunk_size)), []):
+            _put(tasks, chunk, procs)
+        for _ in procs:
+            _put(tasks, None, procs)
+        runs, doc_len = [], Counter()
+        for _ in procs:
+            worker_runs, worker_doc_len = _get(results, procs)
+            runs.extend(worker_runs)
+            doc_len.update(worker_doc_len)
+        doc_len = dict(doc_len)
+        for proc in procs:
+            proc.join()
+            if proc.exitcode != 0:
+                raise RuntimeError(f"a tokenize worker exited with code {proc.exitcode}")
+
+        # phase 2: merge every bucket of the runs
+        bucket_sections = defaultdict(list)
+        for path, sections in runs:
+            for bucket_id, (offset, nbytes) in sections.items():
+                bucket_sections[bucket_id].append((path, offset, nbytes))
+        jobs = [(bucket_id, locs, str(out_dir), str(run_dir), len(doc_len), compressed)
+                for bucket_id, locs in sorted(bucket_sections.items())]
+        doc_ids = np.sort(np.fromiter(doc_len.keys(), dtype=np.int64, count=len(doc_len)))
+        # the merge workers bound the block lengths (min_dl) with the document lengths, like the in-memory writer
+        np.save(run_dir / 'doc_ids.npy', doc_ids.astype(DOC_ID_DTYPE))
+        np.save(run_dir / 'doc_lengths.npy', np.fromiter((doc_len[doc_id] for doc_id in doc_ids.tolist()),
+                                                         dtype=np.int64, count=len(doc_ids)))
+        index = InvertedIndex()
+        index.posting_nbytes = {}
+        norms_paths = {}
+        # a dead merge worker breaks the pool (and fails the build) instead of being waited for forever
+        try:
+            with ProcessPoolExecutor(workers, initializer=_init_merge_worker, initargs=(str(run_dir),)) as pool:
+                for future in as_completed([pool.submit(_merge_bucket, job) for job in jobs]):
+                    bucket_id, df, term_total, posting_locs, posting_nbytes, norms_path = future.result()
+                    index.df.update(df)
+                    index.term_total.update(term_total)
+                    index.posting_locs.update(posting_locs)
+                    index.posting_nbytes.update(posting_nbytes)
+                    norms_paths[bucket_id] = norms_path
+        except BrokenProcessPool:
+            raise RuntimeError("a merge worker died before the merge was done") from None
+        # the TF-IDF norms of the documents are summed over the buckets, in bucket order
+        squares = np.zeros(len(doc_ids))
+        for bucket_id in sorted(norms_paths):
+            for path in norms_paths[bucket_id]:
+                with np.load(path) as part:
+                    squares[np.searchsorted(doc_ids, part['doc_ids'])] += part['squares']
+        index.set_doc_norms(doc_ids, np.sqrt(squares))
+    finally:
+        # the other workers of a failed build would wait for tasks forever
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    index.doc_len = doc_len
+    index.N = len(doc_len)
+    index.unique_terms = sum(doc_len.values())
+    index.write_index(str(out_dir), name)
+    return index
+
+
+def read_jsonl_docs(path, field='text', id_field='id'):
+    """ Yields (doc_id, text) pairs from a .jsonl file. """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line)
+                yield int(doc[id_field]), doc.get(field) or ""
+
+
+def read_parquet_docs(path, field='text', id_field='id'):
+    """ Yields (doc_id, text) pairs from a parquet file (like the wikipedia dump the Spark
+        pipeline read), one row group at a time. Needs pyarrow.
+    """
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(path)
+    for i in range(parquet.num_row_groups):
+        table = parquet.read_row_group(i, columns=[id_field, field])
+        for doc_id, text in zip(table.column(id_field).to_pylist(), table.column(field).to_pylist()):
+            yield int(doc_id), text or ""
+
+
+def read_jsonl_anchors(path, field='anchor_text', id_field='id'):
+    """ Yields a (target doc_id, anchor text) pair for every link of the documents of a .jsonl
+        file, whose `field` is a list of {"id": ..., "text": ...} (or [id, text]) links.
+    """
+    for _, links in read_jsonl_docs(path, field, id_field):
+        for link in links or ():
+            target, text = (link['id'], link['text']) if isinstance(link, dict) else link
+            yield int(target), text or ""
+
+
+def read_parquet_anchors(path, field='anchor_text', id_field='id'):
+    """ Like read_jsonl_anchors, for the anchor_text column (a list of (id, text) structs)
+        of a parquet file. Needs pyarrow.
+    """
+    for _, links in read_parquet_docs(path, field, id_field):
+        for link in links or ():
+            yield int(link['id']), link['text'] or ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an inverted index on the local disk.")
+    parser.add_argument('out_dir')
+    parser.add_argument('name')
+    parser.add_argument('inputs', nargs='+', help=".jsonl or .parquet files of documents")
+    parser.add_argument('--field', default=None, help="the field to index (text, title, ...), "
+                                                       "default text, or anchor_text with --anchor")
+    parser.add_argument('--anchor', action='store_true',
+                        help="index the text of the links of the documents under the documents they point to")
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--memory-mb', type=int, default=MEMORY_BUDGET // 2 ** 20)
+    parser.add_argument('--buckets', type=int, default=NUM_BUCKETS)
+    parser.add_argument('--compressed', action='store_true',
+                        help="write the long posting lists in the compressed format (fewer bytes, slower decode)")
+    args = parser.parse_args()
+    if args.anchor:
+        field = args.field or 'anchor_text'
+        readers = [read_parquet_anchors if path.endswith('.parquet') else read_jsonl_anchors for path in args.inputs]
+    else:
+        field = args.field or 'text'
+        readers = [read_parquet_docs if path.endswith('.parquet') else read_jsonl_docs for path in args.inputs]
+    docs = itertools.chain.from_iterable(reader(path, field, args.id_field)
+                                         for reader, path in zip(readers, args.inputs))
+    index = build_index(docs, args.out_dir, args.name, args.workers, args.memory_mb * 2 ** 20,
+                        args.buckets, compressed=args.compressed)
+    print(f"indexed {index.N:,} documents, {len(index.df):,} terms into {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
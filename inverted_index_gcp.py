@@ -1,15 +1,26 @@
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 import itertools
+import math
+import mmap
+import os
+import shutil
+import threading
 from pathlib import Path
 import pickle
+import numpy as np
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 from contextlib import closing
+from functools import lru_cache
 PROJECT_ID = 'uni-project-480107'
 # changed get bucket to this as an attempt to optimize the search engine speed.
 # instead of using "storage.Client(project=PROJECT_ID)" every time i look up a term posting list
 # i store the "storage.Client(project=PROJECT_ID)" result in global variable client and use its bucket immediately.
 client = None
 def get_bucket(bucket_name):
+    # a bucket like object (e.g. LocalBucket) can be passed instead of a bucket name
+    if not isinstance(bucket_name, str):
+        return bucket_name
     global client
     if client is None:
         # create the client only once to avoid overhead
@@ -21,6 +32,43 @@ def _open(path, mode, bucket=None):
         return open(path, mode)
     return bucket.blob(path).open(mode)
 
+@lru_cache(maxsize=65536)
+def _block_path(base_dir, f_name, bucket=None):
+    """ Returns the path of a posting file from its name as stored in posting_locs. """
+    if bucket:
+        if f_name.startswith(f"{base_dir}/"):
+            return f_name
+        return f"{base_dir}/{f_name}"
+    # local indices store either the file name or the path the writer used
+    if Path(f_name).is_absolute() or Path(f_name).parts[:len(Path(base_dir).parts)] == Path(base_dir).parts:
+        return f_name
+    return str(Path(base_dir) / f_name)
+
+
+class LocalBucket:
+    """ A bucket look-alike backed by a local directory. It can be passed instead of a
+        bucket name to test the bucket code paths (and benchmark them) offline.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.n_opens = 0
+
+    def blob(self, name):
+        return _LocalBlob(self, name)
+
+
+class _LocalBlob:
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self.name = name
+
+    def open(self, mode):
+        path = self._bucket.root / self.name
+        if 'w' in mode:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._bucket.n_opens += 1
+        return open(path, mode)
+
 # Let's start with a small block size of 30 bytes just to test things out.
 BLOCK_SIZE = 1999998
 
@@ -31,10 +79,17 @@ class MultiFileWriter:
         self._base_dir = str(base_dir)  # Store as string
         self._name = name
         self._bucket = None if bucket_name is None else get_bucket(bucket_name)
-        self._file_gen = (_open(str(self._base_dir / f'{name}_{i:03}.bin'),
-                                'wb', self._bucket)
-                          for i in itertools.count())
-        self._f = next(self._file_gen)
+        self._counter = itertools.count()
+        self._open_next()
+
+    def _open_next(self):
+        file_name = f'{self._name}_{next(self._counter):03}.bin'
+        path = _block_path(self._base_dir, file_name, self._bucket)
+        self._f = _open(path, 'wb', self._bucket)
+        # local files are saved in posting_locs by name only so the index directory can be moved,
+        # blobs are saved by their full name.
+        self._f_name = file_name if self._bucket is None else path
+
     def write(self, b):
         locs = []
         while len(b) > 0:
@@ -43,11 +98,10 @@ class MultiFileWriter:
             # if the current file is full, close and open a new one.
             if remaining == 0:
                 self._f.close()
-                self._f = next(self._file_gen)
+                self._open_next()
                 pos, remaining = 0, BLOCK_SIZE
             self._f.write(b[:remaining])
-            name = self._f.name if hasattr(self._f, 'name') else self._f._blob.name
-            locs.append((name, pos))
+            locs.append((self._f_name, pos))
             b = b[remaining:]
         return locs
 
@@ -65,13 +119,7 @@ class MultiFileReader:
     def read(self, locs, n_bytes):
         b = []
         for f_name, offset in locs:
-            if self._bucket:
-                if f_name.startswith(f"{self._base_dir}/"):
-                    full_path = f_name
-                else:
-                    full_path = f"{self._base_dir}/{f_name}"
-            else:
-                full_path = str(Path(self._base_dir) / f_name)
+            full_path = _block_path(self._base_dir, f_name, self._bucket)
             if full_path not in self._open_files:
                 self._open_files[full_path] = _open(full_path, 'rb', self._bucket)
             f = self._open_files[full_path]
@@ -89,9 +137,528 @@ class MultiFileReader:
         self.close()
         return False
 
+class _PooledFile:
+    """ An open posting file of a PostingReader. The lock makes seek + read atomic.
+        In mmap mode `f` is a memoryview of the mapped file instead of a file object.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.lock = threading.Lock()
+        # set once the file left the pool, it must not be opened again
+        self.closed = False
+
+    def close(self):
+        # a mapped file may still be referenced by memoryviews handed out to callers,
+        # so it is only dropped and gets unmapped once the last of them is gone.
+        if self.f is not None and not isinstance(self.f, memoryview):
+            self.f.close()
+        self.f = None
+        self.closed = True
+
+
+def _map_file(path):
+    """ Maps a local file read only and returns a memoryview of it. """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class LocalBlockCache:
+    """ An on-disk mirror of bucket posting files (blocks), e.g. on a local SSD.
+
+        A block is downloaded as a whole the first time it is read and is then read
+        locally (through mmap by PostingReader). When the cached blocks take more than
+        `max_bytes` the least recently used ones are deleted. Files that are deleted
+        while mapped stay readable until they are unmapped.
+
+        Parameters:
+        -----------
+            cache_dir: local directory of the mirror, blocks keep their bucket path under it.
+            max_bytes: size cap of the mirror.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._downloading = {}
+        self._files = OrderedDict()
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        # i pick up blocks left by a previous run, oldest first
+        if self.cache_dir.exists():
+            existing = [p for p in self.cache_dir.rglob('*') if p.is_file() and not p.name.endswith('.part')]
+            for p in sorted(existing, key=lambda p: p.stat().st_mtime):
+                size = p.stat().st_size
+                self._files[str(p.relative_to(self.cache_dir))] = size
+                self.total_bytes += size
+            self._evict()
+
+    def map_block(self, blob_path, bucket):
+        """ Returns a memoryview of the mapped local copy of `blob_path`, downloading it
+            from `bucket` if needed. The file is mapped before it can be evicted.
+        """
+        local = self.cache_dir / blob_path
+        while True:
+            with self._lock:
+                if blob_path in self._files:
+                    self._files.move_to_end(blob_path)
+                    self.hits += 1
+                    return _map_file(local)
+                event = self._downloading.get(blob_path)
+                if event is None:
+                    event = self._downloading[blob_path] = threading.Event()
+                    self.misses += 1
+                    break
+            # another thread is downloading this block, i wait for it and look again
+            event.wait()
+        try:
+            local.parent.mkdir(parents=True, exist_ok=True)
+            tmp = local.with_name(f'{local.name}.{threading.get_ident()}.part')
+            with _open(blob_path, 'rb', bucket) as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(tmp, local)
+            with self._lock:
+                view = _map_file(local)
+                self._files[blob_path] = len(view)
+                self.total_bytes += len(view)
+                self._evict(keep=blob_path)
+        finally:
+            with self._lock:
+                self._downloading.pop(blob_path).set()
+        return view
+
+    def _evict(self, keep=None):
+        """ Deletes least recently used blocks until the mirror fits in max_bytes (lock held). """
+        for blob_path in list(self._files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if blob_path == keep:
+                continue
+            self.total_bytes -= self._files.pop(blob_path)
+            self.evictions += 1
+            try:
+                os.remove(self.cache_dir / blob_path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'blocks': len(self._files), 'bytes': self.total_bytes}
+
+
+class PostingReader:
+    """ Long lived, thread safe binary reader of the posting files of one index.
+
+        Unlike MultiFileReader, which is created and closed for every posting list,
+        a PostingReader keeps up to `max_open_files` files (or blob readers) open in
+        an LRU pool and is meant to be shared by all the request threads. read_many
+        merges the byte ranges of several posting lists that live in the same file
+        into one ranged read.
+
+        Parameters:
+        -----------
+            base_dir: the directory (or bucket prefix) of the posting files.
+            bucket_name: bucket name, bucket like object (e.g. LocalBucket) or None for local files.
+            max_open_files: the number of files kept open at the same time.
+            max_gap: ranges of the same file that are at most this many bytes apart
+                     are read together (the gap is read and thrown away).
+            use_mmap: map local posting files into memory and return zero-copy memoryviews
+                      instead of bytes.
+            block_cache: a LocalBlockCache, bucket files are mirrored to it on first read and
+                         then mapped like local files (implies use_mmap).
+    """
+    def __init__(self, base_dir, bucket_name=None, max_open_files=64, max_gap=0, use_mmap=False, block_cache=None):
+        self._base_dir = str(base_dir)
+        self._bucket = None if bucket_name is None else get_bucket(bucket_name)
+        self._max_open_files = max_open_files
+        self._max_gap = max_gap
+        self._block_cache = block_cache
+        self._use_mmap = use_mmap or block_cache is not None
+        if self._use_mmap and self._bucket is not None and block_cache is None:
+            raise ValueError("bucket files can only be mapped through a block_cache")
+        self._pool = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def _acquire(self, path):
+        """ Returns the pooled file of `path`, evicting the least recently used ones. """
+        evicted = []
+        with self._lock:
+            pooled = self._pool.get(path)
+            if pooled is None:
+                pooled = self._pool[path] = _PooledFile(path)
+                while len(self._pool) > self._max_open_files:
+                    evicted.append(self._pool.popitem(last=False)[1])
+            else:
+                self._pool.move_to_end(path)
+        for old in evicted:
+            with old.lock:
+                old.close()
+        return pooled
+
+    def _open_pooled(self, path):
+        if not self._use_mmap:
+            return _open(path, 'rb', self._bucket)
+        if self._bucket is not None:
+            return self._block_cache.map_block(path, self._bucket)
+        return _map_file(path)
+
+    def _read_range(self, path, offset, n_bytes):
+        while True:
+            pooled = self._acquire(path)
+            with pooled.lock:
+                # another thread evicted the file between _acquire and here, a file opened now
+                # would never be closed, so i take it from the pool again
+                if pooled.closed:
+                    continue
+                opened = pooled.f is None
+                if opened:
+                    pooled.f = self._open_pooled(path)
+                if isinstance(pooled.f, memoryview):
+                    b = pooled.f[offset:offset + n_bytes]
+                else:
+                    pooled.f.seek(offset)
+                    b = pooled.f.read(n_bytes)
+                break
+        with self._lock:
+            self._stats['opens' if opened else 'opens_saved'] += 1
+            self._stats['reads'] += 1
+            self._stats['bytes_read'] += len(b)
+        return b
+
+    def read(self, locs, n_bytes):
+        """ Reads `n_bytes` starting at the first of `locs`, like MultiFileReader.read. """
+        return self.read_many([(locs, n_bytes)])[0]
+
+    def read_many(self, requests):
+        """ Reads several posting lists at once.
+            Parameters:
+            -----------
+                requests: list of (locs, n_bytes) pairs.
+            Returns:
+            -----------
+                list of bytes, one per request (in the same order). In mmap mode a posting
+                list that is stored in a single file is returned as a zero-copy memoryview.
+        """
+        # i split every request into the (file, offset, length) pieces it is made of
+        ranges = defaultdict(list)
+        pieces = []
+        for i, (locs, n_bytes) in enumerate(requests):
+            parts = []
+            for f_name, offset in locs:
+                n_read = min(n_bytes, BLOCK_SIZE - offset)
+                path = _block_path(self._base_dir, f_name, self._bucket)
+                ranges[path].append((offset, offset + n_read, i, len(parts)))
+                parts.append(None)
+                n_bytes -= n_read
+            pieces.append(parts)
+
+        n_ranges = n_reads = saved = gap = 0
+        for path, file_ranges in ranges.items():
+            file_ranges.sort()
+            n_ranges += len(file_ranges)
+            # then i merge overlapping (or close enough) ranges and read each merged range once
+            start, end, members = file_ranges[0][0], file_ranges[0][1], [file_ranges[0]]
+            for rng in file_ranges[1:] + [None]:
+                if rng is not None and rng[0] <= end + self._max_gap:
+                    end = max(end, rng[1])
+                    members.append(rng)
+                    continue
+                b = self._read_range(path, start, end - start)
+                n_reads += 1
+                requested = 0
+                for r_start, r_end, i, j in members:
+                    pieces[i][j] = b[r_start - start:r_end - start]
+                    requested += r_end - r_start
+                saved += max(requested - len(b), 0)
+                gap += max(len(b) - requested, 0)
+                if rng is not None:
+                    start, end, members = rng[0], rng[1], [rng]
+
+        with self._lock:
+            self._stats['ranges'] += n_ranges
+            self._stats['reads_saved'] += n_ranges - n_reads
+            self._stats['bytes_saved'] += saved
+            self._stats['bytes_gap'] += gap
+        return [parts[0] if len(parts) == 1 else b''.join(parts) for parts in pieces]
+
+    def stats(self):
+        """ Returns a dict of counters:
+                opens / opens_saved: files opened / reads served by an already open file.
+                ranges / reads / reads_saved: byte ranges asked for / ranged reads done / ranges merged away.
+                bytes_read: bytes actually read.
+                bytes_saved: bytes that were not read again because ranges overlapped.
+                bytes_gap: bytes read in between merged ranges (only when max_gap > 0).
+        """
+        stats = dict.fromkeys(('opens', 'opens_saved', 'ranges', 'reads', 'reads_saved',
+                               'bytes_read', 'bytes_saved', 'bytes_gap'), 0)
+        with self._lock:
+            stats.update(self._stats)
+        return stats
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = list(self._pool.values()), OrderedDict()
+        for pooled in pool:
+            with pooled.lock:
+                pooled.close()
+
+
+# guards the creation of the PostingReader of an index
+_readers_lock = threading.Lock()
+
 TUPLE_SIZE = 6       # We're going to pack the doc_id and tf values in this
                      # many bytes.
 TF_MASK = 2 ** 16 - 1 # Masking the 16 low bits of an intege
+# a numpy view of the same 6 bytes layout, the high 4 bytes are the doc_id and
+# the low 2 bytes are the tf, both big endian. reading a posting list through
+# this dtype decodes all of its postings in one step instead of a python loop.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+# compressed posting lists start with this magic and a version byte. a 6 bytes posting list
+# can only start with 0xff for a doc id of at least 0xff000000, far above any wikipedia id.
+POSTING_MAGIC = b'\xffPL'
+POSTING_VERSION = 1
+# magic, version and the number of postings (uint32 little endian)
+POSTING_HEADER_SIZE = 8
+# an exception costs a uint32 position and a uint64 high part (see _choose_width)
+EXCEPTION_SIZE = 12
+_WIDTH_LIMITS = [1 << (8 * w) for w in range(8)]
+# with compressed=True, the posting lists of fewer postings are still written in the 6 bytes format:
+# it decodes several times faster, and on short lists the extra decode time of the compressed format
+# is more than the time its saved bytes take to read (see benchmarks.py compressed)
+PACKED_MIN_POSTINGS = 10_000
+_WIDTH_DTYPES = {w: np.dtype(f'<u{w}') for w in (1, 2, 4, 8)}
+
+
+def _choose_width(values):
+    """ Returns the byte width (0 to 8) that makes a packed section the smallest. Every value
+        is stored in `width` bytes, and the few values that do not fit (exceptions, e.g. the
+        first doc id or a rare big gap) also store their position and the rest of their bits.
+    """
+    sizes = [len(values) * w + int(np.count_nonzero(values >= limit)) * EXCEPTION_SIZE
+             for w, limit in enumerate(_WIDTH_LIMITS)] + [len(values) * 8]
+    return int(np.argmin(sizes))
+
+
+def _pack(values, width):
+    """ Packs values in `width` bytes each (little endian) followed by the exceptions.
+        Returns the bytes and the number of exceptions.
+    """
+    values = values.astype('<u8')
+    low = values.view(np.uint8).reshape(len(values), 8)[:, :width]
+    exceptions = np.flatnonzero(values >= _WIDTH_LIMITS[width]) if width < 8 else np.empty(0, dtype=np.int64)
+    high = values[exceptions] >> np.uint64(8 * width) if width < 8 else np.empty(0, dtype='<u8')
+    return b''.join([low.tobytes(), exceptions.astype('<u4').tobytes(), high.astype('<u8').tobytes()]), len(exceptions)
+
+
+def _unpack(data, offset, n, width, n_exceptions):
+    """ Reads n values packed by _pack from `data` at `offset`. Returns them and the next offset. """
+    end = offset + n * width + n_exceptions * EXCEPTION_SIZE
+    if end > len(data):
+        raise ValueError("truncated compressed posting list")
+    if width in _WIDTH_DTYPES:
+        # the values are a plain little endian array
+        values = np.frombuffer(data, dtype=_WIDTH_DTYPES[width], count=n, offset=offset).astype(np.int64)
+    elif width == 0:
+        values = np.zeros(n, dtype=np.int64)
+    else:
+        # widths 3, 5, 6 and 7 are padded with zero bytes to the next array width
+        rows = np.frombuffer(data, dtype=np.uint8, count=n * width, offset=offset).reshape(n, width)
+        padded = np.zeros((n, 4 if width == 3 else 8), dtype=np.uint8)
+        padded[:, :width] = rows
+        values = padded.view(_WIDTH_DTYPES[padded.shape[1]]).ravel().astype(np.int64)
+    if n_exceptions:
+        offset += n * width
+        positions = np.frombuffer(data, dtype='<u4', count=n_exceptions, offset=offset)
+        high = np.frombuffer(data, dtype='<u8', count=n_exceptions, offset=offset + 4 * n_exceptions)
+        values[positions] |= high.astype(np.int64) << (8 * width)
+    return values, end
+
+
+# widths of the gaps and tfs, then their number of exceptions
+_SECTIONS_DTYPE = np.dtype([('gap_width', 'u1'), ('tf_width', 'u1'), ('gap_exceptions', '<u4'), ('tf_exceptions', '<u4')])
+
+
+def encode_posting_list(doc_ids, tfs):
+    """ Encodes a posting list in the compressed format: the header, the byte widths and
+        number of exceptions of the two sections, then the gaps between consecutive doc ids
+        (the first one is the doc id itself) and then the tfs, each section packed in the
+        width that makes it the smallest (see _choose_width). Postings are stored sorted by
+        doc id, and tfs are not capped.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    if len(doc_ids) > 1 and np.any(doc_ids[1:] < doc_ids[:-1]):
+        order = np.argsort(doc_ids, kind='stable')
+        doc_ids, tfs = doc_ids[order], tfs[order]
+    gaps = np.diff(doc_ids, prepend=0)
+    gap_width, tf_width = _choose_width(gaps), _choose_width(tfs)
+    packed_gaps, gap_exceptions = _pack(gaps, gap_width)
+    packed_tfs, tf_exceptions = _pack(tfs, tf_width)
+    sections = np.array([(gap_width, tf_width, gap_exceptions, tf_exceptions)], dtype=_SECTIONS_DTYPE)
+    header = POSTING_MAGIC + bytes([POSTING_VERSION]) + len(doc_ids).to_bytes(4, 'little')
+    return b''.join([header, sections.tobytes(), packed_gaps, packed_tfs])
+
+
+def is_compressed(b):
+    """ True if the posting list bytes `b` are in the compressed format. """
+    return len(b) >= POSTING_HEADER_SIZE and bytes(b[:3]) == POSTING_MAGIC
+
+
+def _decode_compressed(b):
+    if b[3] != POSTING_VERSION:
+        raise ValueError(f"unknown posting list version {b[3]}")
+    n = int.from_bytes(bytes(b[4:POSTING_HEADER_SIZE]), 'little')
+    gap_width, tf_width, gap_exceptions, tf_exceptions = np.frombuffer(
+        b, dtype=_SECTIONS_DTYPE, count=1, offset=POSTING_HEADER_SIZE)[0].tolist()
+    offset = POSTING_HEADER_SIZE + _SECTIONS_DTYPE.itemsize
+    gaps, offset = _unpack(b, offset, n, gap_width, gap_exceptions)
+    tfs, _ = _unpack(b, offset, n, tf_width, tf_exceptions)
+    return np.cumsum(gaps), tfs
+
+
+def decode_posting_list(b, n):
+    """ Decodes `n` postings from the raw bytes `b` into two numpy arrays. Both the 6 bytes
+        format and the compressed format (see encode_posting_list) are read.
+        Returns:
+        -----------
+            doc_ids: int64 array of document ids (in the order they were written)
+            tfs: int64 array of term frequencies
+    """
+    if is_compressed(b):
+        return _decode_compressed(b)
+    postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+    return postings['doc_id'].astype(np.int64), postings['tf'].astype(np.int64)
+
+
+def _posting_bytes(doc_ids, tfs, compressed=False):
+    """ Encodes a posting list in the 6 bytes per posting format, or with compressed=True in the
+        compressed format when it has at least PACKED_MIN_POSTINGS postings. """
+    if compressed and len(doc_ids) >= PACKED_MIN_POSTINGS:
+        return encode_posting_list(doc_ids, tfs)
+    postings = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+    postings['doc_id'] = doc_ids
+    postings['tf'] = tfs & TF_MASK
+    return postings.tobytes()
+
+
+def posting_arrays_to_list(doc_ids, tfs):
+    """ Converts decoded posting arrays back to a [(doc_id, tf), ...] list. """
+    return list(zip(doc_ids.tolist(), tfs.tolist()))
+
+
+# number of postings summarized by one block-max entry
+BLOCK_MAX_SIZE = 128
+# per block statistics that bound the score of any posting in the block. max_tf and min_dl
+# bound the BM25 score for any k1, b and idf. max_pr and max_pv are the static (PageRank and
+# page views) maxima of the files given at write time (NaN when none was), the query engine
+# bounds the static part with the scores it serves instead, which may come from other files.
+BLOCK_MAX_DTYPE = np.dtype([('first_doc', '<i8'), ('last_doc', '<i8'), ('max_tf', '<i8'),
+                            ('min_dl', '<i8'), ('max_pr', '<f8'), ('max_pv', '<f8')])
+
+
+def tfidf_weights(tfs, df, N):
+    """ The TF-IDF weights (tf * log10(N / df)) of the postings of a term. """
+    return np.asarray(tfs, dtype=np.float64) * np.log10(N / df) if df else np.zeros(len(tfs))
+
+
+# number of postings buffered by compute_doc_norms before they are added to the norms
+NORM_BUFFER_POSTINGS = 2 ** 24
+
+
+def sorted_doc_ids(doc_len):
+    """ Returns the sorted doc ids of a doc_len dict (or doc_table.DocColumn) as an array. """
+    if hasattr(doc_len, 'arrays'):
+        return np.asarray(doc_len.arrays()[0], dtype=np.int64)
+    return np.sort(np.fromiter(doc_len.keys(), dtype=np.int64, count=len(doc_len)))
+
+
+def _values_of(mapping, doc_ids, dtype=np.float64):
+    """ Returns the values of an array of doc ids in a dict (0 for the missing ones), with one
+        vectorized lookup when the mapping supports it (e.g. doc_table.DocColumn).
+    """
+    if hasattr(mapping, 'lookup'):
+        return np.asarray(mapping.lookup(doc_ids)).astype(dtype, copy=False)
+    ids = doc_ids.tolist()
+    return np.fromiter((mapping.get(doc_id, 0) for doc_id in ids), dtype=dtype, count=len(ids))
+
+
+def block_max_bounds(doc_ids, tfs, doc_len=None, pagerank=None, page_views=None, block_size=BLOCK_MAX_SIZE):
+    """ Computes the block-max entries (BLOCK_MAX_DTYPE) of a posting list sorted by doc id.
+        Parameters:
+        -----------
+            doc_ids, tfs: the posting list, as arrays or lists.
+            doc_len: optional dict (or doc_table.DocColumn) of doc_id -> length, without it min_dl is 0.
+            pagerank, page_views: optional dicts (or DocColumns) of doc_id -> static score.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    starts = np.arange(0, len(doc_ids), block_size)
+    bounds = np.zeros(len(starts), dtype=BLOCK_MAX_DTYPE)
+    if len(doc_ids) == 0:
+        return bounds
+    bounds['first_doc'] = doc_ids[starts]
+    bounds['last_doc'] = doc_ids[np.minimum(starts + block_size, len(doc_ids)) - 1]
+    bounds['max_tf'] = np.maximum.reduceat(tfs, starts)
+    if doc_len is not None:
+        lengths = _values_of(doc_len, doc_ids, np.int64)
+        bounds['min_dl'] = np.minimum.reduceat(lengths, starts)
+    for field, static in (('max_pr', pagerank), ('max_pv', page_views)):
+        if static is None:
+            bounds[field] = np.nan
+        else:
+            values = _values_of(static, doc_ids)
+            bounds[field] = np.maximum.reduceat(values, starts)
+    return bounds
+
+
+# write_a_posting_list(champion_size=r) saves a champion tier of the r postings with the highest
+# impact (see posting_impacts) of every term with at least CHAMPION_MIN_DF postings
+CHAMPION_MIN_DF = 100_000
+# BM25 parameters of the tf factor of the impact
+CHAMPION_K1 = 1.2
+CHAMPION_B = 0.75
+# weights of the BM25 tf factor, the PageRank and the page views in the impact, like the
+# default fusion of the query engine (0.75 * body, page_rank_tuner and page_views_tuner)
+CHAMPION_WEIGHTS = (0.75, 0.8, 1.4)
+
+
+def posting_impacts(doc_ids, tfs, doc_len=None, avgdl=None, idf=1.0, pagerank=None, page_views=None):
+    """ The impact of every posting of a term, an estimate of the part of the final score of a
+        document it can bring: the weighted BM25 score of the posting (CHAMPION_K1, CHAMPION_B)
+        plus the weighted PageRank and page views of the document. Without doc_len every
+        document has the average length, and a missing static score counts as 0.
+    """
+    tf_weight, pr_weight, pv_weight = CHAMPION_WEIGHTS
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.float64)
+    norm = np.ones(len(doc_ids))
+    if doc_len is not None and avgdl:
+        lengths = _values_of(doc_len, doc_ids)
+        norm = 1 - CHAMPION_B + CHAMPION_B * lengths / avgdl
+    impacts = tf_weight * idf * (tfs * (CHAMPION_K1 + 1)) / (tfs + CHAMPION_K1 * norm)
+    for weight, static in ((pr_weight, pagerank), (pv_weight, page_views)):
+        if static is not None:
+            impacts += weight * _values_of(static, doc_ids)
+    return impacts
+
+
+def champion_postings(doc_ids, tfs, size, impacts):
+    """ Returns the champion tier of a posting list: its `size` postings with the highest
+        impacts (ties to the smaller doc id), sorted by doc id like the full list.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    if len(doc_ids) <= size:
+        return doc_ids, tfs
+    best = np.sort(np.lexsort((doc_ids, -impacts))[:size])
+    return doc_ids[best], tfs[best]
+
 
 class InvertedIndex:
     def __init__(self, docs={}):
@@ -160,58 +727,312 @@ class InvertedIndex:
                 from the object's state dictionary.
             """
         state = self.__dict__.copy()
-        del state['_posting_list']
+        state.pop('_posting_list', None)
+        # open readers are not picklable (and are useless in another process)
+        state.pop('_readers', None)
         return state
 
+    def posting_reader(self, base_dir, bucket_name=None, **reader_options):
+        """ Returns the long lived PostingReader of the posting files in `base_dir`,
+            creating it on first use. It is shared by every thread that reads this index.
+            `reader_options` (e.g. use_mmap, block_cache) are passed to the PostingReader
+            and are only used when it is created.
+        """
+        key = (str(base_dir), bucket_name if isinstance(bucket_name, (str, type(None))) else id(bucket_name))
+        readers = self.__dict__.setdefault('_readers', {})
+        reader = readers.get(key)
+        if reader is None:
+            with _readers_lock:
+                reader = readers.get(key)
+                if reader is None:
+                    reader = readers[key] = PostingReader(base_dir, bucket_name, **reader_options)
+        return reader
+
+    def reader_stats(self):
+        """ Returns the PostingReader.stats() counters summed over the readers of this index. """
+        total = Counter()
+        for reader in list(self.__dict__.get('_readers', {}).values()):
+            total.update(reader.stats())
+        return dict(total)
+
     def posting_lists_iter(self, base_dir, bucket_name=None):
         """ A generator that reads one posting list from disk and yields
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
+        for w, (doc_ids, tfs) in self.posting_arrays_iter(base_dir, bucket_name):
+            yield w, posting_arrays_to_list(doc_ids, tfs)
+
+    def posting_arrays_iter(self, base_dir, bucket_name=None):
+        """ Same as posting_lists_iter but yields (word, (doc_ids, tfs)) where
+            doc_ids and tfs are numpy arrays.
+        """
         with closing(MultiFileReader(base_dir, bucket_name)) as reader:
             for w, locs in self.posting_locs.items():
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                    tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
+                b = reader.read(locs, self.posting_nbytes_of(w))
+                yield w, decode_posting_list(b, self.df[w])
 
     def read_a_posting_list(self, base_dir, w, bucket_name=None):
-        posting_list = []
+        """ Returns the posting list of `w` as a [(doc_id, tf), ...] list. """
         if not w in self.posting_locs:
-            return posting_list
-        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
-            locs = self.posting_locs[w]
-            b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-            for i in range(self.df[w]):
-                doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                posting_list.append((doc_id, tf))
-        return posting_list
+            return []
+        return posting_arrays_to_list(*self.read_a_posting_array(base_dir, w, bucket_name))
+
+    def read_a_posting_array(self, base_dir, w, bucket_name=None):
+        """ Returns the posting list of `w` as two numpy arrays (doc_ids, tfs).
+            Empty arrays are returned for a term that is not in the index.
+        """
+        return self.read_posting_arrays(base_dir, [w], bucket_name)[w]
+
+    def read_posting_arrays(self, base_dir, terms, bucket_name=None):
+        """ Reads the posting lists of several terms through the index's PostingReader,
+            merging the reads of terms that are stored in the same file.
+            Returns a dict mapping each term to its (doc_ids, tfs) numpy arrays.
+        """
+        terms = list(dict.fromkeys(terms))
+        found = [w for w in terms if w in self.posting_locs]
+        reader = self.posting_reader(base_dir, bucket_name)
+        buffers = reader.read_many([(self.posting_locs[w], self.posting_nbytes_of(w)) for w in found]) if found else []
+        res = {w: (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)) for w in terms}
+        for w, b in zip(found, buffers):
+            res[w] = decode_posting_list(b, self.df[w])
+        return res
+
+    def posting_nbytes_of(self, w):
+        """ Returns the number of bytes of the posting list of `w`. Compressed posting lists
+            are recorded in `posting_nbytes`, the others take 6 bytes per posting.
+        """
+        nbytes = self.__dict__.get('posting_nbytes', {}).get(w)
+        return self.df[w] * TUPLE_SIZE if nbytes is None else nbytes
+
+    def posting_file(self, w):
+        """ Returns the name of the file the posting list of `w` starts in (None if `w` is unknown). """
+        locs = self.posting_locs.get(w)
+        return locs[0][0] if locs else None
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None):
+    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None, doc_len=None, pagerank=None, page_views=None,
+                             compressed=False, champion_size=None, champion_min_df=CHAMPION_MIN_DF):
+        """ Writes the posting lists of one bucket and saves their locations in
+            `bucket_id`_posting_locs.pickle and their block-max bounds (see block_max_bounds)
+            in `bucket_id`_block_max.pickle. Posting lists must be sorted by doc id, and each
+            one is a [(doc_id, tf), ...] list or a (doc_ids, tfs) tuple of arrays.
+            doc_len, pagerank and page_views are optional dicts used to tighten the bounds.
+            The sizes of the posting lists are saved in `bucket_id`_posting_nbytes.pickle (load
+            them with load_posting_nbytes). Posting lists are written in the 6 bytes per posting
+            format, compressed=True writes the long ones in the compressed format (see
+            encode_posting_list and PACKED_MIN_POSTINGS).
+            With champion_size, the lists of at least champion_min_df postings are followed by
+            their champion tier (see champion_postings), whose (locations, size in bytes,
+            number of postings) are saved in `bucket_id`_champions.pickle (load them with
+            load_champions).
+        """
         posting_locs = defaultdict(list)
+        posting_nbytes = {}
+        block_max = {}
+        champions = {}
         bucket_id, list_w_pl = b_w_pl
+        if champion_size and doc_len is not None and len(doc_len):
+            lengths = np.asarray(doc_len.arrays()[1] if hasattr(doc_len, 'arrays') else list(doc_len.values()))
+            # a DocColumn has a row (of length 0) for documents without this field, e.g. no title
+            lengths = lengths[lengths > 0]
+            n_docs, avgdl = len(lengths), float(np.mean(lengths)) if len(lengths) else None
+        else:
+            n_docs, avgdl = None, None
 
         with closing(MultiFileWriter(base_dir, bucket_id, bucket_name)) as writer:
             for w, pl in list_w_pl:
+                if isinstance(pl, tuple):
+                    doc_ids, tfs = np.asarray(pl[0], dtype=np.int64), np.asarray(pl[1], dtype=np.int64)
+                else:
+                    doc_ids = np.fromiter((doc_id for doc_id, _ in pl), dtype=np.int64, count=len(pl))
+                    tfs = np.fromiter((tf for _, tf in pl), dtype=np.int64, count=len(pl))
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
+                b = _posting_bytes(doc_ids, tfs, compressed)
+                posting_nbytes[w] = len(b)
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
                 posting_locs[w].extend(locs)
-            if bucket_name:
-                path = f"{base_dir}/{bucket_id}_posting_locs.pickle"
-            else:
-                path = str(Path(base_dir) / f'{bucket_id}_posting_locs.pickle')
+                block_max[w] = block_max_bounds(doc_ids, tfs, doc_len, pagerank, page_views)
+                if champion_size and len(doc_ids) >= champion_min_df:
+                    # the bm25 idf of the term, when the writer knows the number of documents
+                    idf = math.log((n_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5)) + 1 if n_docs else 1.0
+                    impacts = posting_impacts(doc_ids, tfs, doc_len, avgdl, max(idf, 0.0), pagerank, page_views)
+                    tier_ids, tier_tfs = champion_postings(doc_ids, tfs, champion_size, impacts)
+                    b = _posting_bytes(tier_ids, tier_tfs, compressed)
+                    champions[w] = (writer.write(b), len(b), len(tier_ids))
             bucket = None if bucket_name is None else get_bucket(bucket_name)
-            with _open(path, 'wb', bucket) as f:
-                pickle.dump(posting_locs, f)
+            side_files = [('posting_locs', posting_locs), ('block_max', block_max), ('posting_nbytes', posting_nbytes)]
+            if champion_size:
+                side_files.append(('champions', champions))
+            for file_name, obj in side_files:
+                if bucket_name:
+                    path = f"{base_dir}/{bucket_id}_{file_name}.pickle"
+                else:
+                    path = str(Path(base_dir) / f'{bucket_id}_{file_name}.pickle')
+                with _open(path, 'wb', bucket) as f:
+                    pickle.dump(obj, f)
         return bucket_id
+
+    def _bucket_ids(self):
+        # the posting files of a bucket are named `bucket_id`_NNN.bin
+        return sorted({Path(locs[0][0]).name.rsplit('_', 1)[0] for locs in self.posting_locs.values() if locs})
+
+    @staticmethod
+    def _read_bucket_pickle(base_dir, bucket_id, file_name, bucket_name=None):
+        """ Reads the `bucket_id`_`file_name`.pickle written by write_a_posting_list. """
+        if bucket_name:
+            path = f"{base_dir}/{bucket_id}_{file_name}.pickle"
+        else:
+            path = str(Path(base_dir) / f'{bucket_id}_{file_name}.pickle')
+        bucket = None if bucket_name is None else get_bucket(bucket_name)
+        with _open(path, 'rb', bucket) as f:
+            return pickle.load(f)
+
+    def _load_bucket_pickles(self, base_dir, file_name, bucket_name=None):
+        """ Merges the `bucket_id`_`file_name`.pickle dicts of every bucket of this index. """
+        merged = {}
+        for bucket_id in self._bucket_ids():
+            merged.update(InvertedIndex._read_bucket_pickle(base_dir, bucket_id, file_name, bucket_name))
+        return merged
+
+    def load_block_max(self, base_dir, bucket_name=None):
+        """ Loads the block-max bounds saved by write_a_posting_list for every bucket of
+            this index into `self.block_max` (a dict of term -> BLOCK_MAX_DTYPE array).
+        """
+        self.block_max = self._load_bucket_pickles(base_dir, 'block_max', bucket_name)
+
+    def load_posting_nbytes(self, base_dir, bucket_name=None):
+        """ Loads the sizes of the compressed posting lists saved by write_a_posting_list
+            into `self.posting_nbytes`. Save them with the index with write_index.
+        """
+        self.posting_nbytes = self._load_bucket_pickles(base_dir, 'posting_nbytes', bucket_name)
+
+    def load_champions(self, base_dir, bucket_name=None):
+        """ Loads the champion tiers saved by write_a_posting_list into `self.champions`
+            (a dict of term -> (posting locations, size in bytes, number of postings)).
+        """
+        self.champions = self._load_bucket_pickles(base_dir, 'champions', bucket_name)
+
+    def read_champion_arrays(self, base_dir, terms, bucket_name=None):
+        """ Like read_posting_arrays for the champion tiers of the terms, terms without a tier
+            are left out of the returned dict.
+        """
+        tiers = self.__dict__.get('champions', {})
+        found = [w for w in dict.fromkeys(terms) if w in tiers]
+        if not found:
+            return {}
+        buffers = self.posting_reader(base_dir, bucket_name).read_many([tiers[w][:2] for w in found])
+        return {w: decode_posting_list(b, tiers[w][2]) for w, b in zip(found, buffers)}
+
+    def terms_by_bucket(self):
+        """ Returns a dict of bucket id -> the terms whose posting lists the bucket holds,
+            from the names of the posting files (`bucket_id`_NNN.bin).
+        """
+        buckets = defaultdict(list)
+        for w, locs in self.posting_locs.items():
+            if locs:
+                buckets[Path(locs[0][0]).name.rsplit('_', 1)[0]].append(w)
+        return buckets
+
+    def convert_postings(self, base_dir, out_dir, bucket_name=None, out_bucket_name=None,
+                         compressed=False, pagerank=None, page_views=None, champion_size=None,
+                         champion_min_df=CHAMPION_MIN_DF):
+        """ Rewrites the posting lists of this index from `base_dir` to `out_dir` in the
+            6 bytes format (or, with compressed=True, the long ones in the compressed format),
+            keeping the same buckets, and updates posting_locs, posting_nbytes and block_max in place.
+            With champion_size the champion tiers are written too and saved in `champions`.
+            Save the converted index with write_index afterwards.
+        """
+        buckets = self.terms_by_bucket()
+        doc_len = self.__dict__.get('doc_len') or None
+        side_files = ['posting_locs', 'block_max', 'posting_nbytes']
+        if champion_size:
+            side_files.append('champions')
+        converted = {file_name: {} for file_name in side_files}
+        for bucket_id, terms in sorted(buckets.items()):
+            list_w_pl = []
+            for w, (doc_ids, tfs) in self.read_posting_arrays(base_dir, terms, bucket_name).items():
+                # the compressed format and the block-max bounds need the postings sorted by doc id.
+                # the arrays are written as they are, without a list of (doc_id, tf) tuples
+                order = np.argsort(doc_ids, kind='stable')
+                list_w_pl.append((w, (doc_ids[order], tfs[order])))
+            InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), out_dir, out_bucket_name,
+                                               doc_len, pagerank, page_views, compressed, champion_size, champion_min_df)
+            for file_name in side_files:
+                converted[file_name].update(InvertedIndex._read_bucket_pickle(out_dir, bucket_id, file_name, out_bucket_name))
+        self.posting_locs = defaultdict(list, converted['posting_locs'])
+        self.posting_nbytes = converted['posting_nbytes']
+        self.block_max = converted['block_max']
+        if champion_size:
+            self.champions = converted['champions']
+        else:
+            self.__dict__.pop('champions', None)
+        self.__dict__.pop('_readers', None)
+
+    def attach_term_dictionary(self, terms):
+        """ Uses a TermDictionary (see term_dictionary.py) for posting_locs, df and
+            posting_nbytes instead of the dicts of the pickle, which can then be freed.
+        """
+        self.posting_locs = terms.posting_locs
+        self.df = self.document_frequencey_per_term = terms.df
+        self.posting_nbytes = terms.posting_nbytes
+
+    def write_slim(self, base_dir, name, bucket_name=None, drop=()):
+        """ Writes `name`_slim.pkl, a copy of the index pickle without the attributes in `drop`
+            (which another artifact, like the document table or the term dictionary, replaces).
+            An existing `name`_slim.pkl is used as the starting point, so the attributes it
+            already dropped stay dropped.
+        """
+        try:
+            slim = InvertedIndex.read_index(base_dir, f'{name}_slim', bucket_name)
+        except (FileNotFoundError, NotFound):
+            slim = InvertedIndex.__new__(InvertedIndex)
+            slim.__dict__.update(self.__getstate__())
+        for attribute in drop:
+            slim.__dict__.pop(attribute, None)
+            if attribute == 'df':
+                slim.__dict__.pop('document_frequencey_per_term', None)
+        slim._write_globals(base_dir, f'{name}_slim', bucket_name)
+
+    def compute_doc_norms(self, base_dir, bucket_name=None):
+        """ Computes the TF-IDF vector norm of every document, sqrt(sum over its terms of
+            (tf * log10(N / df)) ** 2), from the posting lists, and saves it in `self.doc_norm`
+            (a doc_table.DocColumn of float32, pickled with the index by write_index).
+        """
+        doc_ids = sorted_doc_ids(self.doc_len)
+        squares = np.zeros(len(doc_ids))
+        buffered_ids, buffered_weights = [], []
+
+        def flush():
+            # a bincount over all the documents per term would be far too slow, so terms are added in batches
+            if buffered_ids:
+                positions = np.searchsorted(doc_ids, np.concatenate(buffered_ids))
+                squares[:] += np.bincount(positions, weights=np.concatenate(buffered_weights), minlength=len(doc_ids))
+                buffered_ids.clear()
+                buffered_weights.clear()
+        n_buffered = 0
+        for w, (ids, tfs) in self.posting_arrays_iter(base_dir, bucket_name):
+            buffered_ids.append(ids)
+            buffered_weights.append(tfidf_weights(tfs, self.df[w], self.N) ** 2)
+            n_buffered += len(ids)
+            if n_buffered >= NORM_BUFFER_POSTINGS:
+                flush()
+                n_buffered = 0
+        flush()
+        self.set_doc_norms(doc_ids, np.sqrt(squares))
+
+    def set_doc_norms(self, doc_ids, norms):
+        """ Saves the norms of the (sorted) doc ids in `self.doc_norm`. """
+        from doc_table import DOC_ID_DTYPE, DocColumn
+        self.doc_norm = DocColumn(np.asarray(doc_ids).astype(DOC_ID_DTYPE), np.asarray(norms, dtype=np.float32))
+
+    def compute_block_max(self, base_dir, bucket_name=None, pagerank=None, page_views=None):
+        """ Computes `self.block_max` from the posting lists themselves, for indices that were
+            written before write_a_posting_list saved the bounds. Save the result with write_index.
+        """
+        self.block_max = {w: block_max_bounds(doc_ids, tfs, self.doc_len, pagerank, page_views)
+                          for w, (doc_ids, tfs) in self.posting_arrays_iter(base_dir, bucket_name)}
     @staticmethod
     def read_index(base_dir, name, bucket_name=None):
         if bucket_name:
@@ -223,7 +1044,14 @@ class InvertedIndex:
             index = pickle.load(f)
             # when we created the indices we named the df attribute "document_frequencey_per_term"
             # to make attributes easier to understand, we returned it back to df but needed to add this change to load it without issues.
-            index.df = index.document_frequencey_per_term
+            # indices written by write_index only have the new names, so the old ones are added for them.
+            if hasattr(index, 'document_frequencey_per_term'):
+                index.df = index.document_frequencey_per_term
+            elif hasattr(index, 'df'):
+                index.document_frequencey_per_term = index.df
             # more clear
-            index.unique_terms = index.total_corpus_terms
+            if hasattr(index, 'total_corpus_terms'):
+                index.unique_terms = index.total_corpus_terms
+            else:
+                index.total_corpus_terms = index.unique_terms
             return index
\ No newline at end of file
@@ -0,0 +1,275 @@
+""" Offline load test of the search server on a synthetic, Wikipedia-like corpus.
+
+    python load_test.py generate DATA_DIR [--docs 100000] [--vocab 50000]
+    python load_test.py run DATA_DIR [--endpoint /search] [--mix short] [--concurrency 8] [--queries 2000]
+
+`generate` writes a corpus laid out like the bucket: Zipf distributed body and title indices
+(written with InvertedIndex.write_a_posting_list, with block-max bounds and body norms), PageRank,
+page views, titles and a few query mixes (DATA_DIR/queries.json).
+
+`run` starts search_frontend.py against DATA_DIR (SEARCH_DATA_DIR, no storage.Client), waits for
+/ready, replays a query mix with `concurrency` clients and reports the latency percentiles, the
+QPS and the bytes the server read per query (from /proc/<pid>/io, Linux only). Pass --url to load
+test a server that is already running instead.
+"""
+import argparse
+import gzip
+import json
+import os
+from pathlib import Path
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+from inverted_index_gcp import InvertedIndex, LocalBucket
+from text_Modification import tokenize
+
+# the artifact names search_frontend.py reads from the bucket
+BODY_DIR, BODY_INDEX = "body_index", "body"
+TITLE_DIR, TITLE_INDEX = "title_index", "title"
+PAGE_VIEWS_PATH = "page_views_august_2021_log.pkl"
+PAGERANK_PATH = "pr/part-00000-dfa568ba-d8f3-4828-9ded-c144a863ddec-c000_log.csv.gz"
+TITLES_PATH = "docID_title_mapper.pkl"
+QUERIES_FILE = "queries.json"
+# zipf exponent of the term frequencies (natural text is close to 1)
+ZIPF_S = 1.07
+NUM_BUCKETS = 32
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'zu', 'pe', 'da', 'go', 'hi', 'jo', 'be',
+             'fa', 'cu', 'xe', 'yo', 'wa', 'qui', 'tra', 'sel', 'mon', 'dor', 'ven', 'gal', 'rim']
+
+
+def synthetic_vocabulary(n_words, rng):
+    """ Returns n_words made up words that tokenize() keeps as one distinct token each. """
+    words, stems = [], set()
+    while len(words) < n_words:
+        word = ''.join(rng.choice(SYLLABLES, size=rng.integers(2, 5)))
+        tokens = tokenize(word)
+        if len(tokens) == 1 and tokens[0] not in stems:
+            stems.add(tokens[0])
+            words.append(word)
+    return words
+
+
+def zipf_probabilities(n, s=ZIPF_S):
+    p = 1.0 / np.arange(1, n + 1) ** s
+    return p / p.sum()
+
+
+def _postings(doc_ids, doc_index, term_ids):
+    """ Turns (document, term) token pairs into the sorted (term, doc_ids, tfs) posting lists
+        and the length of every document. """
+    n_docs = len(doc_ids)
+    keys, tfs = np.unique(term_ids.astype(np.int64) * n_docs + doc_index, return_counts=True)
+    terms, docs = keys // n_docs, keys % n_docs
+    bounds = np.flatnonzero(np.diff(terms)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(keys)]])
+    doc_len = np.bincount(doc_index, minlength=n_docs)
+    return [(int(terms[a]), doc_ids[docs[a:b]], tfs[a:b]) for a, b in zip(starts, ends)], doc_len
+
+
+def _write_index(bucket, index_dir, doc_ids, doc_index, term_ids, stems, pagerank, page_views):
+    posting_lists, doc_len = _postings(doc_ids, doc_index, term_ids)
+    index = InvertedIndex()
+    index.doc_len = dict(zip(doc_ids.tolist(), doc_len.tolist()))
+    index.N = len(doc_ids)
+    index.unique_terms = int(doc_len.sum())
+    buckets = [[] for _ in range(NUM_BUCKETS)]
+    for term_id, ids, tfs in posting_lists:
+        w = stems[term_id]
+        index.df[w] = len(ids)
+        index.term_total[w] = int(tfs.sum())
+        buckets[term_id % NUM_BUCKETS].append((w, (ids, tfs)))
+    for bucket_id, list_w_pl in enumerate(buckets):
+        InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), index_dir, bucket, index.doc_len, pagerank, page_views)
+        index.posting_locs.update(InvertedIndex._read_bucket_pickle(index_dir, bucket_id, 'posting_locs', bucket))
+    return index
+
+
+def generate_corpus(data_dir, n_docs=100_000, vocab_size=50_000, body_len=250, seed=0):
+    """ Writes a synthetic corpus into data_dir, laid out like the bucket search_frontend.py reads. """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    bucket = LocalBucket(data_dir)
+    words = synthetic_vocabulary(vocab_size, rng)
+    stems = [tokenize(word)[0] for word in words]
+    p = zipf_probabilities(vocab_size)
+    doc_ids = np.sort(rng.choice(70_000_000, size=n_docs, replace=False))
+    # pagerank and page views are heavy tailed, like the real ones (which are log scaled)
+    pagerank = dict(zip(doc_ids.tolist(), np.log1p(rng.pareto(1.5, n_docs)).tolist()))
+    page_views = dict(zip(doc_ids.tolist(), np.log1p(rng.pareto(1.2, n_docs) * 100).tolist()))
+
+    # body: every document gets a geometric number of zipf distributed tokens
+    lengths = rng.geometric(1 / body_len, size=n_docs)
+    doc_index = np.repeat(np.arange(n_docs), lengths)
+    body = _write_index(bucket, BODY_DIR, doc_ids, doc_index,
+                        rng.choice(vocab_size, size=len(doc_index), p=p), stems, pagerank, page_views)
+    # titles: 1 to 6 words, drawn from the same distribution without its head (titles rarely
+    # repeat the most common words)
+    title_lengths = rng.integers(1, 7, size=n_docs)
+    title_index = np.repeat(np.arange(n_docs), title_lengths)
+    title_terms = (rng.choice(vocab_size - 50, size=len(title_index), p=zipf_probabilities(vocab_size - 50)) + 50)
+    title = _write_index(bucket, TITLE_DIR, doc_ids, title_index, title_terms, stems, pagerank, page_views)
+    starts = np.concatenate([[0], np.cumsum(title_lengths)])
+    titles = {doc_id: ' '.join(words[t] for t in title_terms[starts[i]:starts[i + 1]]).title()
+              for i, doc_id in enumerate(doc_ids.tolist())}
+
+    # the body norms are used by /search_body
+    body.compute_doc_norms(BODY_DIR, bucket)
+    body.write_index(BODY_DIR, BODY_INDEX, bucket)
+    title.write_index(TITLE_DIR, TITLE_INDEX, bucket)
+    for path, obj in ((PAGE_VIEWS_PATH, page_views), (TITLES_PATH, titles)):
+        with bucket.blob(path).open('wb') as f:
+            pickle.dump(obj, f)
+    with bucket.blob(PAGERANK_PATH).open('wb') as f, gzip.open(f, 'wt') as gz:
+        gz.writelines(f"{doc_id},{rank}\n" for doc_id, rank in pagerank.items())
+    with open(data_dir / QUERIES_FILE, 'w') as f:
+        json.dump(query_mixes(words, rng), f)
+    return body, title
+
+
+def query_mixes(words, rng, n_queries=2000):
+    """ Returns a few query mixes (lists of query strings) over the vocabulary:
+            short - 1-2 words from the whole distribution, like most search queries.
+            long  - 3-5 words.
+            head  - 1-3 of the 100 most common words, the slowest (longest posting lists).
+            tail  - 1-3 rare words, mostly short posting lists.
+    """
+    n = len(words)
+    p = zipf_probabilities(n)
+    # queries are made of words people search for, so the most common 20 (stopword like) are skipped
+    p_query = np.concatenate([np.zeros(20), p[20:]])
+    p_query /= p_query.sum()
+
+    def mix(sizes, choose):
+        return [' '.join(words[t] for t in choose(size)) for size in sizes]
+    return {
+        'short': mix(rng.integers(1, 3, n_queries), lambda size: rng.choice(n, size, p=p_query)),
+        'long': mix(rng.integers(3, 6, n_queries), lambda size: rng.choice(n, size, p=p_query)),
+        'head': mix(rng.integers(1, 4, n_queries), lambda size: rng.choice(np.arange(20, 120), size)),
+        'tail': mix(rng.integers(1, 4, n_queries), lambda size: rng.choice(np.arange(n // 2, n), size)),
+    }
+
+
+def _read_bytes(pid):
+    """ Returns the bytes read by a process so far (rchar of /proc/<pid>/io), None if unavailable. """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def start_server(data_dir, port, timeout=300):
+    """ Starts search_frontend.py on data_dir and waits until /ready returns 200. """
+    env = dict(os.environ, SEARCH_DATA_DIR=str(Path(data_dir).resolve()))
+    root = Path(__file__).resolve().parent
+    proc = subprocess.Popen([sys.executable, str(root / 'search_frontend.py'), '--port', str(port)],
+                            cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"the server exited with code {proc.returncode}")
+        try:
+            with urllib.request.urlopen(f'{url}/ready', timeout=5) as response:
+                if response.status == 200:
+                    return proc, url
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.5)
+    proc.terminate()
+    raise TimeoutError(f"the server was not ready after {timeout}s")
+
+
+def replay(url, endpoint, queries, concurrency=8):
+    """ Sends every query to url + endpoint from `concurrency` threads.
+        Returns the latency (seconds) of every request, the wall time and the number of errors.
+    """
+    latencies = np.zeros(len(queries))
+    errors = []
+    next_query = iter(range(len(queries)))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(next_query, None)
+            if i is None:
+                return
+            t_start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(f'{url}{endpoint}?{urllib.parse.urlencode({"query": queries[i]})}',
+                                            timeout=60) as response:
+                    response.read()
+            except (urllib.error.URLError, OSError) as e:
+                errors.append(e)
+            latencies[i] = time.perf_counter() - t_start
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - t_start, len(errors)
+
+
+def report(endpoint, mix, latencies, wall, errors, bytes_read=None):
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    per_query = 'n/a' if bytes_read is None else f"{bytes_read / len(latencies) / 1024:,.1f}KB"
+    print(f"{endpoint} {mix:>6}: {len(latencies):,} queries  p50 {p50:7.2f}ms  p95 {p95:7.2f}ms  p99 {p99:7.2f}ms  "
+          f"{len(latencies) / wall:8.1f} QPS  read/query {per_query}  errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test on a synthetic corpus.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help="write a synthetic corpus")
+    generate.add_argument('data_dir')
+    generate.add_argument('--docs', type=int, default=100_000)
+    generate.add_argument('--vocab', type=int, default=50_000)
+    generate.add_argument('--body-len', type=int, default=250, help="mean number of tokens per body")
+    generate.add_argument('--seed', type=int, default=0)
+    run = commands.add_parser('run', help="replay query mixes against the server")
+    run.add_argument('data_dir')
+    run.add_argument('--endpoint', default='/search')
+    run.add_argument('--mix', nargs='+', default=['short', 'long', 'head', 'tail'])
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--queries', type=int, default=2000, help="queries replayed per mix")
+    run.add_argument('--port', type=int, default=8089)
+    run.add_argument('--url', help="load test this running server instead of starting one")
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        t_start = time.perf_counter()
+        body, title = generate_corpus(args.data_dir, args.docs, args.vocab, args.body_len, args.seed)
+        print(f"wrote {body.N:,} documents, {len(body.df):,} body terms and {len(title.df):,} title terms "
+              f"to {args.data_dir} in {time.perf_counter() - t_start:.1f}s")
+        return
+    with open(Path(args.data_dir) / QUERIES_FILE) as f:
+        mixes = json.load(f)
+    proc, url = (None, args.url) if args.url else start_server(args.data_dir, args.port)
+    try:
+        for mix in args.mix:
+            queries = mixes[mix][:args.queries]
+            before = None if proc is None else _read_bytes(proc.pid)
+            latencies, wall, errors = replay(url, args.endpoint, queries, args.concurrency)
+            after = None if proc is None else _read_bytes(proc.pid)
+            report(args.endpoint, mix, latencies, wall, errors, None if before is None or after is None else after - before)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
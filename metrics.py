@@ -0,0 +1,158 @@
+""" Counters, histograms and per-request stage timings, exported in the Prometheus text format.
+
+Every request gets a RequestProfile, the `stats` Counter the QueryEngine methods already take.
+Besides its counters (postings_scored, candidates, ...) it holds the time spent in every stage
+of the request, which the engine adds with timed() / add_time(). The frontend observes the profile
+of every request into the histograms of a Registry, which GET /metrics renders.
+"""
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the histogram buckets of counts (postings scored, candidates)
+COUNT_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+
+class RequestProfile(Counter):
+    """ The counters and the stage timings (seconds, in the order the stages ran) of one request. """
+    def __init__(self):
+        super().__init__()
+        self.stages = {}
+
+    def as_dict(self):
+        return {'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+                'counters': dict(self)}
+
+
+def add_time(stats, stage, seconds):
+    """ Adds seconds to a stage of stats when it is a RequestProfile (and does nothing otherwise). """
+    stages = getattr(stats, 'stages', None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stats, stage):
+    """ Times the body of the with statement as a stage of stats (see add_time). """
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stats, stage, time.perf_counter() - t_start)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterMetric:
+    """ A monotonic counter with labels. """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram(CounterMetric):
+    """ A histogram with fixed bucket upper bounds and labels. """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, then the sum of the observed values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        res = []
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                res.append((f'{self.name}_bucket', key + (_number(bound),), total))
+            res.append((f'{self.name}_sum', key, counts[-1]))
+            res.append((f'{self.name}_count', key, total))
+        return res
+
+
+class Registry:
+    """ The metrics of the server. Gauges are functions called when the metrics are rendered,
+        they return a list of (label values, value) or a single value.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._gauges = []
+
+    def counter(self, name, help, labels=()):
+        metric = CounterMetric(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, collect, labels=(), kind='gauge'):
+        """ Registers a value read at render time, kind='counter' for values that only grow
+            (like the bytes read by the posting readers, which keep their own totals). """
+        self._gauges.append((name, help, collect, tuple(labels), kind))
+
+    def render(self):
+        """ Returns every metric in the Prometheus text exposition format. """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            label_names = metric.label_names + (('le',) if metric.kind == 'histogram' else ())
+            for name, key, value in metric.samples():
+                names = label_names if name.endswith('_bucket') else metric.label_names
+                lines.append(f'{name}{_labels(names, key)} {_number(value)}')
+        for name, help, collect, label_names, kind in self._gauges:
+            try:
+                values = collect()
+            except Exception:
+                # a gauge of an artifact that is not loaded yet is skipped
+                continue
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in (values if label_names else [((), values)]):
+                lines.append(f'{name}{_labels(label_names, key)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
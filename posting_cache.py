@@ -0,0 +1,218 @@
+from collections import Counter, OrderedDict
+import json
+from pathlib import Path
+import threading
+import time
+from text_Modification import tokenize
+
+# rough python overhead of a cache entry (key, tuple, two array headers) on top of the array data
+ENTRY_OVERHEAD = 300
+
+
+class PostingCache:
+    """ In-process cache of decoded posting lists, keyed by (index name, term).
+
+        The cache is capped by the number of bytes of the cached numpy arrays rather
+        than by the number of entries, since posting lists range from a few bytes to
+        hundreds of megabytes. The least recently used lists are evicted first, and a
+        list that is bigger than the whole budget is never cached.
+
+        Parameters:
+        -----------
+            max_bytes: the byte budget of the cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(posting):
+        doc_ids, tfs = posting
+        return doc_ids.nbytes + tfs.nbytes + ENTRY_OVERHEAD
+
+    def get(self, index_name, term):
+        """ Returns the cached (doc_ids, tfs) of the term or None. """
+        key = (index_name, term)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, index_name, term, posting):
+        """ Caches the (doc_ids, tfs) arrays of the term, evicting old lists as needed. """
+        size = self._size(posting)
+        if size > self.max_bytes:
+            return
+        # the arrays are shared by all the requests from now on, so no one may change them
+        for arr in posting:
+            arr.flags.writeable = False
+        key = (index_name, term)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (posting, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        """ Checks if a (index name, term) pair is cached, without counting a hit or a miss. """
+        with self._lock:
+            return key in self._entries
+
+    def get_many(self, index_name, terms, load_many):
+        """ Returns a dict of term -> (doc_ids, tfs) for the given terms. The terms that are
+            not cached are loaded together with load_many(missing_terms), which must return
+            a dict of the same form, and are then cached.
+        """
+        res, missing = {}, []
+        for term in dict.fromkeys(terms):
+            posting = self.get(index_name, term)
+            if posting is None:
+                missing.append(term)
+            else:
+                res[term] = posting
+        if missing:
+            for term, posting in load_many(missing).items():
+                self.put(index_name, term, posting)
+                res[term] = posting
+        return res
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries), 'bytes': self.total_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+class ResultCache:
+    """ In-process cache of the final results of whole queries (e.g. the top 100 doc ids of
+        /search), keyed by the normalized query (see normalized_query).
+
+        The least recently used entries are evicted once there are max_entries, and an entry
+        older than ttl seconds is a miss. Every entry keeps the version of what its results
+        depend on (see QueryEngine.ranking_version), and an entry of another version than the
+        lookup's is a miss, so new indices or new tuning parameters never serve old results,
+        while the entries of the current version stay cached.
+
+        Parameters:
+        -----------
+            max_entries: the number of results kept.
+            ttl: seconds an entry stays valid.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """ Returns the cached results of key or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] != version:
+                # computed over other indices or tuning, the put after the miss replaces it. it is
+                # left in place, it may be the newer one (a request still running on an old engine)
+                self.invalidations += 1
+                entry = None
+            elif entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, results):
+        """ Caches the results of key, computed with `version`. """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (results, time.monotonic(), version)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'invalidations': self.invalidations,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'entries': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def normalized_query(tokens):
+    """ The result cache key of a query: its tokens sorted, so the reorderings of a query (which
+        score the same) share their results. Repeated tokens are kept, they count in the score.
+    """
+    return tuple(sorted(tokens))
+
+
+def load_query_log(path):
+    """ Reads the queries of a query log. Supported formats:
+            .json - a dict whose keys are queries (like queries_train.json) or a list of queries.
+            .jsonl - one query per line, either a json string or an object with a "query"
+                     (or "title") field. Objects with neither field are skipped.
+    """
+    path = Path(path)
+    if path.suffix == '.jsonl':
+        queries = []
+        with open(path, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    item = item.get('query', item.get('title'))
+                    if item is None:
+                        continue
+                queries.append(item)
+        return queries
+    with open(path, 'rt') as f:
+        queries = json.load(f)
+    return list(queries.keys()) if isinstance(queries, dict) else list(queries)
+
+
+def hot_terms(queries, n_terms):
+    """ Returns the `n_terms` terms that appear in most of the queries, most frequent first.
+        A term counts once per query, however many times the query repeats it.
+    """
+    counts = Counter()
+    for query in queries:
+        counts.update(set(tokenize(query)))
+    return [term for term, _ in counts.most_common(n_terms)]
+
+
+def prewarm(cache, index_name, index, base_dir, terms, bucket_name=None):
+    """ Loads the posting lists of `terms` from `index` into the cache (with coalesced reads).
+        Terms that are already cached are not read again. Returns the number of terms cached.
+    """
+    missing = [term for term in terms if term in index.df and (index_name, term) not in cache]
+    if missing:
+        for term, posting in index.read_posting_arrays(base_dir, missing, bucket_name).items():
+            cache.put(index_name, term, posting)
+    return sum(1 for term in terms if (index_name, term) in cache)
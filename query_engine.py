@@ -0,0 +1,615 @@
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
+import math
+import threading
+import time
+import numpy as np
+from BM25 import accumulate_scores
+from inverted_index_gcp import BLOCK_MAX_SIZE, block_max_bounds, tfidf_weights
+from metrics import add_time, timed
+
+# share of the body and title BM25 scores in the final score
+BODY_WEIGHT = 0.75
+TITLE_WEIGHT = 0.25
+# BM25 tuning of the body and title indices
+BODY_K1 = 0.7
+TITLE_B = 0.7
+# relative slack added to every upper bound so float rounding can never make a bound too small
+BOUND_SLACK = 1e-9
+# threads of the I/O pool shared by all the searches of an engine
+IO_WORKERS = 16
+# number of posting lists whose per block static score bounds an engine keeps (see _static_blocks)
+STATIC_BOUND_LISTS = 10_000
+
+
+def top_k(doc_ids, scores, k, with_scores=False):
+    """Returns the (python int) ids of the k best scored documents, best first.
+    Ties are broken by the smaller doc id. with_scores returns (doc_id, score) pairs instead."""
+    if len(doc_ids) > k:
+        # argpartition finds the k best in linear time, i only fully sort those
+        best = np.argpartition(-scores, k - 1)[:k]
+        # any document with the same score as the k-th one is also kept so the tie break is exact
+        best = np.flatnonzero(scores >= scores[best].min())
+        doc_ids, scores = doc_ids[best], scores[best]
+    order = np.lexsort((doc_ids, -scores))[:k]
+    if with_scores:
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+    return doc_ids[order].tolist()
+
+
+def lookup(mapping, doc_ids):
+    """Returns the values of an array of doc ids in a dict (0 for missing ones) or in a
+    dict like column that supports vectorized lookups (e.g. doc_table.DocColumn)."""
+    if hasattr(mapping, 'lookup'):
+        return mapping.lookup(doc_ids)
+    candidates = doc_ids.tolist()
+    return np.fromiter((mapping.get(doc_id, 0) for doc_id in candidates), dtype=np.float64, count=len(candidates))
+
+
+def rank_by_distinct_terms(doc_id_arrays):
+    """Ranks the documents of the posting lists of the distinct query terms by the number of
+    those terms they contain, most first and ties by the smaller doc id.
+    Returns the ranked doc ids and their counts."""
+    if len(doc_id_arrays) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # a doc id appears at most once per posting list, so its count is the number of terms it has
+    doc_ids, counts = np.unique(np.concatenate(doc_id_arrays), return_counts=True)
+    # the counts are small (at most the number of terms), so the documents are ordered with a
+    # counting sort: one linear pass per count, and the doc ids stay sorted within a count
+    by_count = [np.flatnonzero(counts == count) for count in range(len(doc_id_arrays), 0, -1)]
+    order = np.concatenate(by_count)
+    return doc_ids[order], counts[order]
+
+
+def group_by_file(index, terms):
+    """Groups the distinct terms by the posting file their posting list starts in"""
+    groups = defaultdict(list)
+    for term in dict.fromkeys(terms):
+        groups[index.posting_file(term)].append(term)
+    return list(groups.values())
+
+
+class QueryEngine:
+    """
+    Ranks documents for a tokenized query by fusing the BM25 scores of the body and title
+    indices with the PageRank and page views of every document:
+        final = 0.75 * body + 0.25 * title + page_rank_tuner * pagerank + page_views_tuner * views
+
+    Two methods give the same top k:
+        exhaustive - scores every posting of every query term.
+        bmw - block-max pruning. Uses the per block BM25 bounds saved by write_a_posting_list
+              (max tf, min doc length) and the maximum static score of every block (from
+              the served PageRank and page views) to visit the doc id ranges with the
+              highest bounds first, and only scores the documents whose bound (block BM25
+              bounds + their exact static score) can still reach the current top k. Stops
+              when no remaining range can reach it.
+
+    A third one trades quality for speed:
+        champions - the terms with a champion tier (see InvertedIndex.load_champions) are
+              scored on their tier only, the others on their full lists. The full lists
+              are only read when the tiers give fewer than k documents.
+
+    Parameters:
+    -----------
+    fetch_postings: function (index, terms, dir_name) -> dict of term -> (doc_ids, tfs) arrays.
+    fetch_champions: the same for the champion tiers of the terms, by default they are read with
+                     index.read_champion_arrays from the local disk.
+    executor: the long lived thread pool the posting lists are read on. By default the engine
+              creates one with io_workers threads. Reads of every request share it, so a load
+              spike queues reads up instead of starting more threads.
+    """
+    METHODS = ('exhaustive', 'bmw', 'champions')
+
+    def __init__(self, body_index, body_dir, title_index, title_dir, bm25_body, bm25_title,
+                 page_views, pagerank_scores, fetch_postings, page_views_tuner=1.4, page_rank_tuner=0.8,
+                 executor=None, io_workers=IO_WORKERS, fetch_champions=None):
+        self.body_index = body_index
+        self.body_dir = body_dir
+        self.title_index = title_index
+        self.title_dir = title_dir
+        self.bm25_body = bm25_body
+        self.bm25_title = bm25_title
+        self.page_views = page_views
+        self.pagerank_scores = pagerank_scores
+        self.fetch_postings = fetch_postings
+        self.fetch_champions = fetch_champions or (lambda index, terms, dir_name: index.read_champion_arrays(dir_name, terms))
+        self.page_views_tuner = page_views_tuner
+        self.page_rank_tuner = page_rank_tuner
+        self._static_bounds = OrderedDict()
+        self._static_lock = threading.Lock()
+        # a new engine (over new indices) never has the version of another one
+        self._instance = object()
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='fetch')
+
+    def _submit_fetches(self, tokens, names=('body', 'title'), tiered=None):
+        """Starts reading the posting lists of the tokens in the indices in names on the I/O pool.
+        tiered is an optional dict of index name -> the terms read from their champion tier instead.
+        Returns a dict of future -> index name ('body' or 'title')."""
+        # terms whose posting lists are in the same file are read by one task with a single read.
+        futures = {}
+        indices = {'body': (self.body_index, self.body_dir), 'title': (self.title_index, self.title_dir)}
+        for name in names:
+            index, dir_name = indices[name]
+            tier = (tiered or {}).get(name, ())
+            for fetch, terms in ((self.fetch_postings, [term for term in tokens if term not in tier]),
+                                 (self.fetch_champions, [term for term in tokens if term in tier])):
+                for group in group_by_file(index, terms):
+                    futures[self.executor.submit(fetch, index, group, dir_name)] = name
+        return futures
+
+    def fetch(self, tokens):
+        """Reads the body and title posting lists of the tokens in parallel.
+        Returns two dicts of term -> (doc_ids, tfs)."""
+        postings = {'body': {}, 'title': {}}
+        for future, name in self._submit_fetches(tokens).items():
+            postings[name].update(future.result())
+        return postings['body'], postings['title']
+
+    def ranking_version(self):
+        """The indices and tuning parameters the results depend on, as a value that changes
+        when any of them does. A cache of results is only valid while it stays the same."""
+        return (self._instance, self.page_views_tuner, self.page_rank_tuner,
+                self.bm25_body.k1, self.bm25_body.b, self.bm25_title.k1, self.bm25_title.b)
+
+    def close(self):
+        """Stops the I/O pool if the engine created it."""
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+    def static_scores(self, doc_ids):
+        """The PageRank and page views part of the final score of the documents."""
+        document_views = lookup(self.page_views, doc_ids)
+        document_page_rank = lookup(self.pagerank_scores, doc_ids)
+        return (self.page_rank_tuner * document_page_rank) + (self.page_views_tuner * document_views)
+
+    def final_scores(self, doc_ids, body, title, static_table=None):
+        """Fuses the BM25 scores of the documents with their PageRank and page views.
+        static_table is an optional (sorted doc ids, page views, page rank) table that
+        holds all the doc_ids, to look them up with a search instead of the dicts."""
+        if static_table is None:
+            document_views = lookup(self.page_views, doc_ids)
+            document_page_rank = lookup(self.pagerank_scores, doc_ids)
+        else:
+            table_ids, table_views, table_page_rank = static_table
+            positions = np.searchsorted(table_ids, doc_ids)
+            document_views, document_page_rank = table_views[positions], table_page_rank[positions]
+        fused_bm25 = (BODY_WEIGHT * body) + (TITLE_WEIGHT * title)
+        return fused_bm25 + (self.page_rank_tuner * document_page_rank) + (self.page_views_tuner * document_views)
+
+    def search(self, tokens, k=100, method='exhaustive', stats=None, df=None, with_scores=False, deadline=None):
+        """
+        Returns the ids of the k best documents for the query tokens, best first.
+
+        Parameters:
+        -----------
+        tokens: list of stemmed query tokens (repeated tokens count again, like in the query).
+        method: one of QueryEngine.METHODS.
+        stats: optional dict, 'postings_scored', 'candidates' and the posting bytes fetched from
+               every index ('body_bytes', 'title_bytes') are added to it. When it is a
+               metrics.RequestProfile the time of every stage is added to it too.
+        df: optional {'body': {term: df}, 'title': {term: df}} collection wide document frequencies
+            used for the idf instead of the indices' own (see sharding.py).
+        with_scores: return (doc_id, final score) pairs instead of doc ids.
+        deadline: optional time.perf_counter() value to answer by. The posting lists are read in
+                  descending idf order, and from the first term that is not read by the deadline,
+                  it and the lower idf terms are skipped: the best top k of the higher idf terms
+                  is returned, and 'deadline_hit' and 'terms_skipped' are added to stats (see _collect).
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"unknown search method {method!r}, expected one of {self.METHODS}")
+        if stats is None:
+            stats = Counter()
+        if len(tokens) == 0:
+            return []
+        df = df or {}
+        body_idf = self.bm25_body.calc_idf(tokens, df.get('body'))
+        title_idf = self.bm25_title.calc_idf(tokens, df.get('title'))
+        if method == 'champions':
+            return self._champion_search(tokens, k, body_idf, title_idf, stats, with_scores, deadline)
+        by_idf = tokens if deadline is None else self._by_idf(tokens, body_idf, title_idf)
+        futures = self._submit_fetches(by_idf)
+        postings = {'body': {}, 'title': {}}
+        scored = {}
+        scorers = {'body': (self.bm25_body, body_idf), 'title': (self.bm25_title, title_idf)}
+
+        # the posting lists are scored as soon as they arrive, while the others are still read.
+        # the scores are summed in token order afterwards, so the result does not depend on
+        # the order the reads finish in.
+        def score(name, lists):
+            with timed(stats, 'score'):
+                bm25, idf = scorers[name]
+                for term, (doc_ids, tfs) in lists.items():
+                    scored[name, term] = doc_ids, bm25.score_batch(doc_ids, tfs, idf.get(term, 0))
+                    stats['postings_scored'] += len(doc_ids)
+        skipped = self._collect(futures, by_idf, postings, stats, deadline, score if method == 'exhaustive' else None)
+        # the skipped terms that were read and scored anyway do not count
+        scored = {key: term_scores for key, term_scores in scored.items() if key[1] not in skipped}
+        if method == 'bmw':
+            with timed(stats, 'bmw'):
+                return self._block_max_search(tokens, k, postings['body'], postings['title'], body_idf, title_idf,
+                                              stats, with_scores)
+        return self._exhaustive_search(tokens, k, postings['body'], postings['title'], body_idf, title_idf,
+                                       stats, scored, with_scores=with_scores)
+
+    @staticmethod
+    def _by_idf(tokens, body_idf, title_idf):
+        """The distinct tokens in descending (fused) idf order. The rarest terms weigh the most,
+        so under a deadline they are read first and skipped last."""
+        return sorted(dict.fromkeys(tokens), key=lambda term: -(BODY_WEIGHT * body_idf.get(term, 0)
+                                                                 + TITLE_WEIGHT * title_idf.get(term, 0)))
+
+    def _collect(self, futures, tokens, postings, stats, deadline=None, on_result=None, tiered=None, wanted=None):
+        """Adds the posting lists read by futures (see _submit_fetches) to postings, a dict of index
+        name -> {term: (doc_ids, tfs)}, as the reads finish, and calls on_result(name, lists) for each.
+        With a deadline, tokens must be in descending idf order (see _by_idf). The reads that are not
+        done by then are dropped, and so are the tokens from the first one that was not read onwards,
+        even the ones that were: they get empty posting lists, so only the lowest idf terms are ever
+        skipped, whichever reads finished first. 'deadline_hit' and 'terms_skipped' are added to stats.
+        wanted is an optional dict of index name -> the tokens read from it, by default every token
+        is read from every index of futures.
+        Returns the set of skipped tokens, empty when the deadline was not hit."""
+        t_wait = time.perf_counter()
+        timeout = None
+        if deadline is not None:
+            # the first read of every index holds the highest idf term
+            first = {}
+            for future, name in futures.items():
+                first.setdefault(name, future)
+            _, not_done = wait(list(first.values()), timeout=max(deadline - time.perf_counter(), 0))
+            # when even those are late, only the reads that are already done are used
+            timeout = 0 if not_done else max(deadline - time.perf_counter(), 0)
+        try:
+            for future in as_completed(futures, timeout):
+                add_time(stats, 'fetch', time.perf_counter() - t_wait)
+                name = futures[future]
+                postings[name].update(future.result())
+                self._count_bytes(stats, name, future.result(), (tiered or {}).get(name, ()))
+                if on_result is not None:
+                    on_result(name, future.result())
+                t_wait = time.perf_counter()
+        except TimeoutError:
+            add_time(stats, 'fetch', time.perf_counter() - t_wait)
+            # the reads that did not start yet are dropped, the running ones finish in the background
+            for future in futures:
+                future.cancel()
+            if wanted is None:
+                wanted = {name: tokens for name in set(futures.values())}
+            wanted = {name: set(terms) for name, terms in wanted.items()}
+            tokens = list(dict.fromkeys(tokens))
+            read = [all(term in postings[name] for name in wanted if term in wanted[name]) for term in tokens]
+            skipped = tokens[read.index(False):] if False in read else []
+            for name in wanted:
+                for term in skipped:
+                    if term in wanted[name]:
+                        postings[name][term] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+            stats['deadline_hit'] += 1
+            stats['terms_skipped'] += len(skipped)
+            return set(skipped)
+        return set()
+
+    def _count_bytes(self, stats, name, postings, tiered=()):
+        # the size of the posting lists (or champion tiers) on disk, whether they were read or came from a cache
+        index = self.body_index if name == 'body' else self.title_index
+        stats[f'{name}_bytes'] += sum(index.champions[term][1] if term in tiered else index.posting_nbytes_of(term)
+                                      for term in postings if term in index.df)
+
+    def _champion_search(self, tokens, k, body_idf, title_idf, stats, with_scores=False, deadline=None):
+        """Scores the terms that have a champion tier on their tier and the others on their full
+        posting list, like _exhaustive_search. When fewer than k documents are found that way,
+        the full lists of the tiered terms are read and the query is scored exhaustively.
+        Both reads stop at the deadline like in search(), and a query that ran out of time is
+        not read again in full."""
+        tiered = {name: {term for term in tokens if term in getattr(index, 'champions', {})}
+                  for name, index in (('body', self.body_index), ('title', self.title_index))}
+        postings = {'body': {}, 'title': {}}
+        by_idf = tokens if deadline is None else self._by_idf(tokens, body_idf, title_idf)
+        late = self._collect(self._submit_fetches(by_idf, tiered=tiered), by_idf, postings, stats, deadline,
+                             tiered=tiered)
+        res = self._exhaustive_search(tokens, k, postings['body'], postings['title'], body_idf, title_idf,
+                                      stats, with_scores=with_scores)
+        if len(res) >= k or not any(tiered.values()) or late:
+            return res
+        stats['champion_fallbacks'] += 1
+        fallback = {'body': {}, 'title': {}}
+        futures = {}
+        for name, terms in tiered.items():
+            futures.update(self._submit_fetches([term for term in by_idf if term in terms], names=(name,)))
+        self._collect(futures, [term for term in by_idf if term in tiered['body'] | tiered['title']],
+                      fallback, stats, deadline, wanted=tiered)
+        for name in postings:
+            # a full list that was not read by the deadline leaves the champion tier in its place
+            postings[name].update({term: lists for term, lists in fallback[name].items() if len(lists[0])
+                                   or term not in postings[name]})
+        return self._exhaustive_search(tokens, k, postings['body'], postings['title'], body_idf, title_idf,
+                                       stats, with_scores=with_scores)
+
+    def search_body(self, tokens, k=100, stats=None):
+        """
+        Returns the ids of the k documents whose body is the most similar to the query tokens,
+        best first, by the cosine similarity of their TF-IDF vectors (tf * log10(N / df)).
+
+        The norms of the documents are precomputed (body_index.doc_norm, see
+        InvertedIndex.compute_doc_norms), so the scoring is term at a time: every posting
+        list is weighted in one vectorized call as soon as it is read, and the dot products
+        are summed per document in token order.
+        """
+        if stats is None:
+            stats = Counter()
+        query_tf = Counter(tokens)
+        if not query_tf:
+            return []
+        index = self.body_index
+        futures = self._submit_fetches(list(query_tf), names=('body',))
+        query_weights = {term: tfidf_weights([tf], index.df.get(term, 0), index.N)[0] for term, tf in query_tf.items()}
+        weighted = {}
+        t_wait = time.perf_counter()
+        for future in as_completed(futures):
+            add_time(stats, 'fetch', time.perf_counter() - t_wait)
+            self._count_bytes(stats, 'body', future.result())
+            with timed(stats, 'score'):
+                for term, (doc_ids, tfs) in future.result().items():
+                    if query_weights[term] > 0:
+                        weighted[term] = doc_ids, tfidf_weights(tfs, index.df[term], index.N) * query_weights[term]
+                        stats['postings_scored'] += len(doc_ids)
+            t_wait = time.perf_counter()
+        terms = [term for term in query_tf if term in weighted]
+        with timed(stats, 'accumulate'):
+            doc_ids, dot = accumulate_scores([weighted[term][0] for term in terms], [weighted[term][1] for term in terms])
+        stats['candidates'] += len(doc_ids)
+        if len(doc_ids) == 0:
+            return []
+        with timed(stats, 'normalize'):
+            norms = lookup(index.doc_norm, doc_ids) * math.sqrt(sum(w ** 2 for w in query_weights.values()))
+            # a document without a norm (missing from doc_norm) has no weight for any term
+            cosine = np.divide(dot, norms, out=np.zeros(len(dot)), where=norms > 0)
+        with timed(stats, 'topk'):
+            return top_k(doc_ids, cosine, k)
+
+    def search_distinct(self, tokens, index, dir_name, stats=None):
+        """
+        Returns ALL the documents of `index` that contain a query token, ranked by the number of
+        distinct query tokens they contain (see rank_by_distinct_terms), as doc ids and counts.
+        Used by /search_title (with the title index) and /search_anchor (with the anchor index).
+        """
+        if stats is None:
+            stats = Counter()
+        terms = list(dict.fromkeys(tokens))
+        postings = {}
+        with timed(stats, 'fetch'):
+            for future in [self.executor.submit(self.fetch_postings, index, group, dir_name)
+                           for group in group_by_file(index, terms)]:
+                postings.update(future.result())
+        with timed(stats, 'rank'):
+            doc_ids, counts = rank_by_distinct_terms([postings[term][0] for term in terms if term in postings])
+        stats['postings_scored'] += sum(len(doc_ids) for doc_ids, _ in postings.values())
+        stats['candidates'] += len(doc_ids)
+        return doc_ids, counts
+
+    def search_batch(self, queries, k=100, method='exhaustive', stats=None, deadline=None):
+        """
+        Returns the top k doc ids of every query of a batch, in the order of the queries.
+        The distinct terms of the whole batch are fetched once and, with the exhaustive
+        method, every posting list is scored once and shared by the queries that use it.
+        The results are the same as calling search() on every query.
+        The champions method, which reads different lists per query, calls search() on every query.
+
+        Parameters:
+        -----------
+        queries: list of token lists.
+        deadline: optional time.perf_counter() value to answer the whole batch by, like in search():
+                  the terms of the batch that are not read by then are skipped in every query.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"unknown search method {method!r}, expected one of {self.METHODS}")
+        if stats is None:
+            stats = Counter()
+        if method == 'champions':
+            return [self.search(tokens, k, method, stats, deadline=deadline) for tokens in queries]
+        terms = list(dict.fromkeys(term for tokens in queries for term in tokens))
+        if not terms:
+            return [[] for _ in queries]
+        body_idf = self.bm25_body.calc_idf(terms)
+        title_idf = self.bm25_title.calc_idf(terms)
+        postings = {'body': {}, 'title': {}}
+        by_idf = terms if deadline is None else self._by_idf(terms, body_idf, title_idf)
+        self._collect(self._submit_fetches(by_idf), by_idf, postings, stats, deadline)
+        body_postings, title_postings = postings['body'], postings['title']
+        scored = {}
+        static_table = None
+        if method == 'exhaustive':
+            # the PageRank and page views of every document of the batch are looked up once
+            all_docs = np.unique(np.concatenate([postings[term][0] for term in terms
+                                                 for postings in (body_postings, title_postings)]))
+            static_table = all_docs, lookup(self.page_views, all_docs), lookup(self.pagerank_scores, all_docs)
+        res = []
+        for tokens in queries:
+            if len(tokens) == 0:
+                res.append([])
+            elif method == 'bmw':
+                res.append(self._block_max_search(tokens, k, body_postings, title_postings, body_idf, title_idf, stats))
+            else:
+                res.append(self._exhaustive_search(tokens, k, body_postings, title_postings, body_idf, title_idf,
+                                                   stats, scored, static_table))
+        return res
+
+    def _exhaustive_search(self, tokens, k, body_postings, title_postings, body_idf, title_idf, stats,
+                           scored=None, static_table=None, with_scores=False):
+        # scored caches the BM25 scores of every (index, term) for the other queries of a batch
+        scored = {} if scored is None else scored
+        body_ids, body_scores = [], []
+        title_ids, title_scores = [], []
+        # every posting list is scored with the BM25 formula in one call
+        with timed(stats, 'score'):
+            for term in tokens:
+                for name, postings, bm25, idf, ids, scores in (
+                        ('body', body_postings, self.bm25_body, body_idf, body_ids, body_scores),
+                        ('title', title_postings, self.bm25_title, title_idf, title_ids, title_scores)):
+                    if (name, term) not in scored:
+                        doc_ids, tfs = postings[term]
+                        scored[name, term] = doc_ids, bm25.score_batch(doc_ids, tfs, idf.get(term, 0))
+                        stats['postings_scored'] += len(doc_ids)
+                    doc_ids, term_scores = scored[name, term]
+                    ids.append(doc_ids)
+                    scores.append(term_scores)
+        # i sum the term scores of every document
+        with timed(stats, 'accumulate'):
+            body_ids, body_scores = accumulate_scores(body_ids, body_scores)
+            title_ids, title_scores = accumulate_scores(title_ids, title_scores)
+
+            candidate_docs = np.union1d(body_ids, title_ids)
+            body = np.zeros(len(candidate_docs))
+            body[np.searchsorted(candidate_docs, body_ids)] = body_scores
+            title = np.zeros(len(candidate_docs))
+            title[np.searchsorted(candidate_docs, title_ids)] = title_scores
+        stats['candidates'] += len(candidate_docs)
+        with timed(stats, 'fuse'):
+            final = self.final_scores(candidate_docs, body, title, static_table)
+        with timed(stats, 'topk'):
+            return top_k(candidate_docs, final, k, with_scores)
+
+    def _static_blocks(self, index, term, doc_ids):
+        """The maximum static score of every block of a posting list, from the PageRank and page
+        views the engine serves (the max_pr and max_pv saved at write time may be of other files).
+        The STATIC_BOUND_LISTS most recently used lists are kept while the scores and tuners stay the same."""
+        key = (id(index), term)
+        # the entry holds the scores objects themselves, so their ids can not be reused by others
+        sources = (index, self.pagerank_scores, self.page_views)
+        tuners = (self.page_rank_tuner, self.page_views_tuner, len(doc_ids))
+        with self._static_lock:
+            entry = self._static_bounds.get(key)
+            if entry is not None and all(a is b for a, b in zip(entry[0], sources)) and entry[1] == tuners:
+                self._static_bounds.move_to_end(key)
+                return entry[2]
+        blocks = np.maximum.reduceat(self.static_scores(doc_ids), np.arange(0, len(doc_ids), BLOCK_MAX_SIZE))
+        with self._static_lock:
+            self._static_bounds[key] = sources, tuners, blocks
+            while len(self._static_bounds) > STATIC_BOUND_LISTS:
+                self._static_bounds.popitem(last=False)
+        return blocks
+
+    def _posting_lists(self, tokens, postings, index, bm25, idf, weight):
+        """Describes every distinct term of one index as a dict with its arrays and the
+        upper bound of its weighted score (and of the static score) in each block."""
+        lists = []
+        block_max = getattr(index, 'block_max', {})
+        for term, count in Counter(tokens).items():
+            doc_ids, tfs = postings[term]
+            if len(doc_ids) == 0:
+                continue
+            bounds = block_max.get(term)
+            if bounds is None or len(bounds) != -(-len(doc_ids) // BLOCK_MAX_SIZE):
+                # no (usable) saved bounds, tf is cheap to bound from the list itself
+                bounds = block_max_bounds(doc_ids, tfs)
+            norm = 1 - bm25.b + bm25.b * (bounds['min_dl'] / bm25.avgdl_)
+            max_tf = bounds['max_tf']
+            term_idf = max(idf.get(term, 0), 0)
+            ub = count * weight * term_idf * ((max_tf * (bm25.k1 + 1)) / (max_tf + bm25.k1 * norm))
+            static = self._static_blocks(index, term, doc_ids)
+            lists.append({'term': term, 'doc_ids': doc_ids, 'tfs': tfs, 'bm25': bm25, 'idf': idf.get(term, 0),
+                          'first': bounds['first_doc'], 'last': bounds['last_doc'], 'ub': ub, 'static': static})
+        return lists
+
+    def _exact_scores(self, candidates, tokens, body_lists, title_lists, stats):
+        """Scores the candidate documents exactly, adding the terms in query order like the
+        exhaustive search does so both give the very same floats."""
+        fields = []
+        for lists in (body_lists, title_lists):
+            contributions = {}
+            for l in lists:
+                pos = np.searchsorted(l['doc_ids'], candidates).clip(0, len(l['doc_ids']) - 1)
+                found = l['doc_ids'][pos] == candidates
+                contribution = np.zeros(len(candidates))
+                contribution[found] = l['bm25'].score_batch(candidates[found], l['tfs'][pos[found]], l['idf'])
+                contributions[l['term']] = contribution
+                stats['postings_scored'] += int(found.sum())
+            total = np.zeros(len(candidates))
+            for term in tokens:
+                if term in contributions:
+                    total = total + contributions[term]
+            fields.append(total)
+        return self.final_scores(candidates, fields[0], fields[1])
+
+    def _block_max_search(self, tokens, k, body_postings, title_postings, body_idf, title_idf, stats,
+                          with_scores=False):
+        body_lists = self._posting_lists(tokens, body_postings, self.body_index, self.bm25_body, body_idf, BODY_WEIGHT)
+        title_lists = self._posting_lists(tokens, title_postings, self.title_index, self.bm25_title, title_idf, TITLE_WEIGHT)
+        lists = body_lists + title_lists
+        if len(lists) == 0:
+            return []
+
+        # i cut the doc id space into intervals at every block boundary of every list. inside an
+        # interval each list is covered by at most one of its blocks. a document there is in some
+        # of these blocks (not necessarily all of them), so its score is at most the sum of the
+        # BM25 bounds of the blocks it is in plus the smallest of their static bounds.
+        points = np.unique(np.concatenate([l['first'] for l in lists] + [l['last'] + 1 for l in lists]))
+        starts = points[:-1]
+        ub = np.zeros((len(lists), len(starts)))
+        static = np.full((len(lists), len(starts)), -np.inf)
+        for i, l in enumerate(lists):
+            block = np.searchsorted(l['first'], starts, side='right') - 1
+            clipped = block.clip(0)
+            covered = (block >= 0) & (starts <= l['last'][clipped])
+            l['cover'] = np.where(covered, block, -1)
+            ub[i] = np.where(covered, l['ub'][clipped], 0.0)
+            static[i] = np.where(covered, l['static'][clipped], -np.inf)
+        # the best case over every subset of the covering blocks: when the smallest static bound
+        # is the j-th largest one, the document can be in the j blocks with the largest static bounds.
+        by_static = np.argsort(-static, axis=0, kind='stable')
+        static = np.take_along_axis(static, by_static, axis=0)
+        ub = np.cumsum(np.take_along_axis(ub, by_static, axis=0), axis=0)
+        with np.errstate(invalid='ignore'):
+            interval_ub = (ub + static).max(axis=0)
+        # intervals that no block covers hold no candidates
+        finite = np.isfinite(interval_ub)
+        interval_ub[finite] += np.abs(interval_ub[finite]) * BOUND_SLACK
+        order = np.argsort(-interval_ub, kind='stable')
+        order = order[finite[order]]
+
+        scored_ids, scored_scores = [], []
+        threshold = -np.inf
+        pos, chunk = 0, 16
+        while pos < len(order):
+            # every document of the remaining intervals scores below the current k-th best
+            if interval_ub[order[pos]] < threshold:
+                break
+            chunk_intervals = order[pos:pos + chunk]
+            chunk_intervals = chunk_intervals[interval_ub[chunk_intervals] >= threshold]
+            pos += len(chunk_intervals)
+            chunk *= 2
+            in_chunk = np.zeros(len(starts), dtype=bool)
+            in_chunk[chunk_intervals] = True
+            # the documents of these intervals, with the BM25 bound of the blocks they are really in
+            doc_ids, doc_ubs = [], []
+            for l in lists:
+                blocks = np.unique(l['cover'][chunk_intervals])
+                blocks = blocks[blocks >= 0]
+                if len(blocks) == 0:
+                    continue
+                idx = (blocks[:, None] * BLOCK_MAX_SIZE + np.arange(BLOCK_MAX_SIZE)).ravel()
+                idx = idx[idx < len(l['doc_ids'])]
+                idx = idx[in_chunk[np.searchsorted(points, l['doc_ids'][idx], side='right') - 1]]
+                doc_ids.append(l['doc_ids'][idx])
+                doc_ubs.append(l['ub'][idx // BLOCK_MAX_SIZE])
+            if not doc_ids:
+                continue
+            candidates, candidate_ub = accumulate_scores(doc_ids, doc_ubs)
+            # the static part of a document is known exactly, so i add it instead of its bound
+            candidate_ub = candidate_ub + self.static_scores(candidates)
+            candidate_ub += np.abs(candidate_ub) * BOUND_SLACK
+            by_ub = np.argsort(-candidate_ub, kind='stable')
+            for batch_start in range(0, len(by_ub), max(k, 256)):
+                batch = by_ub[batch_start:batch_start + max(k, 256)]
+                batch = batch[candidate_ub[batch] >= threshold]
+                if len(batch) == 0:
+                    break
+                batch_ids = candidates[batch]
+                scored_ids.append(batch_ids)
+                scored_scores.append(self._exact_scores(batch_ids, tokens, body_lists, title_lists, stats))
+                stats['candidates'] += len(batch_ids)
+                all_scores = np.concatenate(scored_scores)
+                if len(all_scores) >= k:
+                    threshold = np.partition(all_scores, len(all_scores) - k)[len(all_scores) - k]
+        if not scored_ids:
+            return []
+        return top_k(np.concatenate(scored_ids), np.concatenate(scored_scores), k, with_scores)
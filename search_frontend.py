@@ -1,12 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+import json
+import numpy as np
 import pickle
-from text_Modification import all_stopwords,RE_WORD,ps
-from collections import defaultdict
+from text_Modification import analyze, stem
 from BM25 import BM25
 from google.cloud import storage
-import gzip
-from inverted_index_gcp import InvertedIndex
+from google.api_core.exceptions import NotFound
+from inverted_index_gcp import InvertedIndex, LocalBlockCache, LocalBucket
+from posting_cache import PostingCache, ResultCache, load_query_log, hot_terms, normalized_query, prewarm
+from query_engine import BODY_K1, TITLE_B, QueryEngine
+from doc_table import DocColumn, DocTable, read_pagerank_csv
+from startup import ArtifactLoader
+from segments import SegmentSet
+from metrics import COUNT_BUCKETS, Registry, RequestProfile, add_time, timed
+from term_dictionary import TermDictionary
+import argparse
 from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import os
+from pathlib import Path
+import threading
+import time
 class MyFlaskApp(Flask):
     def run(self, host=None, port=None, debug=None, **options):
         super(MyFlaskApp, self).run(host=host, port=port, debug=debug, **options)
@@ -16,39 +30,322 @@ TITLE_DIR = "title_index"
 TITLE_INDEX = "title"
 BODY_INDEX = "body"
 BODY_DIR = "body_index"
-# i connect to my GCP account
-client = storage.Client()
-bucket = client.bucket(BUCKET_NAME)
-# i load the body, title, page views and page rank data from my bucket
-body_index = InvertedIndex.read_index(BODY_DIR, BODY_INDEX, BUCKET_NAME)
-title_index = InvertedIndex.read_index(TITLE_DIR, TITLE_INDEX, BUCKET_NAME)
-blob_pv = bucket.blob("page_views_august_2021_log.pkl")
-with blob_pv.open("rb") as f:
-    page_views = pickle.load(f)
-pagerank_scores = defaultdict(float)
-pr_path = "pr/part-00000-dfa568ba-d8f3-4828-9ded-c144a863ddec-c000_log.csv.gz"
-blob_pr = bucket.blob(pr_path)
-with blob_pr.open("rb") as f:
-    with gzip.open(f, "rt") as gz:
-        for line in gz:
+# the anchor text index built by index_builder.py --anchor, loaded by the first /search_anchor query
+ANCHOR_DIR = "anchor_index"
+ANCHOR_INDEX = "anchor"
+# optional mirror of the posting files of the bucket on the local disk (ideally an SSD).
+# a block is downloaded the first time it is read, and from then on it is read locally through mmap.
+# None reads the posting lists from the bucket every time.
+BLOCK_CACHE_DIR = None
+BLOCK_CACHE_SIZE = 20 * 2 ** 30
+# byte budget of the in-memory cache of decoded posting lists (shared by the body and title indices)
+POSTING_CACHE_SIZE = 2 * 2 ** 30
+# the posting lists of the most common terms of this query log are loaded into the cache at startup
+PREWARM_QUERY_LOG = "queries_train.json"
+PREWARM_TERMS = 1000
+# local directory of the document table built by doc_table.py. when set, the doc lengths, page views,
+# page rank and titles are memory mapped from it instead of loaded into dicts.
+DOC_TABLE_DIR = None
+# local directory with the term dictionaries (TERM_DICT_DIR/body and TERM_DICT_DIR/title) built
+# by term_dictionary.py. when set, the posting locations, df and posting list sizes are memory
+# mapped from them instead of loaded into dicts.
+TERM_DICT_DIR = None
+# load the "<name>_slim" index pickles written by doc_table.py --slim and term_dictionary.py --slim,
+# which skip the dicts that the document table and the term dictionaries replace
+SLIM_INDICES = False
+# when the SEARCH_DATA_DIR environment variable is set, everything is read from that local directory,
+# laid out like the bucket, instead of from GCS (load_test.py generates one)
+LOCAL_DATA_DIR = os.environ.get('SEARCH_DATA_DIR')
+if LOCAL_DATA_DIR is None:
+    # i connect to my GCP account
+    client = storage.Client()
+    bucket = client.bucket(BUCKET_NAME)
+else:
+    # the index code takes a bucket like object wherever it takes a bucket name
+    BUCKET_NAME = bucket = LocalBucket(LOCAL_DATA_DIR)
+# when the SEARCH_SEGMENTS_DIR environment variable is set, the body and title indices are the
+# segments of that index root (see segments.py) instead of BODY_DIR and TITLE_DIR: new and edited
+# documents are searchable as soon as `segments.py add` publishes them, without a rebuild.
+SEGMENTS_DIR = os.environ.get('SEARCH_SEGMENTS_DIR')
+# i check the manifest of the segments this often and swap a new generation in
+SEGMENTS_POLL_SECONDS = 10
+# the largest number of queries accepted by /search_batch
+MAX_BATCH_QUERIES = 1000
+# /search_title and /search_anchor stream their results as json in chunks of this many documents
+STREAM_CHUNK = 10000
+# threads of the I/O pool that reads posting lists, shared by all the requests
+IO_WORKERS = 16
+# at most this many searches run at the same time, the others wait for a slot for up to
+# QUEUE_TIMEOUT seconds and then get a 503, so a load spike queues up instead of piling up threads
+MAX_IN_FLIGHT = 8
+QUEUE_TIMEOUT = 10
+# threads of the production WSGI server
+SERVER_THREADS = 32
+# default time budget of a /search request in milliseconds, counted from its arrival (queue included).
+# the lowest idf terms whose posting lists are not read by then are skipped, see
+# QueryEngine.search(deadline=...). a request can ask for a budget with budget_ms=..., or for none
+# with budget_ms=0 (or none). None waits for every posting list, so the results are always exact
+# unless the operator (--budget-ms) or the request asks for a budget.
+SEARCH_BUDGET_MS = None
+# number of artifacts loaded at the same time at startup
+STARTUP_WORKERS = 8
+# /search keeps the top 100 of this many recent queries for RESULT_CACHE_TTL seconds (0 turns it off),
+# head queries repeat a lot and a cached one skips the reads and the scoring
+RESULT_CACHE_SIZE = 10_000
+RESULT_CACHE_TTL = 600
+posting_cache = PostingCache(POSTING_CACHE_SIZE)
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+
+def load_index(base_dir, name):
+    index_suffix = "_slim" if SLIM_INDICES else ""
+    index = InvertedIndex.read_index(base_dir, name + index_suffix, BUCKET_NAME)
+    if TERM_DICT_DIR is not None:
+        index.attach_term_dictionary(TermDictionary(Path(TERM_DICT_DIR) / name))
+    # the sizes of compressed posting lists, indices converted with convert_postings.py have
+    # them in the pickle and 6 bytes per posting indices have none
+    elif not hasattr(index, 'posting_nbytes'):
+        try:
+            index.load_posting_nbytes(base_dir, BUCKET_NAME)
+        except (FileNotFoundError, NotFound):
+            index.posting_nbytes = {}
+    if BLOCK_CACHE_DIR is not None:
+        index.posting_reader(base_dir, BUCKET_NAME, block_cache=block_cache)
+    return index
+
+
+def load_pickle(path):
+    with bucket.blob(path).open("rb") as f:
+        return pickle.load(f)
+
+
+def load_pagerank():
+    pr_path = "pr/part-00000-dfa568ba-d8f3-4828-9ded-c144a863ddec-c000_log.csv.gz"
+    with bucket.blob(pr_path).open("rb") as f:
+        return read_pagerank_csv(f)
+
+
+def load_block_max(body_index, title_index):
+    # the block-max bounds used by the "bmw" search method, indices written before they were
+    # saved (or converted with compute_block_max) are searched with bounds computed on the fly
+    for index, index_dir in ((body_index, BODY_DIR), (title_index, TITLE_DIR)):
+        if not hasattr(index, 'block_max'):
             try:
-                doc_id, rank = line.strip().split(',')
-                pagerank_scores[int(doc_id)] = float(rank)
-            except ValueError:
+                index.load_block_max(index_dir, BUCKET_NAME)
+            except (FileNotFoundError, NotFound):
+                index.block_max = {}
+    return {BODY_DIR: body_index.block_max, TITLE_DIR: title_index.block_max}
+
+
+def load_champions(body_index, title_index):
+    # the champion tiers of the high df terms used by the "champions" search method, the
+    # indices converted with --champions have them in the pickle, the others have none
+    for index, index_dir in ((body_index, BODY_DIR), (title_index, TITLE_DIR)):
+        if not hasattr(index, 'champions'):
+            try:
+                index.load_champions(index_dir, BUCKET_NAME)
+            except (FileNotFoundError, NotFound):
+                index.champions = {}
+    return {BODY_DIR: len(body_index.champions), TITLE_DIR: len(title_index.champions)}
+
+
+def load_prewarm(body_index, title_index):
+    # i fill the posting list cache with the hottest terms of the query log
+    if PREWARM_QUERY_LOG and os.path.exists(PREWARM_QUERY_LOG):
+        prewarm_terms = hot_terms(load_query_log(PREWARM_QUERY_LOG), PREWARM_TERMS)
+        for index, index_dir in ((title_index, TITLE_DIR), (body_index, BODY_DIR)):
+            index_dir = getattr(index, 'dir_name', index_dir)
+            prewarm(posting_cache, index_dir, index, index_dir, prewarm_terms, BUCKET_NAME)
+    return posting_cache.stats()
+
+
+def as_column(values, keep_integers=False, dtype=np.float32):
+    # /get_pagerank and /get_pageview look up whole arrays of ids in sorted columns, the document
+    # table already has them and the dicts are converted once
+    if hasattr(values, 'take'):
+        return values
+    return DocColumn.from_dict(values, dtype=dtype, keep_integers=keep_integers)
+
+
+def load_engine(body_index, title_index, page_views, pagerank_scores, body_len, title_len):
+    # the segments know the lengths of their live documents
+    if body_len is not None and SEGMENTS_DIR is None:
+        body_index.doc_len = body_len
+        title_index.doc_len = title_len
+    # I initiate my BM25 objects for the body and title indices
+    bm25_body = BM25(doc_len=body_index.doc_len, df=body_index.document_frequencey_per_term, N=body_index.N, total_terms=body_index.unique_terms)
+    bm25_title = BM25(doc_len=title_index.doc_len, df=title_index.document_frequencey_per_term, N=title_index.N, total_terms=title_index.unique_terms)
+    # tuning parameters
+    bm25_body.k1 = BODY_K1
+    bm25_title.b = TITLE_B
+    # the query engine reads posting lists with read_postings (defined at the bottom of this file)
+    # and holds the tuning values for the page rank and page views. the posting lists of the
+    # segments are cached under a name of their generation (dir_name), so a new one starts afresh
+    return QueryEngine(body_index, getattr(body_index, 'dir_name', BODY_DIR), title_index, getattr(title_index, 'dir_name', TITLE_DIR),
+                       bm25_body, bm25_title, page_views, pagerank_scores,
+                       fetch_postings=lambda index, terms, dir_name: read_postings(index, terms, dir_name),
+                       page_views_tuner=1.4, page_rank_tuner=0.8, executor=fetch_pool,
+                       fetch_champions=lambda index, terms, dir_name: read_champions(index, terms, dir_name))
+
+
+# i load the body, title, page views and page rank data from my bucket. everything is loaded
+# concurrently in the background, so the server starts right away and /ready tells when it
+# can answer queries. the block-max bounds are only loaded by the first "bmw" query.
+block_cache = LocalBlockCache(BLOCK_CACHE_DIR, BLOCK_CACHE_SIZE) if BLOCK_CACHE_DIR is not None else None
+# the I/O pool the posting lists are read on, shared by the engines of all the segment generations
+fetch_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='fetch')
+loader = ArtifactLoader(STARTUP_WORKERS)
+if SEGMENTS_DIR is not None:
+    # the body and title indices search the live documents of every segment
+    loader.add('segments', lambda: SegmentSet(SEGMENTS_DIR))
+    loader.add('body_index', lambda segments: segments.body, deps=['segments'])
+    loader.add('title_index', lambda segments: segments.title, deps=['segments'])
+else:
+    loader.add('body_index', lambda: load_index(BODY_DIR, BODY_INDEX))
+    loader.add('title_index', lambda: load_index(TITLE_DIR, TITLE_INDEX))
+if DOC_TABLE_DIR is not None:
+    # the per document data comes from the memory mapped document table (see doc_table.py)
+    loader.add('doc_table', lambda: DocTable(DOC_TABLE_DIR))
+    loader.add('page_views', lambda table: table.column('page_views'), deps=['doc_table'])
+    loader.add('pagerank', lambda table: table.column('pagerank'), deps=['doc_table'])
+    loader.add('base_titles', lambda table: table.titles(), deps=['doc_table'])
+    loader.add('body_len', lambda table: table.column('body_len'), deps=['doc_table'])
+    loader.add('title_len', lambda table: table.column('title_len'), deps=['doc_table'])
+else:
+    loader.add('page_views', lambda: load_pickle("page_views_august_2021_log.pkl"))
+    loader.add('pagerank', load_pagerank)
+    # i load my doc id to title mapper for final results mapping
+    loader.add('base_titles', lambda: load_pickle("docID_title_mapper.pkl"))
+    # the doc lengths stay in the index pickles
+    loader.add('body_len', lambda: None)
+    loader.add('title_len', lambda: None)
+if SEGMENTS_DIR is not None:
+    # the titles of the documents added or edited in the segments come from the segments
+    loader.add('titles', lambda segments, titles: segments.titles(titles), deps=['segments', 'base_titles'])
+else:
+    loader.add('titles', lambda titles: titles, deps=['base_titles'])
+loader.add('engine', load_engine, deps=['body_index', 'title_index', 'page_views', 'pagerank', 'body_len', 'title_len'])
+loader.add('block_max', load_block_max, deps=['body_index', 'title_index'], lazy=True)
+loader.add('champions', load_champions, deps=['body_index', 'title_index'], lazy=True)
+# the PageRank is kept in float64, its json values are the exact scores and not float32 roundings
+loader.add('pagerank_column', lambda pagerank: as_column(pagerank, dtype=np.float64), deps=['pagerank'], lazy=True)
+loader.add('page_views_column', lambda page_views: as_column(page_views, keep_integers=True), deps=['page_views'], lazy=True)
+loader.add('anchor_index', lambda: load_index(ANCHOR_DIR, ANCHOR_INDEX), lazy=True)
+# a failed or slow prewarm only makes the first queries slower, so it does not hold back /ready
+loader.add('prewarm', load_prewarm, deps=['body_index', 'title_index'], required=False)
+loader.start()
+
+
+def watch_segments():
+    # i open every new generation of the segments (published by segments.py add and merge) and
+    # swap it in with a new engine. the requests that already got the old engine finish on it.
+    segments = loader.get('segments')
+    while True:
+        time.sleep(SEGMENTS_POLL_SECONDS)
+        try:
+            new_segments = segments.reopen()
+            if new_segments is segments:
                 continue
-# i load my doc id to title mapper for final results mapping
-blob_pv = bucket.blob("docID_title_mapper.pkl")
-with blob_pv.open("rb") as f:
-    doc_id_title = pickle.load(f)
-# I initiate my BM25 objects for the body and title indices
-bm25_body = BM25(doc_len=body_index.doc_len, df=body_index.document_frequencey_per_term, N=body_index.N, total_terms=body_index.unique_terms)
-bm25_title = BM25(doc_len=title_index.doc_len, df=title_index.document_frequencey_per_term, N=title_index.N, total_terms=title_index.unique_terms)
-# tuning parameters
-bm25_body.k1 = 0.7
-bm25_title.b = 0.7
+            engine = load_engine(new_segments.body, new_segments.title, loader.get('page_views'),
+                                 loader.get('pagerank'), None, None)
+            loader.replace({'segments': new_segments, 'body_index': new_segments.body, 'title_index': new_segments.title,
+                            'engine': engine, 'titles': new_segments.titles(loader.get('base_titles'))})
+            segments = new_segments
+            segment_swaps.inc(status='ok')
+        except Exception:
+            # a generation that fails to open is tried again at the next check, the old one keeps serving
+            app.logger.exception("failed to swap in a new generation of the segments, still serving generation %s",
+                                 segments.generation)
+            segment_swaps.inc(status='failed')
+
+
 app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+search_slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# i keep per stage timings and counters of every request, GET /metrics exports them for prometheus
+metrics = Registry()
+request_seconds = metrics.histogram('search_request_seconds', "Time to answer a request.", ['endpoint'])
+stage_seconds = metrics.histogram('search_stage_seconds', "Time spent in every stage of a request.", ['endpoint', 'stage'])
+postings_scored = metrics.histogram('search_postings_scored', "Postings scored per request.", ['endpoint'], COUNT_BUCKETS)
+candidates = metrics.histogram('search_candidates', "Candidate documents per request.", ['endpoint'], COUNT_BUCKETS)
+posting_bytes = metrics.counter('search_posting_bytes_total', "Bytes of the posting lists used by the requests (cached or read).", ['index'])
+requests_total = metrics.counter('search_requests_total', "Requests answered.", ['endpoint', 'status'])
+deadline_hits = metrics.counter('search_deadline_hits_total', "Requests that ran out of time budget and skipped terms.", ['endpoint'])
+metrics.gauge('search_bytes_read_total', "Bytes read from the posting files.",
+              lambda: [((name,), loader.get(f'{name}_index', timeout=0).reader_stats().get('bytes_read', 0))
+                       for name in ('body', 'title', 'anchor') if loader.loaded(f'{name}_index')], ['index'], kind='counter')
+metrics.gauge('search_posting_cache', "Posting list cache counters.",
+              lambda: [((key,), value) for key, value in posting_cache.stats().items()], ['stat'])
+metrics.gauge('search_result_cache', "Result cache counters.",
+              lambda: [((key,), value) for key, value in result_cache.stats().items()], ['stat'])
+metrics.gauge('search_analyzer_cache', "Counters of the query analyzer and stemmer memos.",
+              lambda: [((name, stat), getattr(memo.cache_info(), stat)) for name, memo in (('query', analyze), ('stem', stem))
+                       for stat in ('hits', 'misses', 'currsize')], ['memo', 'stat'])
+segment_swaps = metrics.counter('search_segment_swaps_total', "New generations of the segments swapped in.", ['status'])
+if SEGMENTS_DIR is not None:
+    metrics.gauge('search_segments', "Segments of the index and their live documents.",
+                  lambda: [((name,), value) for name, value in (
+                      ('segments', len(loader.get('segments', timeout=0).segments)),
+                      ('generation', loader.get('segments', timeout=0).generation),
+                      ('live_docs', loader.get('body_index', timeout=0).N))] if loader.loaded('segments') else [], ['stat'])
+    threading.Thread(target=watch_segments, name='segments', daemon=True).start()
+if block_cache is not None:
+    metrics.gauge('search_block_cache', "Local block cache counters.",
+                  lambda: [((key,), value) for key, value in block_cache.stats().items()], ['stat'])
+
+
+def instrumented(view):
+    ''' Gives the request a metrics.RequestProfile (g.profile) that the view and the query engine add
+        their stage timings and counters to, and observes it into the metrics when the view returns.
+        When the request has an X-Profile header (or profile=1) the stage breakdown is returned in an
+        X-Search-Profile json header. Streamed responses are measured until they start streaming. '''
+    endpoint = view.__name__
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        profile = g.profile = RequestProfile()
+        t_start = g.t_start = time.perf_counter()
+        response = app.make_response(view(*args, **kwargs))
+        elapsed = time.perf_counter() - t_start
+        request_seconds.observe(elapsed, endpoint=endpoint)
+        requests_total.inc(endpoint=endpoint, status=response.status_code)
+        for stage, seconds in profile.stages.items():
+            stage_seconds.observe(seconds, endpoint=endpoint, stage=stage)
+        if 'postings_scored' in profile:
+            postings_scored.observe(profile['postings_scored'], endpoint=endpoint)
+        if 'candidates' in profile:
+            candidates.observe(profile['candidates'], endpoint=endpoint)
+        if profile.get('deadline_hit'):
+            deadline_hits.inc(endpoint=endpoint)
+        for index in ('body', 'title'):
+            if f'{index}_bytes' in profile:
+                posting_bytes.inc(profile[f'{index}_bytes'], index=index)
+        if request.headers.get('X-Profile') or request.args.get('profile'):
+            response.headers['X-Search-Profile'] = json.dumps(dict(profile.as_dict(), total_ms=round(elapsed * 1000, 3)))
+        return response
+    return wrapper
+
+
+def admitted(view):
+    ''' Runs the view only once one of the MAX_IN_FLIGHT search slots is free, and returns
+        a 503 if none frees up within QUEUE_TIMEOUT seconds. '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        t_start = time.perf_counter()
+        acquired = search_slots.acquire(timeout=QUEUE_TIMEOUT)
+        add_time(g.get('profile'), 'queue', time.perf_counter() - t_start)
+        if not acquired:
+            return jsonify(error="the server is overloaded"), 503, {'Retry-After': '1'}
+        try:
+            return view(*args, **kwargs)
+        finally:
+            search_slots.release()
+    return wrapper
+
+
 @app.route("/search")
+@instrumented
+@admitted
 def search():
     ''' Returns up to a 100 of your best search results for the query. This is
         the place to put forward your best search engine, and you are free to
@@ -61,72 +358,141 @@ def search():
          http://YOUR_SERVER_DOMAIN/search?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Add "&engine=bmw" to the URL to rank with block-max pruning instead of
+        scoring every posting (same results, fewer postings scored), or
+        "&engine=champions" to score the high df terms on their champion tiers only
+        (faster, close to the same results).
+        Add "&budget_ms=300" to answer within about 300ms instead of SEARCH_BUDGET_MS (no
+        budget by default): the lowest idf terms that are not read by then are skipped.
+        "&budget_ms=0" (or "&budget_ms=none") waits for every posting list.
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each
-        element is a tuple (wiki_id, title).
+        element is a tuple (wiki_id, title). The X-Search-Degraded header is "true"
+        when terms were skipped to meet the time budget.
     '''
     res = []
     query = request.args.get('query', '')
     if len(query) == 0:
         return jsonify(res)
+    if not loader.ready():
+        return not_ready()
+    engine = loader.get('engine')
+    doc_id_title = loader.get('titles')
     # i transform the query into a list of tokens
-    tokens = [ps.stem(m.group()) for m in RE_WORD.finditer(query.lower()) if m.group() not in all_stopwords]
-
-    # then i calculate the query idf for the body and title indices
-    body_index_idf = bm25_body.calc_idf(tokens)
-    title_index_idf = bm25_title.calc_idf(tokens)
-
-    # i create 2 dicts which will store the term score for every token in the query in the body and title indices
-    body_index_scores = defaultdict(float)
-    title_index_scores = defaultdict(float)
-
-
-    # then i create a thread pool to allow multithreading
-    with ThreadPoolExecutor() as executor:
-        # body threads will work on the body index while title threads will work on the title index
-        body_threads = [executor.submit(read_posting, body_index, term, BODY_DIR) for term in tokens]
-        title_threads = [executor.submit(read_posting, title_index, term, TITLE_DIR) for term in tokens]
-
-        # every thread uses the BM25 formula to calculate the term score then stores it in the suitable dict
-        for thread in body_threads:
-            term, posting_list = thread.result()
-            term_idf = body_index_idf.get(term, 0)
-            for doc_id, tf in posting_list:
-                body_index_scores[doc_id] += bm25_body.score_term(tf, doc_id, term_idf)
-
-
-        for thread in title_threads:
-            term, posting_list = thread.result()
-            term_idf = title_index_idf.get(term, 0)
-            for doc_id, tf in posting_list:
-                title_index_scores[doc_id] += bm25_title.score_term(tf, doc_id, term_idf)
-
-
-    # i create a dict which will store the final score for each term
-    final_score = {}
-    candidate_docs = set(body_index_scores.keys()) | set(title_index_scores.keys())
-
-    # tuning values for the page rank and page views
-    page_views_tuner = 1.4
-    page_rank_tuner = 0.8
-
-    for doc_id in candidate_docs:
-        fused_bm25 = (0.75 * body_index_scores.get(doc_id, 0)) + (0.25 * title_index_scores.get(doc_id,0))
-        document_views = page_views.get(doc_id, 0)
-        document_page_rank = pagerank_scores.get(doc_id, 0)
-        # then i store the final score which is the result of this equation
-        final_score[doc_id] = fused_bm25 + (page_rank_tuner * document_page_rank) + (page_views_tuner * document_views)
-    # i sort the results and keep only top 100
-    res = sorted(final_score.items(), key=lambda item: item[1], reverse=True)[:100]
-    formatted_res = []
-    for doc_id, score in res:
-        # i map each document to it's title and return the final results
-        title = doc_id_title.get(doc_id, "")
-        formatted_res.append((doc_id, title))
-    return jsonify(formatted_res)
+    with timed(g.profile, 'tokenize'):
+        tokens = list(analyze(query))
+
+    # "engine=bmw" uses block-max pruning, it returns the same results as the default exhaustive scoring.
+    # "engine=champions" reads the champion tiers of the high df terms instead of their full lists
+    method = request.args.get('engine', 'exhaustive')
+    if method not in QueryEngine.METHODS:
+        return jsonify(error=f"unknown engine {method}"), 400
+    # i keep only top 100, the time budget started when the request arrived
+    try:
+        deadline = search_deadline(request.args.get('budget_ms', SEARCH_BUDGET_MS))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if method == 'bmw':
+        loader.get('block_max')
+    elif method == 'champions':
+        loader.get('champions')
+    # the same query (or a reordering of it) reuses its results until they expire or the engine's
+    # indices or tuning change. results that skipped terms to meet the budget are not kept.
+    # the normalized query is only the key, the query is scored with its tokens in their own order
+    key = (method, normalized_query(tokens))
+    version = engine.ranking_version()
+    doc_ids = result_cache.get(key, version)
+    if doc_ids is None:
+        doc_ids = engine.search(tokens, k=100, method=method, stats=g.profile, deadline=deadline)
+        if not g.profile.get('deadline_hit'):
+            result_cache.put(key, version, doc_ids)
+    else:
+        g.profile['result_cache_hits'] += 1
+    # i map each document to it's title and return the final results
+    with timed(g.profile, 'titles'):
+        res = with_titles(doc_ids, doc_id_title)
+    return jsonify(res), {'X-Search-Degraded': 'true' if g.profile.get('deadline_hit') else 'false'}
+
+@app.route("/search_batch", methods=['POST'])
+@instrumented
+@admitted
+def search_batch():
+    ''' Returns the top 100 results of every query of a batch, in the same order as the
+        queries. The posting lists of terms shared by several queries are read and scored
+        once, which makes it much faster than calling /search for every query.
+
+        Issue a POST request with a json list of queries, or an object with the queries,
+        the engine and the time budget of the whole batch (like /search's budget_ms):
+          requests.post('http://YOUR_SERVER_DOMAIN/search_batch', json=["hello world", "python"])
+          requests.post('http://YOUR_SERVER_DOMAIN/search_batch', json={"queries": [...], "engine": "bmw"})
+    Returns:
+    --------
+        list with a list of up to 100 (wiki_id, title) tuples per query. The X-Search-Degraded
+        header is "true" when terms were skipped to meet the time budget.
+    '''
+    body = request.get_json(silent=True)
+    queries, method, budget_ms = body, 'exhaustive', SEARCH_BUDGET_MS
+    if isinstance(body, dict):
+        queries, method = body.get('queries'), body.get('engine', 'exhaustive')
+        budget_ms = body.get('budget_ms', SEARCH_BUDGET_MS)
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return jsonify(error="expected a list of query strings"), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify(error=f"at most {MAX_BATCH_QUERIES} queries per batch"), 400
+    if method not in QueryEngine.METHODS:
+        return jsonify(error=f"unknown engine {method}"), 400
+    try:
+        deadline = search_deadline(budget_ms)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if len(queries) == 0:
+        return jsonify([])
+    if not loader.ready():
+        return not_ready()
+    res = search_queries(queries, method=method, stats=g.profile, deadline=deadline)
+    return jsonify(res), {'X-Search-Degraded': 'true' if g.profile.get('deadline_hit') else 'false'}
+
+@app.route("/ready")
+def ready():
+    ''' Returns 200 once the indices and the per document data are loaded and /search can
+        answer queries, and 503 until then. The body has the state, load time (seconds) and
+        approximate memory (bytes) of every startup artifact.
+    '''
+    return jsonify(loader.report()), (200 if loader.ready() else 503)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    ''' Returns the request, stage, posting and cache metrics in the Prometheus text format. '''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def search_deadline(budget_ms):
+    """The time.perf_counter() deadline of a request with a time budget of budget_ms milliseconds,
+    counted from its arrival. None, 0 and "none" mean no deadline."""
+    if budget_ms is None or str(budget_ms).lower() == 'none':
+        return None
+    try:
+        budget_ms = float(budget_ms)
+    except (TypeError, ValueError):
+        raise ValueError("budget_ms must be a number of milliseconds, or 0 for no budget") from None
+    if budget_ms == 0:
+        return None
+    if not budget_ms > 0:
+        raise ValueError("budget_ms must be positive, or 0 for no budget")
+    return g.t_start + budget_ms / 1000
+
+
+def not_ready():
+    failed = loader.failed()
+    error = f"failed to load {', '.join(failed)}" if failed else "the index is still loading"
+    return jsonify(error=error), 503, {'Retry-After': '5'}
+
 
 @app.route("/search_body")
+@instrumented
+@admitted
 def search_body():
     ''' Returns up to a 100 search results for the query using TFIDF AND COSINE
         SIMILARITY OF THE BODY OF ARTICLES ONLY. DO use stemming. DO USE the
@@ -146,12 +512,22 @@ def search_body():
     query = request.args.get('query', '')
     if len(query) == 0:
       return jsonify(res)
-    # BEGIN SOLUTION
-
-    # END SOLUTION
+    if not loader.ready():
+        return not_ready()
+    engine = loader.get('engine')
+    if not hasattr(engine.body_index, 'doc_norm'):
+        return jsonify(error="the body index has no document norms, add them with convert_postings.py --norms"), 503
+    # i rank the body by the cosine similarity of the tf-idf vectors, the document norms are precomputed
+    with timed(g.profile, 'tokenize'):
+        tokens = list(analyze(query))
+    doc_ids = engine.search_body(tokens, k=100, stats=g.profile)
+    with timed(g.profile, 'titles'):
+        res = with_titles(doc_ids, loader.get('titles'))
     return jsonify(res)
 
 @app.route("/search_title")
+@instrumented
+@admitted
 def search_title():
     ''' Returns ALL (not just top 100) search results that contain A QUERY WORD
         IN THE TITLE of articles, ordered in descending order of the NUMBER OF
@@ -176,13 +552,19 @@ def search_title():
     query = request.args.get('query', '')
     if len(query) == 0:
       return jsonify(res)
-    # BEGIN SOLUTION
-
-    # END SOLUTION
-    return jsonify(res)
+    if not loader.ready():
+        return not_ready()
+    engine = loader.get('engine')
+    # i count the distinct query words in every title that has one of them
+    with timed(g.profile, 'tokenize'):
+        tokens = list(analyze(query))
+    doc_ids, _ = engine.search_distinct(tokens, engine.title_index, engine.title_dir, stats=g.profile)
+    return stream_results(doc_ids, loader.get('titles'))
 
 
 @app.route("/search_anchor")
+@instrumented
+@admitted
 def search_anchor():
     ''' Returns ALL (not just top 100) search results that contain A QUERY WORD
         IN THE ANCHOR TEXT of articles, ordered in descending order of the
@@ -207,12 +589,19 @@ def search_anchor():
     query = request.args.get('query', '')
     if len(query) == 0:
         return jsonify(res)
-
-    # BEGIN SOLUTION
-    # END SOLUTION
-    return jsonify(res)
+    if not loader.ready():
+        return not_ready()
+    try:
+        anchor_index = loader.get('anchor_index')
+    except RuntimeError:
+        return not_ready()
+    with timed(g.profile, 'tokenize'):
+        tokens = list(analyze(query))
+    doc_ids, _ = loader.get('engine').search_distinct(tokens, anchor_index, ANCHOR_DIR, stats=g.profile)
+    return stream_results(doc_ids, loader.get('titles'))
 
 @app.route("/get_pagerank", methods=['POST'])
+@instrumented
 def get_pagerank():
     ''' Returns PageRank values for a list of provided wiki article IDs.
 
@@ -223,21 +612,29 @@ def get_pagerank():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pagerank', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        For large payloads send the ids as raw little-endian uint32 (Content-Type:
+        application/octet-stream) and add "?format=binary" to get the scores back as
+        raw little-endian float32.
     Returns:
     --------
         list of floats:
           list of PageRank scores that correrspond to the provided article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
+    wiki_ids = read_wiki_ids()
+    if wiki_ids is None:
+        return jsonify(error="expected a json list of article ids"), 400
     if len(wiki_ids) == 0:
       return jsonify(res)
-    # BEGIN SOLUTION
-
-    # END SOLUTION
-    return jsonify(res)
+    if not loader.loaded('pagerank'):
+        return not_ready()
+    # every id is looked up at once in the sorted column, missing ids get 0
+    with timed(g.profile, 'lookup'):
+        values = loader.get('pagerank_column').take(wiki_ids)
+    return values_response(values)
 
 @app.route("/get_pageview", methods=['POST'])
+@instrumented
 def get_pageview():
     ''' Returns the number of page views that each of the provide wiki articles
         had in August 2021.
@@ -249,6 +646,9 @@ def get_pageview():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pageview', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        For large payloads send the ids as raw little-endian uint32 (Content-Type:
+        application/octet-stream) and add "?format=binary" to get the views back as
+        raw little-endian int32 (float32 when the views are not whole numbers).
     Returns:
     --------
         list of ints:
@@ -256,22 +656,127 @@ def get_pageview():
           provided list article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
+    wiki_ids = read_wiki_ids()
+    if wiki_ids is None:
+        return jsonify(error="expected a json list of article ids"), 400
     if len(wiki_ids) == 0:
       return jsonify(res)
-    # BEGIN SOLUTION
+    if not loader.loaded('page_views'):
+        return not_ready()
+    # every id is looked up at once in the sorted column, missing ids get 0
+    with timed(g.profile, 'lookup'):
+        values = loader.get('page_views_column').take(wiki_ids)
+    return values_response(values)
+def read_wiki_ids():
+    """Returns the article ids of a /get_pagerank or /get_pageview request as an int64 array: a json
+    list, or the raw little-endian uint32 ids when the Content-Type is application/octet-stream.
+    Returns None when the body is neither"""
+    if request.mimetype == 'application/octet-stream':
+        data = request.get_data()
+        return np.frombuffer(data, dtype='<u4').astype(np.int64) if len(data) % 4 == 0 else None
+    wiki_ids = request.get_json(silent=True)
+    if not isinstance(wiki_ids, list) or not all(type(wiki_id) is int for wiki_id in wiki_ids):
+        return None
+    try:
+        return np.array(wiki_ids, dtype=np.int64)
+    except OverflowError:
+        return None
+
+def values_response(values):
+    """Returns the values as a json list, or as raw little-endian int32 / float32 with "?format=binary"
+    (or an Accept: application/octet-stream header). The X-Value-Type header tells which one"""
+    integers = np.issubdtype(values.dtype, np.integer)
+    if request.args.get('format') == 'binary' or request.accept_mimetypes.best == 'application/octet-stream':
+        value_type = 'int32' if integers else 'float32'
+        return Response(values.astype('<i4' if integers else '<f4').tobytes(),
+                        mimetype='application/octet-stream', headers={'X-Value-Type': value_type})
+    # only the binary format is narrowed to float32, json has the full precision of the column
+    return Response(json.dumps((values if integers else values.astype(np.float64)).tolist()), mimetype='application/json')
 
-    # END SOLUTION
-    return jsonify(res)
 def read_posting(index, term, dir_name):
-    """"Returns the term and its posting list from an index"""
-    if term not in index.posting_locs:
-        return term, []
-    posting_list = index.read_a_posting_list(base_dir=dir_name, w=term, bucket_name=BUCKET_NAME)
-    return term, posting_list
+    """"Returns the term and its posting list (as doc_ids and tfs numpy arrays) from an index"""
+    return term, read_postings(index, [term], dir_name)[term]
+
+def read_postings(index, terms, dir_name):
+    """Returns a dict of term -> posting list (doc_ids, tfs) for several terms. Cached posting lists
+    come from the posting cache, the others are read with the index's shared reader so terms stored
+    in the same file cost a single read"""
+    return posting_cache.get_many(dir_name, terms, lambda missing: index.read_posting_arrays(
+        base_dir=dir_name, terms=missing, bucket_name=BUCKET_NAME))
+
+def read_champions(index, terms, dir_name):
+    """Like read_postings for the champion tiers of the terms, which are cached apart from the full lists"""
+    return posting_cache.get_many(f'{dir_name}/champions', terms, lambda missing: index.read_champion_arrays(
+        base_dir=dir_name, terms=missing, bucket_name=BUCKET_NAME))
+
+def with_titles(doc_ids, doc_id_title):
+    """Returns the (doc_id, title) pairs of the result doc ids"""
+    titles = doc_id_title.lookup(doc_ids) if hasattr(doc_id_title, 'lookup') else [doc_id_title.get(doc_id, "") for doc_id in doc_ids]
+    return list(zip(doc_ids, titles))
+
+def stream_results(doc_ids, doc_id_title):
+    """Returns a response that streams the json list of (doc_id, title) pairs of the doc ids in
+    chunks of STREAM_CHUNK documents, so millions of results are never held as one list or string.
+    The json is compact like jsonify's, without spaces after the separators"""
+    def chunks():
+        yield '['
+        for start in range(0, len(doc_ids), STREAM_CHUNK):
+            chunk = json.dumps(with_titles(doc_ids[start:start + STREAM_CHUNK].tolist(), doc_id_title),
+                               separators=(',', ':'))
+            yield (',' if start else '') + chunk[1:-1]
+        yield ']'
+    return Response(chunks(), mimetype='application/json')
+
+def search_queries(queries, k=100, method='exhaustive', stats=None, deadline=None):
+    """Searches a batch of query strings without going through Flask and returns a list of
+    (doc_id, title) lists, in the order of the queries. Each distinct query is tokenized once
+    and the posting lists are read and scored once for the whole batch (see QueryEngine.search_batch)"""
+    engine = loader.get('engine')
+    doc_id_title = loader.get('titles')
+    if method == 'bmw':
+        loader.get('block_max')
+    elif method == 'champions':
+        loader.get('champions')
+    with timed(stats, 'tokenize'):
+        tokens = {query: list(analyze(query)) for query in dict.fromkeys(queries)}
+    doc_ids = engine.search_batch([tokens[query] for query in queries], k=k, method=method, stats=stats,
+                                  deadline=deadline)
+    with timed(stats, 'titles'):
+        return [with_titles(ids, doc_id_title) for ids in doc_ids]
+
 def run(**options):
     app.run(**options)
 
+def serve(host='0.0.0.0', port=8080, threads=SERVER_THREADS):
+    """Runs the app on a production WSGI server: waitress when it is installed, otherwise the
+    threaded Flask server without the debugger and reloader. With gunicorn use one process
+    (the indices are loaded per process) and threads, e.g.
+        gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:8080 search_frontend:app
+    and with an ASGI server (needs asgiref) use asgi_app, e.g.
+        uvicorn search_frontend:asgi_app --host 0.0.0.0 --port 8080"""
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        app.run(host=host, port=port, debug=False, threaded=True)
+    else:
+        waitress_serve(app, host=host, port=port, threads=threads)
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    asgi_app = WsgiToAsgi(app)
+except ImportError:
+    asgi_app = None
+
 if __name__ == '__main__':
-    # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    parser = argparse.ArgumentParser(description="Run the search engine server.")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--dev', action='store_true', help="run the Flask development server with the debugger")
+    parser.add_argument('--budget-ms', type=float, default=SEARCH_BUDGET_MS,
+                        help="default time budget of a /search request (by default, or with 0, it waits for every posting list)")
+    args = parser.parse_args()
+    SEARCH_BUDGET_MS = args.budget_ms or None
+    if args.dev:
+        # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
+        app.run(host='0.0.0.0', port=args.port, debug=True)
+    else:
+        serve(port=args.port)
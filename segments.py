@@ -0,0 +1,582 @@
+""" Incremental index updates with immutable segments and background merges.
+
+Rebuilding the whole index for every new or edited article takes hours, so new documents go
+into small delta segments instead. An index root directory holds a manifest.json that lists its
+segments, oldest first. The first one is usually the full index, which `init` refers to where
+it is (a local directory or the bucket) without copying it. Every other segment is a directory
+of the root laid out like the bucket (body_index/body.pkl, title_index/title.pkl and their
+posting files, written by index_builder.build_index), plus
+    titles.pkl      the titles of its documents.
+    tombstones.npy  the doc ids it deletes from all the OLDER segments: the deleted documents
+                    and the documents it indexes again (an edited document is re-added whole,
+                    so only its newest version is live).
+
+SegmentSet opens the segments of one manifest generation as two SegmentedIndex objects, body
+and title, that the QueryEngine searches like InvertedIndex objects. A posting list is the live
+postings of every segment merged by doc id, and N, the document lengths and df only count the
+live documents, so the BM25 scores are the ones of a single index built from the live documents.
+
+Segments are never changed once written. Adding a segment or merging some writes a new
+directory and replaces the manifest atomically (os.replace), so a server opens the new
+generation (SegmentSet.reopen) and swaps it in while the requests that already started finish
+on the old one. The segments a merge replaced stay on disk for RETIRE_SECONDS.
+
+The merge policy (pick_merge) keeps the number of segments logarithmic in the number of
+documents: segments are grouped in size tiers MERGE_FACTOR times apart, and MERGE_FACTOR
+consecutive segments of a tier are merged into one of the next tier. A segment with too many
+deleted documents is rewritten on its own.
+
+    python segments.py init ROOT BASE_DIR [--bucket BUCKET_NAME]
+    python segments.py add ROOT DOCS.jsonl [DOCS.jsonl ...] [--delete ID [ID ...]]
+    python segments.py merge ROOT [--watch SECONDS]
+    python segments.py status ROOT
+
+DOCS.jsonl holds {"id": ..., "title": ..., "text": ...} documents, new or edited.
+"""
+import argparse
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from pathlib import Path
+import pickle
+import shutil
+import time
+import uuid
+import numpy as np
+from google.api_core.exceptions import NotFound
+from doc_table import DOC_ID_DTYPE, DocColumn
+from index_builder import NUM_BUCKETS, build_index, token2bucket_id
+from inverted_index_gcp import InvertedIndex, sorted_doc_ids
+
+MANIFEST = 'manifest.json'
+LOCK_FILE = 'manifest.lock'
+# (field, index directory, index name) of the indices of a segment, laid out like the bucket
+FIELDS = (('body', 'body_index', 'body'), ('title', 'title_index', 'title'))
+# a merge turns this many consecutive segments of the same size tier into one
+MERGE_FACTOR = 4
+# the segments of up to this many live documents are all in the smallest tier
+MIN_SEGMENT_DOCS = 1000
+# a segment with a larger share of deleted documents is rewritten on its own
+MAX_DELETED_RATIO = 0.3
+# the segments a merge replaced are removed from the disk this long after, so the servers that
+# still search them (until they open the new generation) are not left without their files
+RETIRE_SECONDS = 600
+# number of processes index_builder uses for a delta segment
+DELTA_WORKERS = 2
+
+
+def read_manifest(root):
+    with open(Path(root) / MANIFEST) as f:
+        return json.load(f)
+
+
+def _write_manifest(root, manifest):
+    """ Replaces the manifest atomically with `manifest`, as the next generation. """
+    manifest = dict(manifest, generation=manifest['generation'] + 1)
+    tmp = Path(root) / f'.{MANIFEST}.{uuid.uuid4().hex}'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, Path(root) / MANIFEST)
+    return manifest
+
+
+@contextmanager
+def _locked(root):
+    # the processes that change the manifest (add, merge) take turns, readers never wait
+    with open(Path(root) / LOCK_FILE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_index(base_dir, name, bucket_name=None):
+    index = InvertedIndex.read_index(base_dir, name, bucket_name)
+    if not hasattr(index, 'posting_nbytes'):
+        try:
+            index.load_posting_nbytes(base_dir, bucket_name)
+        except (FileNotFoundError, NotFound):
+            index.posting_nbytes = {}
+    return index
+
+
+def _contains(sorted_ids, doc_ids):
+    """ A boolean mask of the doc ids that are in the sorted array `sorted_ids`. """
+    if not len(sorted_ids) or not len(doc_ids):
+        return np.zeros(len(doc_ids), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_ids, doc_ids), len(sorted_ids) - 1)
+    return sorted_ids[positions] == doc_ids
+
+
+class Segment:
+    """ The indices, titles and tombstones of one segment, as listed in the manifest. """
+    def __init__(self, entry, root):
+        self.name = entry['name']
+        self.bucket_name = entry.get('bucket')
+        if self.bucket_name:
+            self.path = entry['path']
+        else:
+            # the paths of the manifest are relative to the root (or absolute, for a base index)
+            self.path = str(Path(root) / entry['path'])
+        self.indices = {}
+        for field, index_dir, index_name in FIELDS:
+            base_dir = f'{self.path}/{index_dir}' if self.bucket_name else str(Path(self.path) / index_dir)
+            self.indices[field] = (_read_index(base_dir, index_name, self.bucket_name), base_dir)
+        self.titles = {}
+        self.tombstones = np.empty(0, dtype=np.int64)
+        # the base index keeps its titles elsewhere and deletes nothing
+        if not self.bucket_name and (Path(self.path) / 'titles.pkl').exists():
+            with open(Path(self.path) / 'titles.pkl', 'rb') as f:
+                self.titles = pickle.load(f)
+            self.tombstones = np.load(Path(self.path) / 'tombstones.npy')
+        self._lengths = {}
+        self._dead_df = {}
+
+    def doc_lengths(self, field):
+        """ The sorted doc ids of the segment's index of `field` and their lengths (arrays). """
+        if field not in self._lengths:
+            doc_len = self.indices[field][0].doc_len
+            if hasattr(doc_len, 'arrays'):
+                doc_ids, lengths = doc_len.arrays()
+            else:
+                doc_ids = sorted_doc_ids(doc_len)
+                lengths = np.fromiter((doc_len[doc_id] for doc_id in doc_ids.tolist()), dtype=np.int64, count=len(doc_ids))
+            self._lengths[field] = np.asarray(doc_ids, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+        return self._lengths[field]
+
+    def dead_df(self, field, dead):
+        """ The number of postings of the documents of `dead` (a sorted array of doc ids) in the
+            posting lists of the segment's index of `field`, a dict of term -> count of the terms
+            that have some. Counting them scans the whole index, so it is only done again when
+            the dead documents of the segment changed.
+        """
+        dead = dead[_contains(self.doc_lengths(field)[0], dead)]
+        cached = self._dead_df.get(field)
+        if cached is not None and np.array_equal(cached[0], dead):
+            return cached[1]
+        counts = {}
+        if len(dead):
+            index, base_dir = self.indices[field]
+            for w, (doc_ids, _) in index.posting_arrays_iter(base_dir, self.bucket_name):
+                n_dead = int(np.count_nonzero(_contains(dead, doc_ids)))
+                if n_dead:
+                    counts[w] = n_dead
+        self._dead_df[field] = dead, counts
+        return counts
+
+
+class SegmentedIndex:
+    """ The index of one field over the segments of a SegmentSet, searched by the QueryEngine like
+        an InvertedIndex. The posting list of a term is its live postings in every segment, merged
+        by doc id. N, doc_len, unique_terms and df only count the live documents.
+
+        The TF-IDF norms (doc_norm, used by /search_body) are the ones every segment computed with
+        its own df and N, an approximation for the documents of the delta segments until they are
+        merged into bigger ones. The block-max bounds and champion tiers are per segment, so the
+        "bmw" method computes its bounds on the fly and "champions" searches the full lists.
+
+        Parameters:
+        -----------
+            parts: (InvertedIndex, base_dir, bucket_name, dead doc ids) of the segments, oldest
+                   first, where the dead doc ids are a sorted array of the ids tombstoned by the
+                   newer segments.
+            dir_name: the name the posting lists are cached under, different for every generation.
+            lengths: the (sorted doc ids, lengths) arrays of every segment (Segment.doc_lengths).
+            dead_df: the postings of the dead documents of every segment (Segment.dead_df).
+    """
+    def __init__(self, parts, dir_name, lengths, dead_df):
+        self.parts = parts
+        self.dead_df = dead_df
+        self.dir_name = dir_name
+        # every index has its own (empty) block-max bounds and champion tiers, see above
+        self.block_max = {}
+        self.champions = {}
+        self.live_counts = []
+        ids, lens, norms = [], [], []
+        for (index, _, _, dead), (seg_ids, seg_lens) in zip(parts, lengths):
+            live = ~_contains(dead, seg_ids)
+            self.live_counts.append(int(live.sum()))
+            ids.append(seg_ids[live])
+            lens.append(seg_lens[live])
+            if hasattr(index, 'doc_norm'):
+                norms.append(index.doc_norm.lookup(seg_ids[live]))
+        ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        self.doc_len = DocColumn(ids[order].astype(DOC_ID_DTYPE), np.concatenate(lens)[order] if lens else np.empty(0))
+        if len(norms) == len(parts) and parts:
+            self.doc_norm = DocColumn(ids[order].astype(DOC_ID_DTYPE), np.concatenate(norms)[order].astype(np.float32))
+        self.N = len(ids)
+        self.unique_terms = self.total_corpus_terms = int(np.sum(self.doc_len.arrays()[1]))
+        self.df = self.document_frequencey_per_term = LiveDocFreq(self)
+
+    def read_posting_arrays(self, base_dir=None, terms=(), bucket_name=None):
+        """ Returns a dict of term -> (doc_ids, tfs) arrays of the term's live postings in every
+            segment (empty arrays for an unknown term). base_dir and bucket_name are ignored,
+            every segment reads its own.
+        """
+        terms = list(dict.fromkeys(terms))
+        found = defaultdict(list)
+        for index, seg_dir, seg_bucket, dead in self.parts:
+            in_segment = [term for term in terms if term in index.df]
+            if not in_segment:
+                continue
+            for term, (doc_ids, tfs) in index.read_posting_arrays(seg_dir, in_segment, seg_bucket).items():
+                if len(dead):
+                    live = ~_contains(dead, doc_ids)
+                    doc_ids, tfs = doc_ids[live], tfs[live]
+                found[term].append((doc_ids, tfs))
+        res = {}
+        for term in terms:
+            lists = found.get(term, [])
+            if len(lists) == 1:
+                doc_ids, tfs = lists[0]
+            elif lists:
+                doc_ids = np.concatenate([doc_ids for doc_ids, _ in lists])
+                tfs = np.concatenate([tfs for _, tfs in lists])
+                order = np.argsort(doc_ids, kind='stable')
+                doc_ids, tfs = doc_ids[order], tfs[order]
+            else:
+                doc_ids, tfs = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+            res[term] = doc_ids, tfs
+        return res
+
+    def posting_file(self, w):
+        # the posting list of a term is spread over the segments, so every term is read on its own
+        return w
+
+    def posting_nbytes_of(self, w):
+        return sum(index.posting_nbytes_of(w) for index, _, _, _ in self.parts if w in index.df)
+
+    def reader_stats(self):
+        total = Counter()
+        for index, _, _, _ in self.parts:
+            total.update(index.reader_stats())
+        return dict(total)
+
+
+class LiveDocFreq(Mapping):
+    """ The df of the live documents of a SegmentedIndex, a read only dict like view. The df of a
+        term is its df in every segment minus its postings of the dead documents, which were
+        counted when the SegmentSet was opened (see Segment.dead_df), so looking it up reads
+        nothing. Like the df of an index built from the live documents, it only has the terms
+        that have live postings.
+    """
+    def __init__(self, index):
+        self._index = index
+        self._len = None
+
+    def __getitem__(self, w):
+        df = sum(index.df[w] - dead_df.get(w, 0)
+                 for (index, _, _, _), dead_df in zip(self._index.parts, self._index.dead_df) if w in index.df)
+        if not df:
+            raise KeyError(w)
+        return df
+
+    def __iter__(self):
+        seen = set()
+        for index, _, _, _ in self._index.parts:
+            for w in index.df:
+                if w not in seen:
+                    seen.add(w)
+                    if w in self:
+                        yield w
+
+    def __len__(self):
+        # the segments never change, so the terms are only counted once
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+class SegmentTitles:
+    """ The titles of a SegmentSet: a document's title comes from the newest segment that has it,
+        then from `fallback` (the titles of the base index).
+    """
+    def __init__(self, segments, fallback=None):
+        self._segments = [segment for segment in reversed(segments) if segment.titles]
+        self._fallback = fallback
+
+    def get(self, doc_id, default=None):
+        for segment in self._segments:
+            title = segment.titles.get(doc_id)
+            if title is not None:
+                return title
+        return default if self._fallback is None else self._fallback.get(doc_id, default)
+
+
+class SegmentSet:
+    """ The segments of one generation of the manifest of `root`, searched with `body` and `title`
+        (SegmentedIndex objects). The segments of `previous` (an older SegmentSet of the same root)
+        are reused instead of read again.
+    """
+    def __init__(self, root, manifest=None, previous=None):
+        self.root = str(root)
+        manifest = manifest or read_manifest(root)
+        self.generation = manifest['generation']
+        self.names = [entry['name'] for entry in manifest['segments']]
+        reuse = {} if previous is None else {segment.name: segment for segment in previous.segments}
+        self.segments = [reuse.get(entry['name']) or Segment(entry, root) for entry in manifest['segments']]
+        # the documents of a segment are dead when a newer segment tombstones them
+        dead, self.dead = np.empty(0, dtype=np.int64), []
+        for segment in reversed(self.segments):
+            self.dead.append(dead)
+            if len(segment.tombstones):
+                dead = np.union1d(dead, segment.tombstones)
+        self.dead.reverse()
+        for field, index_dir, _ in FIELDS:
+            parts = [segment.indices[field] + (segment.bucket_name, dead) for segment, dead in zip(self.segments, self.dead)]
+            lengths = [segment.doc_lengths(field) for segment in self.segments]
+            dead_df = [segment.dead_df(field, dead) for segment, dead in zip(self.segments, self.dead)]
+            setattr(self, field, SegmentedIndex(parts, f'segments/{self.generation}/{index_dir}', lengths, dead_df))
+
+    def reopen(self):
+        """ Returns the SegmentSet of the current manifest, or self when its segments did not change. """
+        manifest = read_manifest(self.root)
+        if [entry['name'] for entry in manifest['segments']] == self.names:
+            return self
+        return SegmentSet(self.root, manifest, self)
+
+    def titles(self, fallback=None):
+        return SegmentTitles(self.segments, fallback)
+
+    def stats(self):
+        """ The number of documents and of live documents of every segment (of the body index). """
+        return [{'name': segment.name, 'docs': len(segment.doc_lengths('body')[0]), 'live': live}
+                for segment, live in zip(self.segments, self.body.live_counts)]
+
+
+def init(root, base_dir, bucket_name=None):
+    """ Creates the manifest of `root` with the index in `base_dir` (in the bucket, with
+        bucket_name) as its first segment.
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    if (root / MANIFEST).exists():
+        raise FileExistsError(f"{root / MANIFEST} already exists")
+    path = base_dir if bucket_name else str(Path(base_dir).resolve())
+    return _write_manifest(root, {'generation': -1, 'next_segment': 0,
+                                  'segments': [{'name': 'base', 'path': path, 'bucket': bucket_name}],
+                                  'retired': []})
+
+
+def _publish(root, tmp_dir, replaces=()):
+    """ Moves the segment written in tmp_dir into the manifest (in place of the consecutive
+        segments named in `replaces`, or after the others). Returns the new manifest, or None
+        when the segments to replace are not in the manifest anymore.
+    """
+    with _locked(root):
+        manifest = read_manifest(root)
+        names = [entry['name'] for entry in manifest['segments']]
+        replaces = list(replaces)
+        if replaces:
+            start = names.index(replaces[0]) if replaces[0] in names else -1
+            if start < 0 or names[start:start + len(replaces)] != replaces:
+                return None
+        else:
+            start = len(names)
+        name = f"seg_{manifest['next_segment']:06d}"
+        os.rename(tmp_dir, Path(root) / name)
+        entries = manifest['segments']
+        now = time.time()
+        manifest['segments'] = entries[:start] + [{'name': name, 'path': name, 'bucket': None}] + entries[start + len(replaces):]
+        manifest['retired'] = manifest['retired'] + [dict(entry, time=now) for entry in entries[start:start + len(replaces)]]
+        manifest['next_segment'] += 1
+        return _write_manifest(root, manifest)
+
+
+def add_segment(root, docs, deletes=(), workers=DELTA_WORKERS):
+    """ Indexes `docs`, a list of (doc_id, title, text) of new or edited documents, as a new
+        segment, which also deletes the doc ids in `deletes`. Returns the new manifest.
+    """
+    root = Path(root)
+    tmp = root / f'_building_{uuid.uuid4().hex}'
+    try:
+        for field, index_dir, index_name in FIELDS:
+            build_index(((doc_id, title if field == 'title' else text) for doc_id, title, text in docs),
+                        tmp / index_dir, index_name, workers)
+        with open(tmp / 'titles.pkl', 'wb') as f:
+            pickle.dump({doc_id: title for doc_id, title, _ in docs}, f)
+        tombstones = np.unique(np.array([doc_id for doc_id, _, _ in docs] + list(deletes), dtype=np.int64))
+        np.save(tmp / 'tombstones.npy', tombstones)
+        return _publish(root, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _tier(n):
+    tier, n = 0, n // MIN_SEGMENT_DOCS
+    while n >= MERGE_FACTOR:
+        tier, n = tier + 1, n // MERGE_FACTOR
+    return tier
+
+
+def pick_merge(docs, live):
+    """ The merge policy: returns the positions of the consecutive segments to merge next (an
+        empty list when there is nothing to merge), from the number of documents and of live
+        documents of every segment, oldest first.
+    """
+    for i, (n, n_live) in enumerate(zip(docs, live)):
+        if n - n_live > MAX_DELETED_RATIO * n:
+            return [i]
+    tiers = [_tier(n) for n in live]
+    # the newest run of at least MERGE_FACTOR consecutive segments of the same tier
+    end = len(tiers)
+    while end > 0:
+        start = end - 1
+        while start > 0 and tiers[start - 1] == tiers[end - 1]:
+            start -= 1
+        if end - start >= MERGE_FACTOR:
+            return list(range(end - MERGE_FACTOR, end))
+        end = start
+    return []
+
+
+def _write_merged(index, out_dir, name, num_buckets=NUM_BUCKETS):
+    """ Writes the live postings of a SegmentedIndex as one index in out_dir, like build_index. """
+    out_dir.mkdir(parents=True)
+    buckets = defaultdict(set)
+    for part, _, _, _ in index.parts:
+        for w in part.df:
+            buckets[token2bucket_id(w, num_buckets)].add(w)
+    doc_ids, lengths = index.doc_len.arrays()
+    doc_len = dict(zip(doc_ids.tolist(), lengths.tolist()))
+    merged = InvertedIndex()
+    merged.posting_nbytes = {}
+    for bucket_id, terms in sorted(buckets.items()):
+        list_w_pl = [(w, postings) for w, postings in index.read_posting_arrays(terms=sorted(terms)).items()
+                     if len(postings[0])]
+        InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), str(out_dir), None, doc_len)
+        for w, (ids, tfs) in list_w_pl:
+            merged.df[w] = len(ids)
+            merged.term_total[w] = int(tfs.sum())
+        merged.posting_locs.update(InvertedIndex._read_bucket_pickle(str(out_dir), bucket_id, 'posting_locs'))
+        merged.posting_nbytes.update(InvertedIndex._read_bucket_pickle(str(out_dir), bucket_id, 'posting_nbytes'))
+    merged.doc_len = doc_len
+    merged.N = len(doc_len)
+    merged.unique_terms = sum(doc_len.values())
+    merged.compute_doc_norms(str(out_dir))
+    merged.write_index(str(out_dir), name)
+
+
+def merge_segments(segment_set, positions):
+    """ Merges the consecutive segments of a SegmentSet at `positions` into one segment without
+        their dead documents. Returns the new manifest, or None when another merge replaced the
+        segments first.
+    """
+    root = Path(segment_set.root)
+    run = [segment_set.segments[i] for i in positions]
+    tmp = root / f'_merging_{uuid.uuid4().hex}'
+    try:
+        for field, index_dir, index_name in FIELDS:
+            field_index = getattr(segment_set, field)
+            parts = [field_index.parts[i] for i in positions]
+            _write_merged(SegmentedIndex(parts, None, [run_segment.doc_lengths(field) for run_segment in run],
+                                         [field_index.dead_df[i] for i in positions]),
+                          tmp / index_dir, index_name)
+        live = sorted_doc_ids(_read_index(str(tmp / 'body_index'), 'body').doc_len)
+        titles = {}
+        for segment in run:
+            titles.update(segment.titles)
+        title_ids = np.fromiter(titles.keys(), dtype=np.int64, count=len(titles))
+        with open(tmp / 'titles.pkl', 'wb') as f:
+            pickle.dump({doc_id: titles[doc_id] for doc_id in title_ids[_contains(live, title_ids)].tolist()}, f)
+        # the tombstones of the run still delete from the segments before it, the oldest segment has none
+        tombstones = np.empty(0, dtype=np.int64)
+        if positions[0] > 0:
+            for segment in run:
+                tombstones = np.union1d(tombstones, segment.tombstones)
+        np.save(tmp / 'tombstones.npy', tombstones)
+        return _publish(root, tmp, [segment.name for segment in run])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def remove_retired(root, max_age=RETIRE_SECONDS):
+    """ Deletes the directories of the segments retired more than max_age seconds ago. Only the
+        segments written in the root are deleted, a base index outside of it is left alone.
+    """
+    root = Path(root)
+    with _locked(root):
+        manifest = read_manifest(root)
+        now = time.time()
+        keep = [entry for entry in manifest['retired'] if now - entry['time'] < max_age]
+        if len(keep) == len(manifest['retired']):
+            return manifest
+        for entry in manifest['retired']:
+            path = (root / entry['path']).resolve()
+            if entry not in keep and not entry.get('bucket') and path.parent == root.resolve():
+                shutil.rmtree(path, ignore_errors=True)
+        manifest['retired'] = keep
+        return _write_manifest(root, manifest)
+
+
+def merge_once(segment_set):
+    """ Runs one merge picked by the merge policy and removes the old retired segments.
+        Returns the new manifest, or None when there was nothing to merge.
+    """
+    stats = segment_set.stats()
+    positions = pick_merge([s['docs'] for s in stats], [s['live'] for s in stats])
+    manifest = merge_segments(segment_set, positions) if positions else None
+    remove_retired(segment_set.root)
+    return manifest
+
+
+def read_docs(path):
+    """ Yields (doc_id, title, text) from a .jsonl file of {"id": ..., "title": ..., "text": ...}. """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line)
+                yield int(doc['id']), doc.get('title') or "", doc.get('text') or ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the segments of an incrementally updated index.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('init', help="start an index root with an existing index as its base segment")
+    p.add_argument('root')
+    p.add_argument('base_dir', help="the directory with body_index/ and title_index/ (in the bucket, with --bucket)")
+    p.add_argument('--bucket', default=None)
+    p = commands.add_parser('add', help="add a delta segment of new or edited documents")
+    p.add_argument('root')
+    p.add_argument('inputs', nargs='*', help=".jsonl files of {id, title, text} documents")
+    p.add_argument('--delete', type=int, nargs='+', default=[], help="doc ids to delete")
+    p.add_argument('--workers', type=int, default=DELTA_WORKERS)
+    p = commands.add_parser('merge', help="merge segments as the merge policy says")
+    p.add_argument('root')
+    p.add_argument('--watch', type=float, default=None, help="keep merging, checking every SECONDS")
+    p = commands.add_parser('status', help="print the segments and their live documents")
+    p.add_argument('root')
+    args = parser.parse_args()
+    if args.command == 'init':
+        init(args.root, args.base_dir, args.bucket)
+    elif args.command == 'add':
+        docs = [doc for path in args.inputs for doc in read_docs(path)]
+        manifest = add_segment(args.root, docs, args.delete, args.workers)
+        print(f"added {manifest['segments'][-1]['name']}: {len(docs):,} documents, {len(args.delete):,} deletes")
+    elif args.command == 'merge':
+        segment_set = SegmentSet(args.root)
+        while True:
+            segment_set = segment_set.reopen()
+            manifest = merge_once(segment_set)
+            if manifest is not None:
+                print(f"merged, segments: {' '.join(entry['name'] for entry in manifest['segments'])}")
+                continue
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    else:
+        segment_set = SegmentSet(args.root)
+        print(f"generation {segment_set.generation}")
+        for s in segment_set.stats():
+            print(f"{s['name']}: {s['docs']:,} documents, {s['live']:,} live")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+""" Document partitioned, sharded serving with a scatter-gather coordinator.
+
+The documents are split into N shards by doc id (doc_id % N). Every shard holds the body and
+title postings, lengths, PageRank, page views and titles of its documents only, and is served by
+its own process. The coordinator sends every query to all the shards with the collection wide
+statistics (df of the query terms; N and the average lengths are saved in the shards), so a shard
+scores its documents exactly like the unsharded index would. Every shard returns its top k with the
+final fused scores, and the coordinator merges them into the global top k, with the same tie break
+(the smaller doc id) as QueryEngine.search.
+
+    python sharding.py split DATA_DIR OUT_DIR --shards 4 [--bucket BUCKET_NAME]
+    python sharding.py shard OUT_DIR/shard_0 --port 8100
+    python sharding.py coordinator OUT_DIR --shard-urls http://127.0.0.1:8100 ... --port 8090
+    python sharding.py local OUT_DIR --port 8090
+
+DATA_DIR is laid out like the bucket (see load_test.py generate). `local` starts one process per
+shard and the coordinator, which answers /search like search_frontend.py. A query with a time
+budget (budget_ms, or the coordinator's --budget-ms) sends every shard the budget that is left, and
+the shards that did not answer by then are left out of the merge (X-Search-Degraded: true).
+"""
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+import heapq
+import http.client
+import json
+from pathlib import Path
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import numpy as np
+from google.api_core.exceptions import NotFound
+from BM25 import BM25
+from inverted_index_gcp import InvertedIndex, LocalBucket, _open, get_bucket
+from query_engine import BODY_K1, TITLE_B, QueryEngine
+from text_Modification import tokenize
+
+# the names search_frontend.py reads from the bucket
+INDICES = (('body', 'body_index', 'body'), ('title', 'title_index', 'title'))
+PAGE_VIEWS_PATH = "page_views_august_2021_log.pkl"
+PAGERANK_PATH = "pr/part-00000-dfa568ba-d8f3-4828-9ded-c144a863ddec-c000_log.csv.gz"
+TITLES_PATH = "docID_title_mapper.pkl"
+# the collection wide statistics the coordinator sends with every query
+GLOBAL_STATS_FILE = "global_stats.pkl"
+# a shard that does not answer within this many seconds fails the query
+SHARD_TIMEOUT = 30
+# under a time budget a shard gets this many milliseconds past the budget it was sent (for the
+# network and the json) before it is left out of the merge
+SHARD_SLACK_MS = 50
+# at most this many queries are sent to the shards at the same time, the others wait for a slot for
+# up to QUEUE_TIMEOUT seconds and then get a 503, like in search_frontend.py
+MAX_IN_FLIGHT = 8
+QUEUE_TIMEOUT = 10
+
+
+def shard_of(doc_ids, n_shards):
+    """ The shard of every doc id of an array. """
+    return np.asarray(doc_ids) % n_shards
+
+
+def budget_deadline(budget_ms, t_start):
+    """ The time.perf_counter() deadline of a request that arrived at t_start with a time budget of
+        budget_ms milliseconds, like search_frontend.search_deadline. None, 0 and "none" mean no deadline.
+    """
+    if budget_ms is None or str(budget_ms).lower() == 'none':
+        return None
+    try:
+        budget_ms = float(budget_ms)
+    except (TypeError, ValueError):
+        raise ValueError("budget_ms must be a number of milliseconds, or 0 for no budget") from None
+    if budget_ms == 0:
+        return None
+    if not budget_ms > 0:
+        raise ValueError("budget_ms must be positive, or 0 for no budget")
+    return t_start + budget_ms / 1000
+
+
+def _load_pickle(bucket, path):
+    with closing(_open(path, 'rb', bucket)) as f:
+        return pickle.load(f)
+
+
+def _load_pagerank(bucket, path):
+    from doc_table import read_pagerank_csv
+    with closing(_open(path, 'rb', bucket)) as f:
+        return read_pagerank_csv(f)
+
+
+def split_index(index, base_dir, bucket_name, out_dirs, pagerank=None, page_views=None):
+    """ Writes the posting lists of `index` split by shard_of into one local directory per shard
+        (out_dirs), with block-max bounds. Returns the shard InvertedIndex objects, which keep the
+        collection wide N and unique_terms (global_N, global_unique_terms) for BM25.
+    """
+    n_shards = len(out_dirs)
+    shards = [InvertedIndex() for _ in range(n_shards)]
+    doc_ids = np.fromiter(index.doc_len.keys(), dtype=np.int64, count=len(index.doc_len))
+    lengths = np.fromiter(index.doc_len.values(), dtype=np.int64, count=len(index.doc_len))
+    for i, shard in enumerate(shards):
+        in_shard = shard_of(doc_ids, n_shards) == i
+        shard.doc_len = dict(zip(doc_ids[in_shard].tolist(), lengths[in_shard].tolist()))
+        shard.N = len(shard.doc_len)
+        shard.unique_terms = int(lengths[in_shard].sum())
+        shard.global_N = index.N
+        shard.global_unique_terms = index.unique_terms
+        shard.posting_nbytes = {}
+        shard.block_max = {}
+    for bucket_id, terms in sorted(index.terms_by_bucket().items()):
+        lists = [[] for _ in range(n_shards)]
+        for w, (ids, tfs) in index.read_posting_arrays(base_dir, terms, bucket_name).items():
+            order = np.argsort(ids, kind='stable')
+            ids, tfs = ids[order], tfs[order]
+            shard_ids = shard_of(ids, n_shards)
+            for i in np.unique(shard_ids).tolist():
+                in_shard = shard_ids == i
+                lists[i].append((w, (ids[in_shard], tfs[in_shard])))
+        for i, shard in enumerate(shards):
+            if not lists[i]:
+                continue
+            InvertedIndex.write_a_posting_list((bucket_id, lists[i]), out_dirs[i], None, shard.doc_len,
+                                               pagerank, page_views)
+            for w, (ids, tfs) in lists[i]:
+                shard.df[w] = len(ids)
+                shard.term_total[w] = int(tfs.sum())
+            shard.posting_locs.update(InvertedIndex._read_bucket_pickle(out_dirs[i], bucket_id, 'posting_locs'))
+            shard.posting_nbytes.update(InvertedIndex._read_bucket_pickle(out_dirs[i], bucket_id, 'posting_nbytes'))
+            shard.block_max.update(InvertedIndex._read_bucket_pickle(out_dirs[i], bucket_id, 'block_max'))
+    return shards
+
+
+def split_data(data_dir, out_dir, n_shards, bucket_name=None):
+    """ Splits the indices and the per document data of a bucket (or of a local directory laid
+        out like one) into n_shards shard directories under out_dir, and writes the collection
+        wide statistics the coordinator needs to out_dir/GLOBAL_STATS_FILE.
+    """
+    bucket = LocalBucket(data_dir) if bucket_name is None else get_bucket(bucket_name)
+    out_dir = Path(out_dir)
+    shard_dirs = [out_dir / f'shard_{i}' for i in range(n_shards)]
+    page_views = _load_pickle(bucket, PAGE_VIEWS_PATH)
+    pagerank = _load_pagerank(bucket, PAGERANK_PATH)
+    titles = _load_pickle(bucket, TITLES_PATH)
+    for shard_dir in shard_dirs:
+        for _, index_dir, _ in INDICES:
+            (shard_dir / index_dir).mkdir(parents=True, exist_ok=True)
+    global_stats = {}
+    for name, index_dir, index_name in INDICES:
+        index = InvertedIndex.read_index(index_dir, index_name, bucket)
+        if not hasattr(index, 'posting_nbytes'):
+            # like search_frontend.load_index, 6 bytes per posting indices have no sizes
+            try:
+                index.load_posting_nbytes(index_dir, bucket)
+            except (FileNotFoundError, NotFound):
+                index.posting_nbytes = {}
+        shards = split_index(index, index_dir, bucket, [shard_dir / index_dir for shard_dir in shard_dirs],
+                             pagerank, page_views)
+        for shard, shard_dir in zip(shards, shard_dirs):
+            shard.write_index(str(shard_dir / index_dir), index_name)
+        global_stats[name] = {'df': dict(index.df), 'N': index.N, 'unique_terms': index.unique_terms}
+    for i, shard_dir in enumerate(shard_dirs):
+        for file_name, values in (('page_views.pkl', page_views), ('pagerank.pkl', pagerank), ('titles.pkl', titles)):
+            with open(shard_dir / file_name, 'wb') as f:
+                pickle.dump({doc_id: value for doc_id, value in values.items() if doc_id % n_shards == i}, f)
+    with open(out_dir / GLOBAL_STATS_FILE, 'wb') as f:
+        pickle.dump(global_stats, f)
+    return shard_dirs
+
+
+class Shard:
+    """ Searches the documents of one shard directory written by split_data. """
+    def __init__(self, shard_dir):
+        shard_dir = Path(shard_dir)
+        indices, bm25 = {}, {}
+        for name, index_dir, index_name in INDICES:
+            index = InvertedIndex.read_index(str(shard_dir / index_dir), index_name)
+            # the average length and N of the whole collection, so the scores match the unsharded BM25
+            bm25[name] = BM25(doc_len=index.doc_len, df=index.df, N=index.global_N, total_terms=index.global_unique_terms)
+            indices[name] = (index, str(shard_dir / index_dir))
+        bm25['body'].k1 = BODY_K1
+        bm25['title'].b = TITLE_B
+        with open(shard_dir / 'page_views.pkl', 'rb') as f:
+            page_views = pickle.load(f)
+        with open(shard_dir / 'pagerank.pkl', 'rb') as f:
+            pagerank = pickle.load(f)
+        with open(shard_dir / 'titles.pkl', 'rb') as f:
+            self.titles = pickle.load(f)
+        fetch = lambda index, terms, dir_name: index.read_posting_arrays(dir_name, terms)
+        (body_index, body_dir), (title_index, title_dir) = indices['body'], indices['title']
+        self.engine = QueryEngine(body_index, body_dir, title_index, title_dir, bm25['body'], bm25['title'],
+                                  page_views, pagerank, fetch)
+
+    def search(self, tokens, k=100, method='exhaustive', df=None, deadline=None, stats=None):
+        """ Returns the [doc_id, final score, title] lists of the k best documents of the shard.
+            deadline and stats are passed to QueryEngine.search.
+        """
+        return [[doc_id, score, self.titles.get(doc_id, "")]
+                for doc_id, score in self.engine.search(tokens, k, method, stats, df=df, with_scores=True,
+                                                        deadline=deadline)]
+
+
+def merge_top_k(shard_results, k):
+    """ Merges the best first [doc_id, score, ...] lists of the shards into the global top k,
+        best first with ties broken by the smaller doc id, like QueryEngine.search. """
+    merged = heapq.merge(*shard_results, key=lambda result: (-result[1], result[0]))
+    return [result for _, result in zip(range(k), merged)]
+
+
+class _ShardClient:
+    """ Posts json to a shard over keep-alive connections, one per thread. """
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self._local = threading.local()
+
+    def post(self, path, payload, timeout=SHARD_TIMEOUT):
+        """ Returns the json answer of the shard and its headers. A request that fails in any way
+            (a timeout or a partial read included) closes the connection, so the next request of the
+            thread never reads the rest of an old answer.
+        """
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                body = response.read()
+            except Exception as e:
+                conn.close()
+                self._local.conn = None
+                # the shard closed the kept alive connection, i open a new one once
+                if attempt or not isinstance(e, (http.client.HTTPException, ConnectionError)):
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"shard {self.host}:{self.port} answered {response.status}: {body[:200]!r}")
+            return json.loads(body), response.headers
+
+
+class Coordinator:
+    """ Sends every query to all the shards and merges their top k.
+
+        budget_ms is the default time budget of a query (None waits for every shard for up to
+        SHARD_TIMEOUT seconds).
+    """
+    def __init__(self, shard_urls, global_stats, budget_ms=None):
+        self.shards = [_ShardClient(url) for url in shard_urls]
+        self.global_stats = global_stats
+        self.budget_ms = budget_ms
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(shard_urls), thread_name_prefix='shard')
+
+    def search(self, tokens, k=100, method='exhaustive', deadline=None, stats=None):
+        """ Returns the [doc_id, final score, title] lists of the k best documents of all the shards.
+
+            deadline is an optional time.perf_counter() value to answer by. Every shard is sent the
+            budget that is left (and skips its lowest idf terms when it runs out), and the shards that
+            did not answer SHARD_SLACK_MS after the deadline are left out of the merge. 'deadline_hit'
+            is added to stats when a shard skipped terms or was left out, 'shards_skipped' counts the
+            shards left out.
+        """
+        if len(tokens) == 0:
+            return []
+        if stats is None:
+            stats = Counter()
+        df = {name: {term: collection['df'].get(term, 0) for term in tokens}
+              for name, collection in self.global_stats.items()}
+        payload = {'tokens': tokens, 'k': k, 'method': method, 'df': df}
+        timeout = SHARD_TIMEOUT
+        if deadline is not None:
+            budget_ms = max((deadline - time.perf_counter()) * 1000, 1)
+            payload['budget_ms'] = budget_ms
+            timeout = min(SHARD_TIMEOUT, (budget_ms + SHARD_SLACK_MS) / 1000)
+        futures = [self.executor.submit(shard.post, '/shard_search', payload, timeout) for shard in self.shards]
+        done, not_done = wait(futures, timeout=None if deadline is None else timeout)
+        results = []
+        for future in futures:
+            if future in not_done or (deadline is not None and isinstance(future.exception(), TimeoutError)):
+                # the shard ran out of the budget, its thread stops at the socket timeout
+                stats['shards_skipped'] += 1
+                continue
+            shard_results, headers = future.result()
+            if headers.get('X-Search-Degraded') == 'true':
+                stats['deadline_hit'] = 1
+            results.append(shard_results)
+        if stats['shards_skipped']:
+            stats['deadline_hit'] = 1
+        return merge_top_k(results, k)
+
+
+def _serve(app, port, threads=16):
+    # the same server choice as search_frontend.serve
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+    else:
+        waitress_serve(app, host='0.0.0.0', port=port, threads=threads)
+
+
+def shard_app(shard):
+    from flask import Flask, jsonify, request
+    app = Flask(__name__)
+
+    @app.route("/shard_search", methods=['POST'])
+    def shard_search():
+        t_start = time.perf_counter()
+        body = request.get_json()
+        method = body.get('method', 'exhaustive')
+        if method not in QueryEngine.METHODS:
+            return jsonify(error=f"unknown engine {method}"), 400
+        # the budget the coordinator had left when it sent the query
+        try:
+            deadline = budget_deadline(body.get('budget_ms'), t_start)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        stats = Counter()
+        results = shard.search(body['tokens'], int(body.get('k', 100)), method, body.get('df'), deadline, stats)
+        return jsonify(results), {'X-Search-Degraded': 'true' if stats['deadline_hit'] else 'false'}
+
+    @app.route("/ready")
+    def ready():
+        return jsonify(ready=True)
+    return app
+
+
+def coordinator_app(coordinator):
+    from flask import Flask, jsonify, request
+    app = Flask(__name__)
+    search_slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+    @app.route("/search")
+    def search():
+        ''' Returns up to a 100 (wiki_id, title) results for the query, like search_frontend.py
+            (including "&budget_ms=..." and the X-Search-Degraded header). '''
+        t_start = time.perf_counter()
+        query = request.args.get('query', '')
+        if len(query) == 0:
+            return jsonify([])
+        method = request.args.get('engine', 'exhaustive')
+        if method not in QueryEngine.METHODS:
+            return jsonify(error=f"unknown engine {method}"), 400
+        try:
+            deadline = budget_deadline(request.args.get('budget_ms', coordinator.budget_ms), t_start)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        # the budget counts the time spent waiting for a slot
+        if not search_slots.acquire(timeout=QUEUE_TIMEOUT):
+            return jsonify(error="the server is overloaded"), 503, {'Retry-After': '1'}
+        try:
+            stats = Counter()
+            results = coordinator.search(tokenize(query), 100, method, deadline, stats)
+        finally:
+            search_slots.release()
+        return (jsonify([(doc_id, title) for doc_id, _, title in results]),
+                {'X-Search-Degraded': 'true' if stats['deadline_hit'] else 'false'})
+
+    @app.route("/ready")
+    def ready():
+        return jsonify(ready=True)
+    return app
+
+
+def _wait_ready(url, proc, timeout=300):
+    deadline = time.perf_counter() + timeout
+    client = _ShardClient(url)
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"the shard at {url} exited with code {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection(client.host, client.port, timeout=5)
+            conn.request('GET', '/ready')
+            if conn.getresponse().status == 200:
+                return
+        except (http.client.HTTPException, OSError):
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"the shard at {url} was not ready after {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded serving of the search engine.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split = commands.add_parser('split', help="split the indices and the per document data into shards")
+    split.add_argument('data_dir')
+    split.add_argument('out_dir')
+    split.add_argument('--shards', type=int, required=True)
+    split.add_argument('--bucket', help="read the data from this bucket instead of data_dir")
+    shard = commands.add_parser('shard', help="serve one shard")
+    shard.add_argument('shard_dir')
+    shard.add_argument('--port', type=int, required=True)
+    coordinator = commands.add_parser('coordinator', help="serve /search over running shards")
+    coordinator.add_argument('out_dir')
+    coordinator.add_argument('--shard-urls', nargs='+', required=True)
+    coordinator.add_argument('--port', type=int, default=8090)
+    coordinator.add_argument('--budget-ms', type=float, default=None,
+                             help="default time budget of a /search request (by default, or with 0, it waits for every shard)")
+    local = commands.add_parser('local', help="start a process per shard and the coordinator")
+    local.add_argument('out_dir')
+    local.add_argument('--port', type=int, default=8090)
+    local.add_argument('--budget-ms', type=float, default=None,
+                       help="default time budget of a /search request (by default, or with 0, it waits for every shard)")
+    local.add_argument('--first-shard-port', type=int, default=8100)
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        shard_dirs = split_data(args.data_dir, args.out_dir, args.shards, args.bucket)
+        print(f"wrote {len(shard_dirs)} shards to {args.out_dir}")
+    elif args.command == 'shard':
+        _serve(shard_app(Shard(args.shard_dir)), args.port)
+    else:
+        with open(Path(args.out_dir) / GLOBAL_STATS_FILE, 'rb') as f:
+            global_stats = pickle.load(f)
+        procs = []
+        try:
+            if args.command == 'local':
+                shard_dirs = sorted(Path(args.out_dir).glob('shard_*'), key=lambda path: int(path.name.split('_')[1]))
+                urls = []
+                for i, shard_dir in enumerate(shard_dirs):
+                    port = args.first_shard_port + i
+                    procs.append(subprocess.Popen([sys.executable, __file__, 'shard', str(shard_dir), '--port', str(port)]))
+                    urls.append(f'http://127.0.0.1:{port}')
+                for url, proc in zip(urls, procs):
+                    _wait_ready(url, proc)
+            else:
+                urls = args.shard_urls
+            _serve(coordinator_app(Coordinator(urls, global_stats, args.budget_ms or None)), args.port)
+        finally:
+            for proc in procs:
+                proc.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+# number of items sampled from a dict (or list) to estimate its size
+SIZE_SAMPLE = 1000
+
+
+def _rss():
+    """ Returns the resident memory of the process in bytes (0 where /proc is not available). """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def approx_size(obj, _depth=0):
+    """ Returns an estimate of the memory held by obj in bytes.
+
+        numpy arrays count their data (0 for memory mapped ones, which live in the page cache),
+        dicts and lists count their own size plus the average size of a sample of their items
+        times their length, and other objects count their attributes. It is an estimate, but
+        unlike the RSS it does not mix up artifacts that load at the same time.
+    """
+    if isinstance(obj, np.memmap):
+        return sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) if obj.flags.owndata else obj.nbytes + sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None or _depth > 3:
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = obj.items()
+        size = sys.getsizeof(obj)
+        if obj:
+            sample = [approx_size(k, _depth + 1) + approx_size(v, _depth + 1)
+                      for _, (k, v) in zip(range(SIZE_SAMPLE), items)]
+            size += sum(sample) * len(obj) // len(sample)
+        return size
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        size = sys.getsizeof(obj)
+        if obj:
+            sample = [approx_size(v, _depth + 1) for _, v in zip(range(SIZE_SAMPLE), obj)]
+            size += sum(sample) * len(obj) // len(sample)
+        return size
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + sum(approx_size(v, _depth + 1) for v in vars(obj).values())
+    return sys.getsizeof(obj)
+
+
+class Artifact:
+    """ One thing the server loads at startup, with its load time and size once it is loaded. """
+    def __init__(self, name, load, deps=(), lazy=False, required=True):
+        self.name = name
+        self.load = load
+        self.deps = tuple(deps)
+        self.lazy = lazy
+        self.required = required
+        # pending -> waiting (for its dependencies) -> loading -> loaded or failed
+        self.state = 'pending'
+        self.value = None
+        self.error = None
+        self.started = self.seconds = None
+        self.size = self.rss_delta = None
+        self.done = threading.Event()
+
+    def report(self):
+        return {'state': self.state, 'lazy': self.lazy, 'required': self.required,
+                'seconds': None if self.seconds is None else round(self.seconds, 3),
+                'bytes': self.size, 'rss_delta': self.rss_delta,
+                'error': None if self.error is None else repr(self.error)}
+
+
+class ArtifactLoader:
+    """ Loads the artifacts of the server concurrently on a thread pool.
+
+        Every artifact is a function that receives the values of its dependencies (in the
+        order of `deps`) and returns the loaded object. Eager artifacts start loading when
+        start() is called, each one as soon as its dependencies are loaded. Lazy artifacts
+        are only loaded the first time get() asks for them. The loader is ready when all the
+        required artifacts are loaded.
+
+        Parameters:
+        -----------
+            max_workers: number of artifacts loaded at the same time.
+    """
+    def __init__(self, max_workers=8):
+        self.artifacts = {}
+        self.started = None
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='startup')
+        self._lock = threading.Lock()
+
+    def add(self, name, load, deps=(), lazy=False, required=True):
+        """ Registers an artifact. Lazy artifacts are never required for readiness. """
+        if name in self.artifacts:
+            raise ValueError(f"artifact {name} is already registered")
+        missing = [dep for dep in deps if dep not in self.artifacts]
+        if missing:
+            raise ValueError(f"unknown dependencies of {name}: {missing}")
+        self.artifacts[name] = Artifact(name, load, deps, lazy, required and not lazy)
+
+    def start(self):
+        """ Starts loading every eager artifact in the background and returns right away. """
+        self.started = time.perf_counter()
+        for artifact in self.artifacts.values():
+            if not artifact.lazy:
+                self._submit(artifact)
+        return self
+
+    def _submit(self, artifact):
+        with self._lock:
+            if artifact.state != 'pending':
+                return
+            artifact.state = 'waiting'
+        # a dependency that is lazy is loaded on demand, like get() would
+        for dep in artifact.deps:
+            self._submit(self.artifacts[dep])
+        self._run_if_ready(artifact)
+
+    def _run_if_ready(self, artifact):
+        # an artifact only takes a thread once its dependencies are done, so waiting
+        # artifacts can never fill the pool and block the ones they wait for
+        with self._lock:
+            if artifact.state != 'waiting' or not all(self.artifacts[dep].done.is_set() for dep in artifact.deps):
+                return
+            artifact.state = 'loading'
+        self._pool.submit(self._load, artifact)
+
+    def _load(self, artifact):
+        try:
+            failed = [dep for dep in artifact.deps if self.artifacts[dep].error is not None]
+            if failed:
+                raise RuntimeError(f"dependencies of {artifact.name} failed to load: {failed}")
+            deps = [self.artifacts[dep].value for dep in artifact.deps]
+            rss = _rss()
+            artifact.started = time.perf_counter()
+            value = artifact.load(*deps)
+            artifact.seconds = time.perf_counter() - artifact.started
+            artifact.rss_delta = _rss() - rss
+            artifact.size = approx_size(value)
+            artifact.value = value
+            artifact.state = 'loaded'
+        except BaseException as e:
+            artifact.error = e
+            artifact.state = 'failed'
+        finally:
+            artifact.done.set()
+            for other in list(self.artifacts.values()):
+                if artifact.name in other.deps:
+                    self._run_if_ready(other)
+
+    def get(self, name, timeout=None):
+        """ Returns the value of an artifact, loading it first if it is lazy and not loaded yet.
+            Waits for it to finish loading and re-raises the error if loading it failed.
+        """
+        artifact = self.artifacts[name]
+        self._submit(artifact)
+        if not artifact.done.wait(timeout):
+            raise TimeoutError(f"{name} is still loading")
+        if artifact.error is not None:
+            raise RuntimeError(f"loading {name} failed") from artifact.error
+        return artifact.value
+
+    def replace(self, values):
+        """ Replaces the values of loaded artifacts all at once, e.g. a new generation of the
+            indices with the engine built on them. get() returns the new values from then on,
+            the callers that got the old ones keep them.
+        """
+        sizes = {name: approx_size(value) for name, value in values.items()}
+        with self._lock:
+            not_loaded = [name for name in values if self.artifacts[name].state != 'loaded']
+            if not_loaded:
+                raise ValueError(f"cannot replace artifacts that are not loaded: {not_loaded}")
+            for name, value in values.items():
+                self.artifacts[name].value = value
+                self.artifacts[name].size = sizes[name]
+
+    def loaded(self, name):
+        return self.artifacts[name].state == 'loaded'
+
+    def ready(self):
+        """ True when every required artifact is loaded. """
+        return all(a.state == 'loaded' for a in self.artifacts.values() if a.required)
+
+    def failed(self):
+        return [name for name, a in self.artifacts.items() if a.state == 'failed']
+
+    def wait(self, timeout=None):
+        """ Waits for the required artifacts, returns ready(). """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for artifact in self.artifacts.values():
+            if artifact.required:
+                left = None if deadline is None else max(0, deadline - time.perf_counter())
+                if not artifact.done.wait(left):
+                    return False
+        return self.ready()
+
+    def report(self):
+        """ Returns the state, load time and size of every artifact. """
+        return {'ready': self.ready(),
+                'uptime': None if self.started is None else round(time.perf_counter() - self.started, 3),
+                'rss': _rss(),
+                'artifacts': {name: a.report() for name, a in self.artifacts.items()}}
@@ -0,0 +1,177 @@
+""" Compact, memory-mapped term dictionary replacing the posting_locs, df and posting_nbytes dicts.
+
+The dictionary is a directory of .npy files:
+    term_offsets.npy  int64 offsets of each term in the heap (one more than the number of terms)
+    term_heap.npy     uint8 utf-8 bytes of all the terms, sorted by their bytes
+    df.npy            uint32 document frequency of each term
+    nbytes.npy        int64 size of each posting list in bytes
+    loc_offsets.npy   int64 offsets of each term in loc_file / loc_offset (one more than the number of terms)
+    loc_file.npy      uint32 file id of every (file_name, offset) location
+    loc_offset.npy    uint32 byte offset in the file of every location
+    files.json        the posting file names, the file id is the position in this list
+
+A term is found with a binary search, first over every SAMPLE_RATE-th term (kept in memory)
+and then over the terms in between, so a lookup is O(log n) and touches a few pages.
+
+Build it from an index pickle with:
+    python term_dictionary.py BASE_DIR NAME OUT_DIR [--bucket BUCKET_NAME]
+"""
+import argparse
+from bisect import bisect_right
+from collections.abc import Mapping
+import json
+from pathlib import Path
+import numpy as np
+
+# one term of every SAMPLE_RATE is kept in memory to start the binary search from
+SAMPLE_RATE = 64
+
+
+class _TermColumn(Mapping):
+    """ A read only, dict like view of one column of the dictionary (term -> value). """
+    def __init__(self, terms, values):
+        self._terms = terms
+        self._values = values
+
+    def __getitem__(self, term):
+        i = self._terms.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._values(i)
+
+    def __contains__(self, term):
+        return self._terms.find(term) >= 0
+
+    def __iter__(self):
+        return iter(self._terms)
+
+    def __len__(self):
+        return len(self._terms)
+
+
+class TermDictionary:
+    """ The memory mapped term dictionary of a directory written by TermDictionary.build.
+
+        `posting_locs`, `df` and `posting_nbytes` are dict like views, so an index that
+        uses them (see InvertedIndex.attach_term_dictionary) reads posting lists as before.
+    """
+    def __init__(self, directory, mmap=True):
+        self.directory = Path(directory)
+        mode = 'r' if mmap else None
+        load = lambda name: np.load(self.directory / f'{name}.npy', mmap_mode=mode)
+        self.term_offsets = load('term_offsets')
+        self.term_heap = load('term_heap')
+        self.df_ = load('df')
+        self.nbytes = load('nbytes')
+        self.loc_offsets = load('loc_offsets')
+        self.loc_file = load('loc_file')
+        self.loc_offset = load('loc_offset')
+        with open(self.directory / 'files.json') as f:
+            self.files = json.load(f)
+        # indexing and slicing memoryviews is much cheaper than the memmaps for every probe
+        self._heap = memoryview(self.term_heap) if len(self.term_heap) else memoryview(b'')
+        self._term_offsets = memoryview(self.term_offsets).cast('B').cast('q')
+        self._loc_offsets = memoryview(self.loc_offsets).cast('B').cast('q')
+        self._loc_file = memoryview(self.loc_file).cast('B').cast('I')
+        self._loc_offset = memoryview(self.loc_offset).cast('B').cast('I')
+        self._sample = [self._term_bytes(i) for i in range(0, len(self), SAMPLE_RATE)]
+        self.posting_locs = _TermColumn(self, self.locs_at)
+        df, nbytes = memoryview(self.df_).cast('B').cast('I'), memoryview(self.nbytes).cast('B').cast('q')
+        self.df = _TermColumn(self, df.__getitem__)
+        self.posting_nbytes = _TermColumn(self, nbytes.__getitem__)
+
+    def __len__(self):
+        return len(self.term_offsets) - 1
+
+    def _term_bytes(self, i):
+        return bytes(self._heap[self._term_offsets[i]:self._term_offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._term_bytes(i).decode('utf-8')
+
+    def find(self, term):
+        """ Returns the position of the term in the dictionary or -1. """
+        if not isinstance(term, str):
+            return -1
+        key = term.encode('utf-8')
+        block = bisect_right(self._sample, key) - 1
+        if block < 0:
+            return -1
+        lo, hi = block * SAMPLE_RATE, min((block + 1) * SAMPLE_RATE, len(self))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._term_bytes(mid)
+            if mid_key == key:
+                return mid
+            if mid_key < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return -1
+
+    def locs_at(self, i):
+        """ Returns the [(file_name, offset), ...] locations of the i-th term. """
+        start, end = self._loc_offsets[i], self._loc_offsets[i + 1]
+        return [(self.files[f], o) for f, o in zip(self._loc_file[start:end], self._loc_offset[start:end])]
+
+    @staticmethod
+    def build(out_dir, posting_locs, df, posting_nbytes):
+        """ Writes the term dictionary of the terms of posting_locs. df and posting_nbytes are
+            dicts (or callables) giving the df and the posting list size in bytes of a term.
+            Returns the TermDictionary.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        get_df = df if callable(df) else df.__getitem__
+        get_nbytes = posting_nbytes if callable(posting_nbytes) else posting_nbytes.__getitem__
+        terms = sorted(posting_locs, key=lambda w: w.encode('utf-8'))
+        encoded = [w.encode('utf-8') for w in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=term_offsets[1:])
+        file_ids = {}
+        loc_counts, loc_file, loc_offset = [], [], []
+        for w in terms:
+            locs = posting_locs[w]
+            loc_counts.append(len(locs))
+            for file_name, offset in locs:
+                loc_file.append(file_ids.setdefault(file_name, len(file_ids)))
+                loc_offset.append(offset)
+        loc_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(loc_counts, out=loc_offsets[1:])
+        arrays = {
+            'term_offsets': term_offsets,
+            'term_heap': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'df': np.array([get_df(w) for w in terms], dtype=np.uint32),
+            'nbytes': np.array([get_nbytes(w) for w in terms], dtype=np.int64),
+            'loc_offsets': loc_offsets,
+            # the posting files are at most BLOCK_SIZE (about 2MB) long
+            'loc_file': np.array(loc_file, dtype=np.uint32),
+            'loc_offset': np.array(loc_offset, dtype=np.uint32),
+        }
+        for name, array in arrays.items():
+            np.save(out_dir / f'{name}.npy', array)
+        with open(out_dir / 'files.json', 'w') as f:
+            json.dump(list(file_ids), f)
+        return TermDictionary(out_dir)
+
+
+def main():
+    from inverted_index_gcp import InvertedIndex
+    parser = argparse.ArgumentParser(description="Build the term dictionary of an index.")
+    parser.add_argument('base_dir')
+    parser.add_argument('name')
+    parser.add_argument('out_dir')
+    parser.add_argument('--bucket', help="read the index pickle from this bucket instead of the local disk")
+    parser.add_argument('--slim', action='store_true',
+                        help="also write a <name>_slim.pkl copy of the index pickle without the term dicts")
+    args = parser.parse_args()
+    index = InvertedIndex.read_index(args.base_dir, args.name, args.bucket)
+    terms = TermDictionary.build(args.out_dir, index.posting_locs, index.df, index.posting_nbytes_of)
+    print(f"wrote {len(terms):,} terms and {len(terms.files):,} file names to {args.out_dir}")
+    if args.slim:
+        index.write_slim(args.base_dir, args.name, args.bucket, ['posting_locs', 'df', 'posting_nbytes', 'term_total'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import pickle
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+# the modules live at the top of the repository, next to this directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from BM25 import BM25
+from inverted_index_gcp import InvertedIndex
+from query_engine import QueryEngine
+
+
+def _build_engine(root, n_docs=20_000, n_terms=80, seed=6):
+    """ Writes small random body and title indices (with block-max bounds and, for the body, document
+        norms), PageRank and page views under root. Returns a QueryEngine over them and the terms
+        ('term0', 'term1', ...), whose df is zipf like: a few terms are in most of the documents.
+    """
+    rng = np.random.default_rng(seed)
+    doc_ids = np.sort(rng.choice(10_000_000, size=n_docs, replace=False))
+    pagerank = dict(zip(doc_ids.tolist(), (rng.pareto(2.0, n_docs) * 0.1).tolist()))
+    page_views = dict(zip(doc_ids.tolist(), (rng.pareto(1.5, n_docs) * 0.05).tolist()))
+    args = []
+    for name, max_df, mean_len in (('body', n_docs * 3 // 4, 400), ('title', n_docs // 40, 4)):
+        index = InvertedIndex()
+        index.doc_len = dict(zip(doc_ids.tolist(), (rng.poisson(mean_len, n_docs) + 1).tolist()))
+        index.N = n_docs
+        index.unique_terms = sum(index.doc_len.values())
+        buckets = [[] for _ in range(4)]
+        for i in range(n_terms):
+            df = int(min(rng.zipf(1.2) * 20, max_df))
+            ids = np.sort(rng.choice(doc_ids, size=df, replace=False))
+            tfs = rng.zipf(2.0, size=df).clip(1, 1000)
+            index.df[f'term{i}'] = df
+            buckets[i % 4].append((f'term{i}', list(zip(ids.tolist(), tfs.tolist()))))
+        base_dir = Path(root) / name
+        base_dir.mkdir()
+        for bucket_id, list_w_pl in enumerate(buckets):
+            InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), str(base_dir), None,
+                                               index.doc_len, pagerank, page_views)
+            with open(base_dir / f'{bucket_id}_posting_locs.pickle', 'rb') as f:
+                index.posting_locs.update(pickle.load(f))
+        index.load_block_max(str(base_dir))
+        index.load_posting_nbytes(str(base_dir))
+        if name == 'body':
+            index.compute_doc_norms(str(base_dir))
+        args += [index, str(base_dir), BM25(index.doc_len, index.df, index.N, index.unique_terms)]
+    body_index, body_dir, bm25_body, title_index, title_dir, bm25_title = args
+    bm25_body.k1 = 0.7
+    bm25_title.b = 0.7
+    fetch = lambda index, terms, dir_name: index.read_posting_arrays(dir_name, terms)
+    engine = QueryEngine(body_index, body_dir, title_index, title_dir, bm25_body, bm25_title,
+                         page_views, pagerank, fetch)
+    return engine, [f'term{i}' for i in range(n_terms)]
+
+
+@pytest.fixture(scope='session')
+def build_engine():
+    """ The function that builds a small random corpus and a QueryEngine over it (see _build_engine). """
+    return _build_engine
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pytest
+from inverted_index_gcp import LocalBlockCache, LocalBucket, PostingReader
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    """ A local bucket with 4 posting files of 200 bytes under body_index/. """
+    root = tmp_path / 'bucket'
+    (root / 'body_index').mkdir(parents=True)
+    files = {f'{i}_000.bin': bytes(range(i, i + 200)) for i in range(4)}
+    for name, data in files.items():
+        (root / 'body_index' / name).write_bytes(data)
+    return LocalBucket(root), files
+
+
+def test_mapped_local_files_are_read_without_copies(tmp_path, bucket):
+    local_bucket, files = bucket
+    reader = PostingReader(local_bucket.root / 'body_index', use_mmap=True)
+    b = reader.read([('2_000.bin', 50)], 30)
+    assert isinstance(b, memoryview) and bytes(b) == files['2_000.bin'][50:80]
+    reader.close()
+    # the view stays readable after the reader let go of the file
+    assert bytes(b) == files['2_000.bin'][50:80]
+    with pytest.raises(ValueError):
+        PostingReader('body_index', local_bucket, use_mmap=True)
+
+
+def test_blocks_are_downloaded_once_and_then_read_locally(tmp_path, bucket):
+    local_bucket, files = bucket
+    cache = LocalBlockCache(tmp_path / 'cache', 10_000)
+    for _ in range(2):
+        # a new reader (like after a restart of the index) finds the block in the cache
+        reader = PostingReader('body_index', local_bucket, block_cache=cache)
+        assert bytes(reader.read([('1_000.bin', 10)], 20)) == files['1_000.bin'][10:30]
+        reader.close()
+    assert local_bucket.n_opens == 1
+    assert (tmp_path / 'cache' / 'body_index' / '1_000.bin').read_bytes() == files['1_000.bin']
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'blocks': 1, 'bytes': 200}
+
+
+def test_least_recently_used_blocks_are_deleted(tmp_path, bucket):
+    local_bucket, files = bucket
+    cache = LocalBlockCache(tmp_path / 'cache', 450)
+    first = cache.map_block('body_index/0_000.bin', local_bucket)
+    cache.map_block('body_index/1_000.bin', local_bucket)
+    cache.map_block('body_index/0_000.bin', local_bucket)
+    cache.map_block('body_index/2_000.bin', local_bucket)
+    assert sorted(os.listdir(tmp_path / 'cache' / 'body_index')) == ['0_000.bin', '2_000.bin']
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'evictions': 1, 'blocks': 2, 'bytes': 400}
+    # a block bigger than the whole cache is still mapped
+    small = LocalBlockCache(tmp_path / 'small', 100)
+    assert bytes(small.map_block('body_index/3_000.bin', local_bucket)) == files['3_000.bin']
+    cache.map_block('body_index/3_000.bin', local_bucket)
+    cache.map_block('body_index/1_000.bin', local_bucket)
+    # a mapped block that was deleted stays readable
+    assert not (tmp_path / 'cache' / 'body_index' / '0_000.bin').exists()
+    assert bytes(first) == files['0_000.bin']
+
+
+def test_blocks_left_by_a_previous_run_are_reused(tmp_path, bucket):
+    local_bucket, files = bucket
+    cache = LocalBlockCache(tmp_path / 'cache', 10_000)
+    for name in ('0_000.bin', '1_000.bin'):
+        cache.map_block(f'body_index/{name}', local_bucket)
+    # a download that was cut off is not taken for a block
+    (tmp_path / 'cache' / 'body_index' / '2_000.bin.123.part').write_bytes(b'cut')
+    restarted = LocalBlockCache(tmp_path / 'cache', 10_000)
+    assert restarted.stats()['blocks'] == 2 and restarted.stats()['bytes'] == 400
+    assert bytes(restarted.map_block('body_index/1_000.bin', local_bucket)) == files['1_000.bin']
+    assert bytes(restarted.map_block('body_index/2_000.bin', local_bucket)) == files['2_000.bin']
+    assert local_bucket.n_opens == 3
+    # a smaller cache drops the oldest blocks when it starts
+    assert LocalBlockCache(tmp_path / 'cache', 250).stats()['blocks'] == 1
+
+
+def test_threads_wait_for_a_block_being_downloaded(tmp_path, bucket):
+    local_bucket, files = bucket
+    cache = LocalBlockCache(tmp_path / 'cache', 10_000)
+    with ThreadPoolExecutor(8) as pool:
+        views = list(pool.map(lambda _: cache.map_block('body_index/3_000.bin', local_bucket), range(32)))
+    assert all(bytes(view) == files['3_000.bin'] for view in views)
+    assert local_bucket.n_opens == 1
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 31
@@ -0,0 +1,76 @@
+from collections import defaultdict
+import math
+import numpy as np
+import pytest
+from BM25 import BM25, accumulate_scores
+from doc_table import DocColumn
+
+
+@pytest.fixture
+def bm25():
+    rng = np.random.default_rng(0)
+    doc_len = dict(zip(range(1, 2001), rng.integers(0, 300, size=2000).tolist()))
+    return BM25(doc_len, {'a': 10}, len(doc_len), sum(doc_len.values()))
+
+
+@pytest.mark.parametrize('b', [0.75, 0.3])
+def test_score_batch_matches_score_term(bm25, b):
+    bm25.b = b
+    rng = np.random.default_rng(1)
+    # documents of length 0 and unknown documents score 0
+    doc_ids = np.concatenate([np.sort(rng.choice(2000, size=500, replace=False)) + 1, [5000, 5001]])
+    tfs = rng.integers(1, 20, size=len(doc_ids))
+    expected = [bm25.score_term(tf, doc_id, 2.5) for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist())]
+    np.testing.assert_allclose(bm25.score_batch(doc_ids, tfs, 2.5), expected)
+
+
+def reference_score(tf, dl, avgdl, idf, k1, b):
+    # the Okapi BM25 term weight, 0 for an empty (or unknown) document
+    if dl == 0:
+        return 0.0
+    return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+
+
+@pytest.mark.parametrize('as_column', [False, True])
+def test_score_batch_matches_the_bm25_formula(bm25, as_column):
+    doc_len = bm25.doc_len_
+    if as_column:
+        bm25 = BM25(DocColumn.from_dict(doc_len, dtype=np.int32), bm25.df_, bm25.N_, sum(doc_len.values()))
+    avgdl = sum(doc_len.values()) / len(doc_len)
+    rng = np.random.default_rng(4)
+    doc_ids = np.sort(rng.choice(np.arange(1, 2101), size=800, replace=False))
+    tfs = rng.integers(1, 50, size=len(doc_ids))
+    idf = bm25.calc_idf(['a', 'missing'])
+    assert idf == {'a': math.log((2000 - 10 + 0.5) / (10 + 0.5)) + 1, 'missing': math.log((2000 + 0.5) / 0.5) + 1}
+    expected = [reference_score(tf, doc_len.get(doc_id, 0), avgdl, idf['a'], 1.5, 0.75)
+                for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist())]
+    np.testing.assert_allclose(bm25.score_batch(doc_ids, tfs, idf['a']), expected, rtol=1e-12)
+
+
+def test_score_batch_follows_changes_of_b_and_k1(bm25):
+    avgdl = sum(bm25.doc_len_.values()) / len(bm25.doc_len_)
+    doc_ids, tfs = np.arange(1, 2001), np.full(2000, 3)
+    bm25.score_batch(doc_ids, tfs, 1.0)
+    # b and k1 are tuned on the object after the length normalization was built
+    for k1, b in ((1.5, 0.3), (0.9, 0.3), (0.9, 1.0), (1.2, 0.0)):
+        bm25.k1, bm25.b = k1, b
+        expected = [reference_score(3, bm25.doc_len_[doc_id], avgdl, 1.0, k1, b) for doc_id in doc_ids.tolist()]
+        np.testing.assert_allclose(bm25.score_batch(doc_ids, tfs, 1.0), expected, rtol=1e-12)
+
+
+def test_score_batch_of_an_empty_list(bm25):
+    assert len(bm25.score_batch(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 1.0)) == 0
+
+
+def test_accumulate_scores_sums_like_a_dict():
+    rng = np.random.default_rng(2)
+    doc_id_arrays = [rng.choice(100, size=30, replace=False) for _ in range(4)]
+    score_arrays = [rng.random(30) for _ in range(4)]
+    expected = defaultdict(float)
+    for doc_ids, scores in zip(doc_id_arrays, score_arrays):
+        for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+            expected[doc_id] += score
+    doc_ids, scores = accumulate_scores(doc_id_arrays, score_arrays)
+    assert doc_ids.tolist() == sorted(expected)
+    np.testing.assert_allclose(scores, [expected[doc_id] for doc_id in sorted(expected)])
+    assert len(accumulate_scores([], [])[0]) == 0
@@ -0,0 +1,110 @@
+from collections import Counter
+from pathlib import Path
+import threading
+import time
+import pytest
+
+# seconds a slowed down read takes, far more than the budgets below
+SLOW_READ = 2.0
+BUDGET = 0.2
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory, build_engine):
+    root = tmp_path_factory.mktemp('engine')
+    engine, terms = build_engine(root)
+    out_dir = Path(root) / 'body_champions'
+    out_dir.mkdir()
+    engine.body_index.convert_postings(engine.body_dir, str(out_dir), champion_size=50, champion_min_df=1_000)
+    engine.body_dir = str(out_dir)
+    yield engine, terms
+    engine.close()
+
+
+@pytest.fixture
+def slow(engine, monkeypatch):
+    """ Makes the reads of the given terms take SLOW_READ seconds (or until the test ends). """
+    engine, terms = engine
+    slow_terms = set()
+    released = threading.Event()
+
+    def slowed(fetch):
+        def fetch_postings(index, group, dir_name):
+            if slow_terms.intersection(group):
+                released.wait(SLOW_READ)
+            return fetch(index, group, dir_name)
+        return fetch_postings
+    monkeypatch.setattr(engine, 'fetch_postings', slowed(engine.fetch_postings))
+    monkeypatch.setattr(engine, 'fetch_champions', slowed(engine.fetch_champions))
+    yield engine, terms, slow_terms
+    # the reads that were given up on finish in the background and free the I/O pool for the next test
+    released.set()
+
+
+def query_of(engine, terms):
+    """ Three terms of different buckets, in descending (fused body and title) idf order. """
+    return engine._by_idf(terms[:3], engine.bm25_body.calc_idf(terms[:3]), engine.bm25_title.calc_idf(terms[:3]))
+
+
+def test_a_far_deadline_changes_nothing(engine):
+    engine, terms = engine
+    query = query_of(engine, terms)
+    for method in engine.METHODS:
+        stats = Counter()
+        expected = engine.search(query, 100, method)
+        assert engine.search(query, 100, method, stats, deadline=time.perf_counter() + 60) == expected
+        assert engine.search_batch([query, query[:1]], 100, method, stats, deadline=time.perf_counter() + 60)[0] == expected
+        assert stats['deadline_hit'] == 0
+
+
+@pytest.mark.parametrize('method', ['exhaustive', 'bmw'])
+def test_a_late_term_is_skipped(slow, method):
+    engine, terms, slow_terms = slow
+    query = query_of(engine, terms)
+    expected = engine.search(query[:2], 100, method)
+    slow_terms.add(query[2])
+    stats = Counter()
+    t_start = time.perf_counter()
+    got = engine.search(query, 100, method, stats, deadline=t_start + BUDGET)
+    assert time.perf_counter() - t_start < BUDGET + 0.5
+    assert got == expected
+    assert stats['deadline_hit'] == 1 and stats['terms_skipped'] == 1
+
+
+@pytest.mark.parametrize('method', ['exhaustive', 'bmw'])
+def test_the_terms_after_a_late_one_are_skipped_too(slow, method):
+    engine, terms, slow_terms = slow
+    query = query_of(engine, terms)
+    expected = engine.search(query[:1], 100, method)
+    # the middle term is late, the lower idf one that was read in time is skipped with it
+    slow_terms.add(query[1])
+    stats = Counter()
+    got = engine.search(query, 100, method, stats, deadline=time.perf_counter() + BUDGET)
+    assert got == expected
+    assert stats['deadline_hit'] == 1 and stats['terms_skipped'] == 2
+
+
+def test_a_late_first_read_does_not_block(slow):
+    engine, terms, slow_terms = slow
+    slow_terms.update(terms[:3])
+    stats = Counter()
+    t_start = time.perf_counter()
+    assert engine.search(terms[:3], 100, deadline=t_start + BUDGET, stats=stats) == []
+    assert time.perf_counter() - t_start < BUDGET + 0.5
+    assert stats['deadline_hit'] == 1 and stats['terms_skipped'] == 3
+
+
+def test_champions_and_batches_stop_at_the_deadline(slow):
+    engine, terms, slow_terms = slow
+    tiered = [term for term in terms if term in engine.body_index.champions]
+    slow_terms.update(tiered)
+    for search in (lambda stats, deadline: engine.search(tiered[:2], 100, 'champions', stats, deadline=deadline),
+                   lambda stats, deadline: engine.search_batch([tiered[:2], terms[:1]], 100, 'champions', stats, deadline),
+                   lambda stats, deadline: engine.search_batch([tiered[:2], terms[:1]], 100, 'exhaustive', stats, deadline)):
+        stats = Counter()
+        t_start = time.perf_counter()
+        search(stats, t_start + BUDGET)
+        assert time.perf_counter() - t_start < BUDGET + 0.5
+        assert stats['deadline_hit'] >= 1
+        # a champions query that ran out of time is not read again in full
+        assert stats['champion_fallbacks'] == 0
@@ -0,0 +1,91 @@
+import gzip
+import io
+import numpy as np
+import pytest
+from doc_table import SORTED_SEARCH_MIN, DocColumn, DocTable, read_pagerank_csv
+
+
+@pytest.fixture
+def dicts():
+    rng = np.random.default_rng(0)
+    doc_ids = rng.choice(2 ** 32 - 1, size=5_000, replace=False).tolist()
+    return {
+        'body_len': dict(zip(doc_ids, rng.integers(1, 5_000, size=5_000).tolist())),
+        # a document can be missing from some of the dicts
+        'title_len': dict(zip(doc_ids[:4_000], rng.integers(1, 10, size=4_000).tolist())),
+        'pagerank': dict(zip(doc_ids[1_000:], (rng.random(4_000) / 3).tolist())),
+        'page_views': dict(zip(doc_ids, rng.integers(0, 10 ** 6, size=5_000).tolist())),
+        'titles': {doc_id: f"Title {i} é中" for i, doc_id in enumerate(doc_ids[:4_500])},
+    }
+
+
+def test_columns_read_like_the_dicts(tmp_path, dicts):
+    table = DocTable.build(tmp_path, **dicts)
+    assert len(table) == 5_000 and isinstance(table.doc_ids, np.memmap)
+    rng = np.random.default_rng(1)
+    all_ids = np.array(list(dicts['body_len']))
+    # unknown, negative and too big ids are missing
+    queries = np.concatenate([rng.choice(all_ids, 5_000), rng.integers(0, 2 ** 32, 100), [-1, 2 ** 40]])
+    assert len(queries) >= SORTED_SEARCH_MIN
+    for name in ('body_len', 'title_len', 'pagerank', 'page_views'):
+        column, values = table.column(name), dicts[name]
+        expected = [values.get(doc_id, 0) for doc_id in queries.tolist()]
+        # the small lookups search the ids as they are, the big ones sort them first
+        for ids, want in ((queries[:50], expected[:50]), (queries, expected)):
+            np.testing.assert_allclose(column.lookup(ids), want, rtol=1e-7)
+        doc_id = next(iter(values))
+        assert column.get(doc_id) == pytest.approx(values[doc_id], rel=1e-7) and doc_id in column
+        assert column.get(-1) is None and -1 not in column
+        with pytest.raises(KeyError):
+            column[2 ** 40]
+    # page views are whole numbers, so they are kept as integers, and the PageRank is exact
+    assert table.column('page_views').values().dtype == np.int32
+    assert table.column('pagerank').take(list(dicts['pagerank'])).tolist() == list(dicts['pagerank'].values())
+    titles = table.titles()
+    assert titles.lookup(queries[:100].tolist()) == [dicts['titles'].get(doc_id, "") for doc_id in queries[:100].tolist()]
+    assert titles.get(-1, 'none') == 'none'
+
+
+def test_page_views_that_are_not_whole_numbers_stay_floats(tmp_path):
+    table = DocTable.build(tmp_path, page_views={1: 1.5, 2: 2.0})
+    assert table.column('page_views').take([1, 2, 3]).tolist() == [1.5, 2.0, 0.0]
+    assert table.titles().get(1) == ""
+
+
+def test_an_empty_table(tmp_path):
+    table = DocTable.build(tmp_path)
+    assert len(table) == 0
+    assert table.column('pagerank').lookup([1, 2]).tolist() == [0.0, 0.0]
+    assert table.column('body_len').take([1]).tolist() == [0]
+
+
+def test_from_dict(dicts):
+    column = DocColumn.from_dict(dicts['page_views'], keep_integers=True, default=-1)
+    assert column.values().dtype == np.int32 and len(column) == len(dicts['page_views'])
+    assert column.take([next(iter(dicts['page_views'])), 7]).tolist() == [next(iter(dicts['page_views'].values())), -1]
+    assert DocColumn.from_dict({1: 0.5}, keep_integers=True).values().dtype == np.float32
+
+
+def test_read_pagerank_csv_skips_bad_lines():
+    data = io.BytesIO(gzip.compress(b"12,0.5\nheader,rank\n7,1e-3\n\n99,x\n"))
+    assert read_pagerank_csv(data) == {12: 0.5, 7: 1e-3}
+
+
+def test_the_engine_ranks_the_same_with_columns(tmp_path, build_engine):
+    engine, terms = build_engine(tmp_path, n_terms=30)
+    try:
+        queries = [terms[i:i + 3] for i in range(0, 30, 3)]
+        expected = [engine.search(query, 100, with_scores=True) for query in queries]
+        table = DocTable.build(tmp_path / 'table', body_len=engine.bm25_body.doc_len_, title_len=engine.bm25_title.doc_len_,
+                               pagerank=engine.pagerank_scores, page_views=engine.page_views)
+        engine.pagerank_scores = table.column('pagerank')
+        # the page views of the test corpus are not whole numbers, float32 rounds them a little
+        engine.page_views = table.column('page_views')
+        engine.bm25_body.doc_len_, engine.bm25_title.doc_len_ = table.column('body_len'), table.column('title_len')
+        engine.bm25_body._norm_b = engine.bm25_title._norm_b = None
+        for query, want in zip(queries, expected):
+            got = engine.search(query, 100, with_scores=True)
+            assert [doc_id for doc_id, _ in got[:20]] == [doc_id for doc_id, _ in want[:20]]
+            np.testing.assert_allclose([score for _, score in got], [score for _, score in want], rtol=1e-5)
+    finally:
+        engine.close()
@@ -0,0 +1,212 @@
+import importlib
+import json
+from pathlib import Path
+import threading
+import time
+import numpy as np
+import pytest
+from load_test import QUERIES_FILE, generate_corpus
+
+
+@pytest.fixture(scope='module')
+def frontend(tmp_path_factory):
+    """ search_frontend.py serving a small synthetic corpus (it reads SEARCH_DATA_DIR when imported). """
+    data_dir = tmp_path_factory.mktemp('frontend')
+    generate_corpus(data_dir, n_docs=2_000, vocab_size=2_000, body_len=40)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('SEARCH_DATA_DIR', str(data_dir))
+        module = importlib.import_module('search_frontend')
+    client = module.app.test_client()
+    for _ in range(600):
+        if client.get('/ready').status_code == 200:
+            break
+        time.sleep(0.05)
+    return module, client
+
+
+@pytest.mark.parametrize('endpoint', ['/get_pagerank', '/get_pageview'])
+def test_ids_must_be_a_json_list_of_integers(frontend, endpoint):
+    _, client = frontend
+    assert client.post(endpoint, json=[1, 2]).status_code == 200
+    for body in ([1, True], [False], [1.5], ['1'], {'ids': [1]}, [2 ** 70]):
+        response = client.post(endpoint, json=body)
+        assert response.status_code == 400, body
+        assert 'error' in response.get_json()
+
+
+@pytest.fixture(scope='module')
+def queries(frontend):
+    module, _ = frontend
+    with open(Path(module.LOCAL_DATA_DIR) / QUERIES_FILE) as f:
+        return [query for mix in json.load(f).values() for query in mix[:5]]
+
+
+def test_search_batch_answers_like_search(frontend, queries):
+    _, client = frontend
+    batch = queries + [queries[0], '']
+    response = client.post('/search_batch', json={'queries': batch, 'engine': 'bmw'})
+    assert response.status_code == 200 and response.headers['X-Search-Degraded'] == 'false'
+    expected = [client.get('/search', query_string={'query': query, 'engine': 'bmw'}).get_json() for query in batch]
+    assert any(expected) and response.get_json() == expected
+    assert client.post('/search_batch', json=queries[:3]).get_json() == expected[:3]
+    assert client.post('/search_batch', json=[]).get_json() == []
+
+
+def test_search_batch_rejects_malformed_batches(frontend, monkeypatch):
+    module, client = frontend
+    monkeypatch.setattr(module, 'MAX_BATCH_QUERIES', 2)
+    for body in ('hello', {'query': ['a']}, ['a', 1], ['a', 'b', 'c'], {'queries': ['a'], 'engine': 'nope'},
+                 {'queries': ['a'], 'budget_ms': 'soon'}, {'queries': ['a'], 'budget_ms': -5}):
+        response = client.post('/search_batch', json=body)
+        assert response.status_code == 400, body
+        assert 'error' in response.get_json()
+
+
+def test_ready_reports_every_artifact(frontend):
+    module, client = frontend
+    report = client.get('/ready').get_json()
+    assert report['ready'] and report['uptime'] > 0
+    artifacts = report['artifacts']
+    assert set(artifacts) == set(module.loader.artifacts)
+    assert artifacts['engine']['state'] == 'loaded' and artifacts['engine']['seconds'] is not None
+    assert artifacts['body_index']['bytes'] > 0
+    assert artifacts['anchor_index']['lazy'] and not artifacts['anchor_index']['required']
+
+
+def test_requests_get_a_503_until_the_artifacts_are_loaded(frontend, monkeypatch):
+    from startup import ArtifactLoader
+    module, client = frontend
+    release = threading.Event()
+    loader = ArtifactLoader()
+    loader.add('engine', lambda: release.wait(5))
+    loader.add('titles', lambda: {})
+    monkeypatch.setattr(module, 'loader', loader.start())
+    try:
+        assert client.get('/ready').status_code == 503
+        response = client.get('/search', query_string={'query': 'hello'})
+        assert response.status_code == 503 and response.headers['Retry-After'] == '5'
+        assert 'still loading' in response.get_json()['error']
+    finally:
+        release.set()
+    assert loader.wait(5) and client.get('/ready').status_code == 200
+
+
+def test_searches_over_the_limit_wait_for_a_slot_and_then_get_a_503(frontend, queries, monkeypatch):
+    module, client = frontend
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(module, 'search_slots', slots)
+    monkeypatch.setattr(module, 'QUEUE_TIMEOUT', 0.1)
+    assert slots.acquire()
+    response = client.get('/search', query_string={'query': queries[1]}, headers={'X-Profile': '1'})
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert json.loads(response.headers['X-Search-Profile'])['stages_ms']['queue'] >= 100
+    slots.release()
+    assert client.get('/search', query_string={'query': queries[1]}).status_code == 200
+
+
+def test_search_body_returns_the_cosine_ranking_with_titles(frontend, queries, monkeypatch):
+    from text_Modification import analyze
+    module, client = frontend
+    engine, titles = module.loader.get('engine'), module.loader.get('titles')
+    found = 0
+    for query in queries[:5]:
+        expected = [[doc_id, titles.get(doc_id, "")] for doc_id in engine.search_body(list(analyze(query)))]
+        assert client.get('/search_body', query_string={'query': query}).get_json() == expected
+        found += len(expected)
+    assert found > 0
+    assert client.get('/search_body', query_string={'query': ''}).get_json() == []
+    # an index without document norms can not rank by cosine
+    monkeypatch.delattr(engine.body_index, 'doc_norm')
+    response = client.get('/search_body', query_string={'query': queries[0]})
+    assert response.status_code == 503 and 'norms' in response.get_json()['error']
+
+
+def test_search_title_streams_every_matching_document(frontend, queries, monkeypatch):
+    from text_Modification import analyze
+    module, client = frontend
+    # many small chunks, so the joins between them are checked too
+    monkeypatch.setattr(module, 'STREAM_CHUNK', 7)
+    engine, titles = module.loader.get('engine'), module.loader.get('titles')
+    found = 0
+    for query in queries[:5] + ['qqqqqq']:
+        doc_ids, _ = engine.search_distinct(list(analyze(query)), engine.title_index, engine.title_dir)
+        response = client.get('/search_title', query_string={'query': query})
+        assert response.is_streamed and response.mimetype == 'application/json'
+        assert json.loads(response.get_data()) == [[doc_id, titles.get(doc_id, "")] for doc_id in doc_ids.tolist()]
+        found += len(doc_ids)
+    assert found > 2 * module.STREAM_CHUNK
+
+
+def test_search_anchor_loads_the_anchor_index_on_first_use(frontend):
+    from index_builder import build_index
+    module, client = frontend
+    titles = module.loader.get('titles')
+    targets = sorted(titles)[:3]
+    anchors = [(targets[0], 'hello world'), (targets[1], 'hello'), (targets[2], 'world wide'), (targets[0], 'hello')]
+    build_index(anchors, Path(module.LOCAL_DATA_DIR) / module.ANCHOR_DIR, module.ANCHOR_INDEX, workers=1)
+    assert not module.loader.loaded('anchor_index')
+    response = client.get('/search_anchor', query_string={'query': 'hello world'})
+    assert response.is_streamed and module.loader.loaded('anchor_index')
+    assert json.loads(response.get_data()) == [[doc_id, titles.get(doc_id, "")] for doc_id in targets]
+
+
+def test_pagerank_and_page_views_of_a_list_of_ids(frontend):
+    module, client = frontend
+    pagerank, page_views = module.loader.get('pagerank'), module.loader.get('page_views')
+    # known ids, an unknown one and a repeated one
+    wiki_ids = sorted(pagerank)[:50] + [1, sorted(pagerank)[3]]
+    assert client.post('/get_pagerank', json=wiki_ids).get_json() == [pagerank.get(i, 0) for i in wiki_ids]
+    views = client.post('/get_pageview', json=wiki_ids).get_json()
+    np.testing.assert_allclose(views, [page_views.get(i, 0) for i in wiki_ids], rtol=1e-6)
+    assert client.post('/get_pagerank', json=[]).get_json() == []
+
+
+@pytest.mark.parametrize('endpoint, name', [('/get_pagerank', 'pagerank'), ('/get_pageview', 'page_views')])
+def test_the_binary_format(frontend, endpoint, name):
+    module, client = frontend
+    values = module.loader.get(name)
+    wiki_ids = np.array(sorted(values)[:1000] + [1, 2 ** 32 - 1], dtype='<u4')
+    expected = np.array([values.get(i, 0) for i in wiki_ids.tolist()])
+    for headers, query in (({}, {'format': 'binary'}), ({'Accept': 'application/octet-stream'}, {})):
+        response = client.post(endpoint, data=wiki_ids.tobytes(), content_type='application/octet-stream',
+                               headers=headers, query_string=query)
+        assert response.mimetype == 'application/octet-stream'
+        value_type = response.headers['X-Value-Type']
+        got = np.frombuffer(response.get_data(), dtype='<i4' if value_type == 'int32' else '<f4')
+        np.testing.assert_allclose(got, expected.astype(np.float32), rtol=1e-6)
+    # binary ids with a json answer
+    response = client.post(endpoint, data=wiki_ids[:3].tobytes(), content_type='application/octet-stream')
+    np.testing.assert_allclose(response.get_json(), expected[:3], rtol=1e-6)
+    # the body must be whole uint32 ids
+    assert client.post(endpoint, data=b'\x01\x02\x03', content_type='application/octet-stream').status_code == 400
+
+
+def test_metrics_count_every_request(frontend, queries):
+    module, client = frontend
+
+    def sample(text, line_start):
+        return sum(float(line.split()[-1]) for line in text.splitlines() if line.startswith(line_start))
+    before = client.get('/metrics').get_data(as_text=True)
+    for query in queries[:3]:
+        assert client.get('/search', query_string={'query': query}).status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    after = response.get_data(as_text=True)
+    assert sample(after, 'search_request_seconds_count{endpoint="search"}') - \
+        sample(before, 'search_request_seconds_count{endpoint="search"}') == 3
+    assert sample(after, 'search_requests_total{endpoint="search",status="200"}') - \
+        sample(before, 'search_requests_total{endpoint="search",status="200"}') == 3
+    assert 'search_stage_seconds_count{endpoint="search",stage="tokenize"}' in after
+    assert '# TYPE search_postings_scored histogram' in after
+
+
+def test_the_profile_header_is_returned_on_request(frontend, queries):
+    module, client = frontend
+    assert 'X-Search-Profile' not in client.get('/search', query_string={'query': queries[0]}).headers
+    for kwargs in ({'headers': {'X-Profile': '1'}}, {'query_string': {'query': queries[0], 'profile': 1}}):
+        kwargs.setdefault('query_string', {'query': queries[0]})
+        response = client.get('/search', **kwargs)
+        profile = json.loads(response.headers['X-Search-Profile'])
+        assert set(profile) == {'stages_ms', 'counters', 'total_ms'}
+        assert 'tokenize' in profile['stages_ms']
+        assert sum(profile['stages_ms'].values()) <= profile['total_ms'] + 1
@@ -0,0 +1,108 @@
+import json
+import os
+import random
+import numpy as np
+import pytest
+import index_builder
+from index_builder import build_index
+from inverted_index_gcp import InvertedIndex, block_max_bounds, tfidf_weights
+from text_Modification import tokenize
+
+
+def random_docs(n=600, seed=0):
+    rng = random.Random(seed)
+    vocab = [''.join(rng.choice('bcdfghjklmnprstvz') + rng.choice('aeiou') for _ in range(3)) for _ in range(800)]
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    return [(doc_id, ' '.join(rng.choices(vocab, weights, k=rng.randint(0, 120)))) for doc_id in rng.sample(range(10 ** 6), n)]
+
+
+def in_memory_index(docs):
+    index = InvertedIndex({doc_id: tokenize(text) for doc_id, text in docs})
+    postings = {w: sorted(pl) for w, pl in index._posting_list.items()}
+    return index, postings
+
+
+def expected_norms(index, postings):
+    squares = dict.fromkeys(index.doc_len, 0.0)
+    for w, pl in postings.items():
+        weights = tfidf_weights(np.array([tf for _, tf in pl]), index.df[w], index.N)
+        for (doc_id, _), weight in zip(pl, weights.tolist()):
+            squares[doc_id] += weight ** 2
+    return squares
+
+
+@pytest.fixture
+def small_runs(monkeypatch):
+    # many runs per bucket, terms split over blocks and several norm files per bucket
+    monkeypatch.setattr(index_builder, 'SPILL_BLOCK_POSTINGS', 7)
+    monkeypatch.setattr(index_builder, 'NORM_FLUSH_POSTINGS', 50)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_merged_index_matches_an_in_memory_build(tmp_path, small_runs, compressed):
+    docs = random_docs()
+    index = build_index(docs, tmp_path, 'body', workers=2, memory_budget=40_000, num_buckets=8,
+                        compressed=compressed, chunk_size=50)
+    expected, postings = in_memory_index(docs)
+    assert index.N == expected.N and index.doc_len == expected.doc_len
+    assert index.unique_terms == expected.unique_terms
+    assert dict(index.df) == dict(expected.df)
+    assert dict(index.term_total) == dict(expected.term_total)
+    # the index on disk is the one that was returned
+    index = InvertedIndex.read_index(str(tmp_path), 'body')
+    for w, (doc_ids, tfs) in index.posting_arrays_iter(str(tmp_path)):
+        assert list(zip(doc_ids.tolist(), tfs.tolist())) == postings[w]
+    squares = expected_norms(expected, postings)
+    doc_ids = sorted(squares)
+    np.testing.assert_allclose(index.doc_norm.lookup(np.array(doc_ids)), np.sqrt([squares[d] for d in doc_ids]), rtol=1e-6)
+    assert not (tmp_path / '_body_runs').exists()
+    # the block-max bounds are the ones of the in-memory writer, min_dl included
+    index.load_block_max(str(tmp_path))
+    for w, pl in postings.items():
+        expected_bounds = block_max_bounds([doc_id for doc_id, _ in pl], [tf for _, tf in pl], expected.doc_len)
+        for field in expected_bounds.dtype.names:
+            np.testing.assert_array_equal(index.block_max[w][field], expected_bounds[field])
+
+
+def test_the_block_and_flush_sizes_do_not_change_the_index(tmp_path, monkeypatch):
+    docs = random_docs(300, seed=1)
+    build_index(docs, tmp_path / 'default', 'body', workers=2, memory_budget=40_000, num_buckets=4)
+    monkeypatch.setattr(index_builder, 'SPILL_BLOCK_POSTINGS', 1)
+    monkeypatch.setattr(index_builder, 'NORM_FLUSH_POSTINGS', 1)
+    build_index(docs, tmp_path / 'small', 'body', workers=2, memory_budget=40_000, num_buckets=4)
+    for name in sorted(os.listdir(tmp_path / 'default')):
+        if name.endswith('.bin'):
+            assert (tmp_path / 'default' / name).read_bytes() == (tmp_path / 'small' / name).read_bytes()
+
+
+def _dying_worker(*args):
+    os._exit(3)
+
+
+def test_a_dead_worker_fails_the_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_builder, '_tokenize_worker', _dying_worker)
+    monkeypatch.setattr(index_builder, 'WORKER_POLL_SECONDS', 0.1)
+    with pytest.raises(RuntimeError, match='exited with code 3'):
+        build_index(random_docs(200), tmp_path, 'body', workers=2, chunk_size=10)
+
+
+def test_a_dead_merge_worker_fails_the_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_builder, '_merge_bucket', _dying_worker)
+    with pytest.raises(RuntimeError, match='merge worker died'):
+        build_index(random_docs(200), tmp_path, 'body', workers=2, chunk_size=10)
+
+
+def test_the_anchor_text_is_indexed_under_the_linked_documents(tmp_path):
+    links = [{'id': 1, 'links': [{'id': 10, 'text': 'python programming'}, [20, 'python snake']]},
+             {'id': 2, 'links': [{'id': 10, 'text': 'python'}, {'id': 30, 'text': None}]},
+             {'id': 3, 'links': None}]
+    path = tmp_path / 'links.jsonl'
+    path.write_text(''.join(json.dumps(doc) + '\n' for doc in links))
+    anchors = list(index_builder.read_jsonl_anchors(path, 'links'))
+    assert anchors == [(10, 'python programming'), (20, 'python snake'), (10, 'python'), (30, '')]
+    index = build_index(anchors, tmp_path / 'anchor', 'anchor', workers=1)
+    python = tokenize('python')[0]
+    doc_ids, tfs = index.read_a_posting_array(str(tmp_path / 'anchor'), python)
+    # the links to a document add up
+    assert doc_ids.tolist() == [10, 20] and tfs.tolist() == [2, 1]
+    assert index.doc_len[10] == len(tokenize('python programming')) + 1
@@ -0,0 +1,126 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pickle
+import threading
+import urllib.parse
+import numpy as np
+import pytest
+from inverted_index_gcp import InvertedIndex, LocalBucket
+from load_test import (BODY_DIR, BODY_INDEX, PAGE_VIEWS_PATH, QUERIES_FILE, TITLE_DIR, TITLE_INDEX, TITLES_PATH,
+                       generate_corpus, query_mixes, replay, report, synthetic_vocabulary, zipf_probabilities)
+from text_Modification import tokenize
+
+
+def test_synthetic_vocabulary_is_one_distinct_token_per_word():
+    words = synthetic_vocabulary(500, np.random.default_rng(0))
+    assert len(words) == 500
+    stems = [tokenize(word) for word in words]
+    assert all(len(tokens) == 1 for tokens in stems)
+    assert len({tokens[0] for tokens in stems}) == 500
+
+
+def test_zipf_probabilities_sum_to_one_and_decrease():
+    p = zipf_probabilities(1_000)
+    assert p.sum() == pytest.approx(1.0)
+    assert np.all(np.diff(p) < 0)
+    assert p[0] / p[9] == pytest.approx(10 ** 1.07)
+
+
+def test_query_mixes():
+    words = [f'w{i}' for i in range(1_000)]
+    mixes = query_mixes(words, np.random.default_rng(0), n_queries=300)
+    assert set(mixes) == {'short', 'long', 'head', 'tail'}
+    sizes = {mix: [len(query.split()) for query in queries] for mix, queries in mixes.items()}
+    assert all(len(queries) == 300 for queries in mixes.values())
+    assert set(sizes['short']) == {1, 2}
+    assert set(sizes['long']) == {3, 4, 5}
+    rank = {w: i for i, w in enumerate(words)}
+    used = {mix: [rank[w] for query in queries for w in query.split()] for mix, queries in mixes.items()}
+    # the 20 stopword like words are never queried
+    assert min(min(ranks) for ranks in used.values()) >= 20
+    assert max(used['head']) < 120
+    assert min(used['tail']) >= 500
+
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('corpus')
+    body, title = generate_corpus(data_dir, n_docs=1_000, vocab_size=800, body_len=30)
+    return data_dir, body, title
+
+
+def test_generate_corpus_writes_the_bucket_layout(corpus):
+    data_dir, body, title = corpus
+    bucket = LocalBucket(data_dir)
+    for index_dir, name, written in ((BODY_DIR, BODY_INDEX, body), (TITLE_DIR, TITLE_INDEX, title)):
+        index = InvertedIndex.read_index(index_dir, name, bucket)
+        assert index.N == 1_000
+        assert index.df == written.df
+        assert sum(index.doc_len.values()) == index.unique_terms
+        # every posting list decodes to df sorted documents whose tfs add up to the term total
+        for w in list(index.df)[:50]:
+            doc_ids, tfs = index.read_a_posting_array(index_dir, w, bucket)
+            assert len(doc_ids) == index.df[w]
+            assert np.all(np.diff(doc_ids) > 0)
+            assert int(tfs.sum()) == index.term_total[w]
+    with open(data_dir / TITLES_PATH, 'rb') as f:
+        titles = pickle.load(f)
+    with open(data_dir / PAGE_VIEWS_PATH, 'rb') as f:
+        page_views = pickle.load(f)
+    assert set(titles) == set(page_views) == set(body.doc_len)
+    with open(data_dir / QUERIES_FILE) as f:
+        mixes = json.load(f)
+    assert set(mixes) == {'short', 'long', 'head', 'tail'}
+
+
+def test_generate_corpus_is_seeded(corpus, tmp_path):
+    data_dir, body, _ = corpus
+    again, _ = generate_corpus(tmp_path, n_docs=1_000, vocab_size=800, body_len=30)
+    assert again.df == body.df and again.doc_len == body.doc_len
+    assert (tmp_path / QUERIES_FILE).read_text() == (data_dir / QUERIES_FILE).read_text()
+
+
+class EchoServer(ThreadingHTTPServer):
+    """ Answers every GET with 200, or with 500 for a query in `failing`, and keeps the queries. """
+    daemon_threads = True
+
+    def __init__(self, failing=()):
+        self.queries, self.lock = [], threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)['query'][0]
+                with self.lock:
+                    self.queries.append(query)
+                handler.send_response(500 if query in failing else 200)
+                handler.send_header('Content-Length', '2')
+                handler.end_headers()
+                handler.wfile.write(b'[]')
+
+            def log_message(handler, *args):
+                pass
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def test_replay_sends_every_query_once_and_counts_errors():
+    queries = [f'query {i}' for i in range(50)]
+    server = EchoServer(failing={'query 3', 'query 7'})
+    try:
+        latencies, wall, errors = replay(server.url, '/search', queries, concurrency=4)
+    finally:
+        server.shutdown()
+    assert sorted(server.queries) == sorted(queries)
+    assert errors == 2
+    assert len(latencies) == 50 and np.all(latencies > 0)
+    assert wall >= latencies.max()
+
+
+def test_report(capsys):
+    report('/search', 'short', np.array([0.001, 0.002, 0.003, 0.004]), 2.0, 1, bytes_read=4 * 2048)
+    out = capsys.readouterr().out
+    assert out.startswith('/search  short: 4 queries')
+    assert 'p50    2.50ms' in out and '2.0 QPS' in out and 'read/query 2.0KB' in out and 'errors 1' in out
+    report('/search', 'head', np.array([0.001]), 1.0, 0)
+    assert 'read/query n/a' in capsys.readouterr().out
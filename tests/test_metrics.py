@@ -0,0 +1,53 @@
+import time
+from metrics import Registry, RequestProfile, add_time, timed
+
+
+def test_the_profile_adds_up_stage_times_and_counters():
+    profile = RequestProfile()
+    add_time(profile, 'score', 0.002)
+    add_time(profile, 'score', 0.003)
+    with timed(profile, 'read'):
+        time.sleep(0.01)
+    profile['postings_scored'] += 7
+    res = profile.as_dict()
+    assert list(res['stages_ms']) == ['score', 'read']
+    assert res['stages_ms']['score'] == 5.0 and res['stages_ms']['read'] >= 10
+    assert res['counters'] == {'postings_scored': 7}
+    # plain stats are left alone
+    stats = {}
+    add_time(stats, 'score', 1.0)
+    with timed(None, 'score'):
+        pass
+    assert stats == {}
+
+
+def test_render_counters_and_histograms():
+    registry = Registry()
+    requests = registry.counter('requests_total', "Requests.", ['endpoint', 'status'])
+    latency = registry.histogram('request_seconds', "Latency.", ['endpoint'], buckets=(0.1, 1.0))
+    requests.inc(endpoint='search', status=200)
+    requests.inc(2, endpoint='search', status=200)
+    requests.inc(endpoint='search', status=503)
+    for seconds in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(seconds, endpoint='search')
+    lines = registry.render().splitlines()
+    assert lines[:4] == ['# HELP requests_total Requests.', '# TYPE requests_total counter',
+                         'requests_total{endpoint="search",status="200"} 3',
+                         'requests_total{endpoint="search",status="503"} 1']
+    # buckets are cumulative and their bounds are inclusive
+    assert lines[4:] == ['# HELP request_seconds Latency.', '# TYPE request_seconds histogram',
+                         'request_seconds_bucket{endpoint="search",le="0.1"} 2',
+                         'request_seconds_bucket{endpoint="search",le="1.0"} 3',
+                         'request_seconds_bucket{endpoint="search",le="+Inf"} 4',
+                         'request_seconds_sum{endpoint="search"} 3.65',
+                         'request_seconds_count{endpoint="search"} 4']
+
+
+def test_render_gauges_and_skips_the_failing_ones():
+    registry = Registry()
+    registry.gauge('cache', "Cache counters.", lambda: [(('hits',), 3), (('misses',), 1)], ['kind'])
+    registry.gauge('bytes_read_total', "Bytes.", lambda: 10, kind='counter')
+    registry.gauge('not_loaded', "Missing.", lambda: 1 / 0)
+    assert registry.render().splitlines() == [
+        '# HELP cache Cache counters.', '# TYPE cache gauge', 'cache{kind="hits"} 3', 'cache{kind="misses"} 1',
+        '# HELP bytes_read_total Bytes.', '# TYPE bytes_read_total counter', 'bytes_read_total 10']
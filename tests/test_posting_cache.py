@@ -0,0 +1,85 @@
+import json
+import numpy as np
+import pytest
+from posting_cache import ENTRY_OVERHEAD, PostingCache, hot_terms, load_query_log, prewarm
+
+
+def posting(n, start=0):
+    return np.arange(start, start + n, dtype=np.int64), np.ones(n, dtype=np.int64)
+
+
+# the cached size of a posting(100)
+SIZE = 2 * 800 + ENTRY_OVERHEAD
+
+
+def test_the_byte_budget_evicts_the_least_recently_used_lists():
+    cache = PostingCache(2 * SIZE + 10)
+    cache.put('body', 'a', posting(100))
+    cache.put('body', 'b', posting(100))
+    assert cache.get('body', 'a') is not None
+    cache.put('title', 'a', posting(100))
+    assert cache.get('body', 'b') is None and ('body', 'a') in cache and ('title', 'a') in cache
+    # a list bigger than the whole budget is not cached, and does not evict the others
+    cache.put('body', 'huge', posting(1000))
+    assert ('body', 'huge') not in cache and cache.stats()['entries'] == 2
+    # caching a list again replaces it
+    cache.put('body', 'a', posting(100, start=5))
+    assert cache.get('body', 'a')[0][0] == 5
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 1, 'hit_rate': 2 / 3, 'entries': 2, 'bytes': 2 * SIZE}
+    cache.clear()
+    assert cache.stats()['bytes'] == 0 and cache.get('body', 'a') is None
+
+
+def test_cached_arrays_are_read_only():
+    cache = PostingCache(10 * SIZE)
+    cache.put('body', 'a', posting(100))
+    doc_ids, _ = cache.get('body', 'a')
+    with pytest.raises(ValueError):
+        doc_ids[0] = 7
+
+
+def test_get_many_loads_the_missing_lists_together():
+    cache = PostingCache(10 * SIZE)
+    cache.put('body', 'a', posting(100))
+    loads = []
+
+    def load_many(terms):
+        loads.append(terms)
+        return {term: posting(100, start=i) for i, term in enumerate(terms)}
+    got = cache.get_many('body', ['b', 'a', 'c', 'b'], load_many)
+    assert loads == [['b', 'c']] and list(got) == ['a', 'b', 'c']
+    assert cache.get_many('body', ['c', 'b'], load_many).keys() == {'b', 'c'} and len(loads) == 1
+
+
+def test_prewarm_reads_the_lists_that_are_not_cached(tmp_path, build_engine):
+    engine, terms = build_engine(tmp_path, n_terms=20)
+    index, base_dir = engine.body_index, engine.body_dir
+    cache = PostingCache(2 ** 30)
+    try:
+        assert prewarm(cache, 'body', index, base_dir, terms[:5] + ['unknown']) == 5
+        reads = index.reader_stats()['ranges']
+        assert prewarm(cache, 'body', index, base_dir, terms[:8]) == 8
+        # only the 3 new lists were read
+        assert index.reader_stats()['ranges'] == reads + 3
+        expected = index.read_posting_arrays(base_dir, terms[:8])
+        for term in terms[:8]:
+            np.testing.assert_array_equal(cache.get('body', term)[0], expected[term][0])
+    finally:
+        engine.close()
+
+
+def test_hot_terms_count_a_term_once_per_query():
+    queries = ['python python python python', 'java script', 'java beans', 'java']
+    assert hot_terms(queries, 2) == ['java', 'python']
+    assert hot_terms(queries, 1) == ['java']
+
+
+def test_load_query_log_formats(tmp_path):
+    (tmp_path / 'train.json').write_text(json.dumps({'hello world': [1, 2], 'python': [3]}))
+    assert load_query_log(tmp_path / 'train.json') == ['hello world', 'python']
+    (tmp_path / 'list.json').write_text(json.dumps(['a b', 'c']))
+    assert load_query_log(tmp_path / 'list.json') == ['a b', 'c']
+    rows = ['"plain"', '', '{"query": "by query"}', '{"title": "by title"}',
+            '{"query": "query wins", "title": "not this"}', '{"clicks": 3}', '{"ts": 1, "user": "u"}']
+    (tmp_path / 'log.jsonl').write_text('\n'.join(rows) + '\n')
+    assert load_query_log(tmp_path / 'log.jsonl') == ['plain', 'by query', 'by title', 'query wins']
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from inverted_index_gcp import (PACKED_MIN_POSTINGS, TUPLE_SIZE, InvertedIndex, _posting_bytes,
+                                decode_posting_list, encode_posting_list, is_compressed)
+
+
+def random_postings(n, seed=0, max_gap=1000, max_tf=20):
+    rng = np.random.default_rng(seed)
+    doc_ids = np.cumsum(rng.integers(1, max_gap, size=n))
+    tfs = rng.integers(1, max_tf, size=n)
+    return doc_ids, tfs
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 127, 1000])
+def test_compressed_round_trip(n):
+    doc_ids, tfs = random_postings(n)
+    b = encode_posting_list(doc_ids, tfs)
+    assert is_compressed(b)
+    got_ids, got_tfs = decode_posting_list(b, n)
+    np.testing.assert_array_equal(got_ids, doc_ids)
+    np.testing.assert_array_equal(got_tfs, tfs)
+
+
+def test_compressed_round_trip_with_exceptions():
+    # a few huge gaps and tfs do not fit the width chosen for the others
+    doc_ids, tfs = random_postings(5000, seed=1, max_gap=50, max_tf=5)
+    doc_ids[2500:] += 2 ** 40
+    doc_ids[4000:] += 2 ** 20
+    tfs[[0, 17, 4999]] = [70_000, 2 ** 33, 300]
+    got_ids, got_tfs = decode_posting_list(encode_posting_list(doc_ids, tfs), len(doc_ids))
+    np.testing.assert_array_equal(got_ids, doc_ids)
+    np.testing.assert_array_equal(got_tfs, tfs)
+
+
+def test_compressed_sorts_by_doc_id():
+    got_ids, got_tfs = decode_posting_list(encode_posting_list([30, 10, 20], [3, 1, 2]), 3)
+    assert got_ids.tolist() == [10, 20, 30]
+    assert got_tfs.tolist() == [1, 2, 3]
+
+
+def test_short_lists_stay_in_the_6_bytes_format():
+    doc_ids, tfs = random_postings(PACKED_MIN_POSTINGS - 1)
+    b = _posting_bytes(doc_ids, tfs, compressed=True)
+    assert not is_compressed(b)
+    assert len(b) == TUPLE_SIZE * len(doc_ids)
+    doc_ids, tfs = random_postings(PACKED_MIN_POSTINGS)
+    assert is_compressed(_posting_bytes(doc_ids, tfs, compressed=True))
+    assert not is_compressed(_posting_bytes(doc_ids, tfs))
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_write_and_read_posting_lists(tmp_path, compressed):
+    lists = {'short': random_postings(10, seed=2), 'long': random_postings(PACKED_MIN_POSTINGS + 5, seed=3)}
+    InvertedIndex.write_a_posting_list((0, list(lists.items())), str(tmp_path), compressed=compressed)
+    index = InvertedIndex()
+    index.posting_locs.update(InvertedIndex._read_bucket_pickle(str(tmp_path), 0, 'posting_locs'))
+    index.df.update({w: len(doc_ids) for w, (doc_ids, _) in lists.items()})
+    index.load_posting_nbytes(str(tmp_path))
+    assert (index.posting_nbytes['long'] < TUPLE_SIZE * index.df['long']) == compressed
+    postings = index.read_posting_arrays(str(tmp_path), list(lists))
+    for w, (doc_ids, tfs) in lists.items():
+        np.testing.assert_array_equal(postings[w][0], doc_ids)
+        np.testing.assert_array_equal(postings[w][1], tfs)
+
+
+def reference_decode(b, n):
+    # the per posting loop decode_posting_list replaced: 4 bytes doc id, 2 bytes tf, big-endian
+    return [(int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big'),
+             int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')) for i in range(n)]
+
+
+@pytest.mark.parametrize('as_type', [bytes, bytearray, memoryview])
+def test_decode_matches_the_per_posting_loop(as_type):
+    doc_ids, tfs = random_postings(500, seed=4, max_gap=2 ** 22, max_tf=2 ** 16)
+    b = _posting_bytes(doc_ids, tfs)
+    # the reader hands back whatever buffer it read, which may be longer than the list
+    got_ids, got_tfs = decode_posting_list(as_type(b + b'\x00' * TUPLE_SIZE), len(doc_ids))
+    assert got_ids.dtype == got_tfs.dtype == np.int64
+    assert list(zip(got_ids.tolist(), got_tfs.tolist())) == reference_decode(b, len(doc_ids))
+    np.testing.assert_array_equal(got_ids, doc_ids)
+    np.testing.assert_array_equal(got_tfs, tfs)
+
+
+def test_tfs_keep_their_16_low_bits():
+    got_ids, got_tfs = decode_posting_list(_posting_bytes(np.array([1, 2]), np.array([65_535, 65_537])), 2)
+    assert got_ids.tolist() == [1, 2] and got_tfs.tolist() == [65_535, 1]
+
+
+def test_tuple_and_array_apis_read_the_same_lists(tmp_path):
+    lists = {f'w{i}': random_postings(20 * i + 1, seed=i) for i in range(5)}
+    InvertedIndex.write_a_posting_list((0, list(lists.items())), str(tmp_path))
+    index = InvertedIndex()
+    index.posting_locs.update(InvertedIndex._read_bucket_pickle(str(tmp_path), 0, 'posting_locs'))
+    index.df.update({w: len(doc_ids) for w, (doc_ids, _) in lists.items()})
+    expected = {w: list(zip(doc_ids.tolist(), tfs.tolist())) for w, (doc_ids, tfs) in lists.items()}
+    assert dict(index.posting_lists_iter(str(tmp_path))) == expected
+    assert {w: list(zip(ids.tolist(), tfs.tolist())) for w, (ids, tfs) in index.posting_arrays_iter(str(tmp_path))} == expected
+    assert index.read_a_posting_list(str(tmp_path), 'w3') == expected['w3']
+    assert index.read_a_posting_list(str(tmp_path), 'missing') == []
+    doc_ids, tfs = index.read_a_posting_array(str(tmp_path), 'missing')
+    assert len(doc_ids) == len(tfs) == 0 and doc_ids.dtype == np.int64
@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import inverted_index_gcp
+from inverted_index_gcp import PostingReader
+
+
+@pytest.fixture
+def posting_files(tmp_path):
+    files = {f'{i}_000.bin': bytes(range(i, i + 200)) for i in range(4)}
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+    return tmp_path, files
+
+
+def recording(reader):
+    """ Makes the reader keep every file it opens in the returned list. """
+    opened = []
+    open_pooled = reader._open_pooled
+
+    def recording_open(path):
+        opened.append(open_pooled(path))
+        return opened[-1]
+    reader._open_pooled = recording_open
+    return opened
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_overlapping_ranges_of_a_file_are_read_once(posting_files, use_mmap):
+    tmp_path, files = posting_files
+    reader = PostingReader(tmp_path, use_mmap=use_mmap)
+    requests = [([('0_000.bin', 10)], 20), ([('0_000.bin', 25)], 10), ([('0_000.bin', 100)], 10), ([('1_000.bin', 0)], 5)]
+    got = reader.read_many(requests)
+    assert [bytes(b) for b in got] == [files[f][offset:offset + n] for [(f, offset)], n in requests]
+    stats = reader.stats()
+    assert (stats['ranges'], stats['reads'], stats['reads_saved']) == (4, 3, 1)
+    assert (stats['bytes_read'], stats['bytes_saved'], stats['bytes_gap']) == (25 + 10 + 5, 5, 0)
+    assert (stats['opens'], stats['opens_saved']) == (2, 1)
+    reader.close()
+
+
+def test_ranges_close_enough_are_read_together(posting_files):
+    tmp_path, files = posting_files
+    reader = PostingReader(tmp_path, max_gap=100)
+    got = reader.read_many([([('0_000.bin', 100)], 10), ([('0_000.bin', 10)], 20), ([('0_000.bin', 180)], 20)])
+    assert got == [files['0_000.bin'][100:110], files['0_000.bin'][10:30], files['0_000.bin'][180:200]]
+    stats = reader.stats()
+    assert (stats['reads'], stats['reads_saved'], stats['bytes_read'], stats['bytes_gap']) == (1, 2, 190, 140)
+    reader.close()
+
+
+def test_a_list_that_spans_files(posting_files, monkeypatch):
+    tmp_path, files = posting_files
+    monkeypatch.setattr(inverted_index_gcp, 'BLOCK_SIZE', 200)
+    reader = PostingReader(tmp_path)
+    assert reader.read([('0_000.bin', 190), ('1_000.bin', 0)], 15) == files['0_000.bin'][190:] + files['1_000.bin'][:5]
+    reader.close()
+
+
+def test_least_recently_used_files_are_closed(posting_files):
+    tmp_path, files = posting_files
+    reader = PostingReader(tmp_path, max_open_files=2)
+    opened = recording(reader)
+    for name in ('0_000.bin', '1_000.bin', '0_000.bin', '2_000.bin'):
+        assert reader.read([(name, 3)], 4) == files[name][3:7]
+    # 1 was the least recently used when 2 was opened
+    assert [f.closed for f in opened] == [False, True, False]
+    assert sorted(pooled.path.rsplit('/', 1)[-1] for pooled in reader._pool.values()) == ['0_000.bin', '2_000.bin']
+    reader.read([('1_000.bin', 0)], 1)
+    stats = reader.stats()
+    assert (stats['opens'], stats['opens_saved']) == (4, 1)
+    reader.close()
+    assert all(f.closed for f in opened)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_threads_share_a_small_pool(posting_files, use_mmap):
+    tmp_path, files = posting_files
+    reader = PostingReader(tmp_path, max_open_files=2, use_mmap=use_mmap)
+    opened = recording(reader)
+    names = sorted(files)
+    requests = [(names[i % len(names)], i % 150, 1 + i % 50) for i in range(2000)]
+
+    def read(request):
+        name, offset, n = request
+        return bytes(reader.read([(name, offset)], n)) == files[name][offset:offset + n]
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(read, requests))
+    assert len(reader._pool) <= 2
+    reader.close()
+    if not use_mmap:
+        assert all(f.closed for f in opened)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_a_file_evicted_before_it_is_read_is_not_reopened_outside_the_pool(posting_files, use_mmap):
+    tmp_path, files = posting_files
+    reader = PostingReader(tmp_path, use_mmap=use_mmap)
+    opened = recording(reader)
+    acquire = reader._acquire
+    evictions = []
+
+    def evicting_acquire(path):
+        # another thread evicts every file right after this one took it from the pool, once
+        pooled = acquire(path)
+        if not evictions:
+            evictions.append(path)
+            reader.close()
+        return pooled
+    reader._acquire = evicting_acquire
+    assert bytes(reader.read([('0_000.bin', 10)], 20)) == files['0_000.bin'][10:30]
+    # the only file opened is the one in the pool
+    assert len(opened) == 1 and [pooled.f for pooled in reader._pool.values()] == [opened[0]]
+    reader.close()
+    if not use_mmap:
+        assert all(f.closed for f in opened)
@@ -0,0 +1,253 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import math
+from pathlib import Path
+import threading
+import time
+import numpy as np
+import pytest
+from doc_table import DocColumn
+import inverted_index_gcp
+from inverted_index_gcp import block_max_bounds, posting_impacts
+from query_engine import IO_WORKERS, QueryEngine, rank_by_distinct_terms
+
+
+def random_queries(terms, n=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.choice(terms, size=rng.integers(1, 5), replace=False).tolist() for _ in range(n)]
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory, build_engine):
+    engine, terms = build_engine(tmp_path_factory.mktemp('engine'))
+    yield engine, terms
+    engine.close()
+
+
+def champion_engine(build_engine, root, champion_size):
+    engine, terms = build_engine(root)
+    out_dir = Path(root) / 'body_champions'
+    out_dir.mkdir()
+    engine.body_index.convert_postings(engine.body_dir, str(out_dir), pagerank=engine.pagerank_scores,
+                                       page_views=engine.page_views, champion_size=champion_size, champion_min_df=1_000)
+    engine.body_dir = str(out_dir)
+    return engine, terms
+
+
+def assert_same_results(got, expected):
+    # (doc_id, score) pairs, best first
+    assert [doc_id for doc_id, _ in got] == [doc_id for doc_id, _ in expected]
+    np.testing.assert_allclose([score for _, score in got], [score for _, score in expected])
+
+
+@pytest.mark.parametrize('k', [1, 10, 100])
+def test_bmw_matches_exhaustive(engine, k):
+    engine, terms = engine
+    stats = Counter()
+    for query in random_queries(terms):
+        expected = engine.search(query, k, 'exhaustive', with_scores=True)
+        assert_same_results(engine.search(query, k, 'bmw', stats, with_scores=True), expected)
+    assert stats['postings_scored'] > 0
+
+
+@pytest.mark.parametrize('method', ['exhaustive', 'bmw'])
+def test_search_batch_matches_search(engine, method):
+    engine, terms = engine
+    rng = np.random.default_rng(3)
+    # the queries share terms, repeat some and one is empty
+    queries = [rng.choice(terms[:20], size=rng.integers(1, 4)).tolist() for _ in range(30)] + [[]]
+    stats = Counter()
+    batch = engine.search_batch(queries, 100, method, stats)
+    assert [list(res) for res in batch] == [list(engine.search(query, 100, method)) for query in queries]
+    assert stats['postings_scored'] > 0
+
+
+def test_bmw_is_exact_with_other_static_scores_than_at_write_time(engine, monkeypatch):
+    engine, terms = engine
+    # new PageRank and page views files, where documents the saved block maxima call weak are strong
+    rng = np.random.default_rng(3)
+    doc_ids = np.array(sorted(engine.pagerank_scores))
+    boosted = dict(zip(doc_ids.tolist(), (rng.pareto(1.0, len(doc_ids)) * 5).tolist()))
+    monkeypatch.setattr(engine, 'pagerank_scores', boosted)
+    monkeypatch.setattr(engine, 'page_views', DocColumn.from_dict(boosted, dtype=np.float64))
+    for query in random_queries(terms, seed=2):
+        expected = engine.search(query, 10, 'exhaustive', with_scores=True)
+        assert_same_results(engine.search(query, 10, 'bmw', with_scores=True), expected)
+    # and back, the bounds kept for the new scores are not reused
+    monkeypatch.undo()
+    for query in random_queries(terms, seed=2):
+        assert_same_results(engine.search(query, 10, 'bmw', with_scores=True),
+                            engine.search(query, 10, 'exhaustive', with_scores=True))
+
+
+def test_repeated_tokens_count_again(engine):
+    engine, terms = engine
+    once = engine.search(terms[:2], 10, with_scores=True)
+    twice = engine.search(terms[:2] + terms[:1], 10, with_scores=True)
+    assert once != twice
+    assert_same_results(engine.search(terms[:2] + terms[:1], 10, 'bmw', with_scores=True), twice)
+
+
+def test_champions_with_whole_lists_as_tiers_match_exhaustive(tmp_path, build_engine):
+    engine, terms = champion_engine(build_engine, tmp_path, champion_size=100_000)
+    assert engine.body_index.champions
+    try:
+        for query in random_queries(terms, seed=1):
+            expected = engine.search(query, 100, 'exhaustive', with_scores=True)
+            assert_same_results(engine.search(query, 100, 'champions', with_scores=True), expected)
+    finally:
+        engine.close()
+
+
+def test_champions_fall_back_to_the_full_lists(tmp_path, build_engine):
+    engine, terms = champion_engine(build_engine, tmp_path, champion_size=20)
+    tiered = [term for term in terms if term in engine.body_index.champions]
+    try:
+        # no tier holds enough documents for such a k, so the full lists are always read
+        k = 10 ** 6
+        stats = Counter()
+        for query in random_queries(tiered, n=10, seed=2):
+            expected = engine.search(query, k, 'exhaustive', with_scores=True)
+            assert_same_results(engine.search(query, k, 'champions', stats, with_scores=True), expected)
+        assert stats['champion_fallbacks'] == 10
+    finally:
+        engine.close()
+
+
+def test_unknown_method(engine):
+    engine, terms = engine
+    with pytest.raises(ValueError):
+        engine.search(terms[:1], method='wand')
+
+
+def test_bounds_and_impacts_are_the_same_with_columns_and_dicts():
+    rng = np.random.default_rng(3)
+    all_ids = np.sort(rng.choice(10 ** 6, size=5_000, replace=False))
+    lengths = dict(zip(all_ids.tolist(), rng.integers(1, 500, size=len(all_ids)).tolist()))
+    pagerank = dict(zip(all_ids.tolist(), rng.random(len(all_ids)).tolist()))
+    columns = [DocColumn.from_dict(values, dtype=dtype) for values, dtype in ((lengths, np.int32), (pagerank, np.float64))]
+    # some postings have documents without a length or PageRank
+    doc_ids = np.sort(np.concatenate([rng.choice(all_ids, size=1_000, replace=False), [10 ** 6 + 1, 10 ** 6 + 7]]))
+    tfs = rng.integers(1, 30, size=len(doc_ids))
+    expected = block_max_bounds(doc_ids, tfs, lengths, pagerank, pagerank)
+    got = block_max_bounds(doc_ids, tfs, columns[0], columns[1], columns[1])
+    for field in expected.dtype.names:
+        np.testing.assert_array_equal(got[field], expected[field])
+    np.testing.assert_allclose(posting_impacts(doc_ids, tfs, columns[0], 250.0, 1.5, columns[1]),
+                               posting_impacts(doc_ids, tfs, lengths, 250.0, 1.5, pagerank))
+
+
+def test_reads_that_finish_out_of_order_score_the_same(engine, monkeypatch):
+    engine, terms = engine
+    queries = random_queries(terms, n=10, seed=4)
+    expected = [engine.search(query, 100, with_scores=True) for query in queries]
+    fetch = engine.fetch_postings
+    slow_terms = set()
+
+    def fetch_postings(index, group, dir_name):
+        # the lists of the first token of a query arrive last
+        if slow_terms.intersection(group):
+            time.sleep(0.05)
+        return fetch(index, group, dir_name)
+    monkeypatch.setattr(engine, 'fetch_postings', fetch_postings)
+    for query, want in zip(queries, expected):
+        slow_terms.clear()
+        slow_terms.add(query[0])
+        # the scores are summed in token order whatever order the reads finish in
+        assert engine.search(query, 100, with_scores=True) == want
+
+
+def test_concurrent_searches_share_the_io_pool(engine):
+    engine, terms = engine
+    queries = random_queries(terms, n=64, seed=5)
+    expected = [engine.search(query, 100) for query in queries]
+    fetch_threads = lambda: {thread for thread in threading.enumerate() if thread.name.startswith('fetch')}
+    before = fetch_threads()
+    with ThreadPoolExecutor(16) as pool:
+        assert list(pool.map(lambda query: engine.search(query, 100), queries)) == expected
+    # the requests read on the engine's pool, they do not start reading threads of their own
+    assert len(fetch_threads() - before) <= IO_WORKERS
+
+
+def test_an_engine_leaves_a_given_executor_running(engine):
+    engine, terms = engine
+    with ThreadPoolExecutor(2) as pool:
+        other = QueryEngine(engine.body_index, engine.body_dir, engine.title_index, engine.title_dir,
+                            engine.bm25_body, engine.bm25_title, engine.page_views, engine.pagerank_scores,
+                            engine.fetch_postings, executor=pool)
+        assert other.search(terms[:2], 10) == engine.search(terms[:2], 10)
+        other.close()
+        assert pool.submit(lambda: 1).result() == 1
+
+
+def reference_norms(index, base_dir):
+    # the squared TF-IDF weights summed document by document
+    squares = Counter()
+    for term, (doc_ids, tfs) in index.posting_arrays_iter(base_dir):
+        idf = math.log10(index.N / index.df[term])
+        for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist()):
+            squares[doc_id] += (tf * idf) ** 2
+    return {doc_id: math.sqrt(square) for doc_id, square in squares.items()}
+
+
+def test_doc_norms_are_the_tfidf_vector_lengths(engine, monkeypatch):
+    engine, _ = engine
+    index = engine.body_index
+    expected = reference_norms(index, engine.body_dir)
+    doc_ids = np.array(sorted(index.doc_len))
+    want = [expected.get(doc_id, 0.0) for doc_id in doc_ids.tolist()]
+    np.testing.assert_allclose(index.doc_norm.lookup(doc_ids), want, rtol=1e-6)
+    # the norms are the same when the postings are added in many small batches
+    norms = index.doc_norm
+    monkeypatch.setattr(inverted_index_gcp, 'NORM_BUFFER_POSTINGS', 1_000)
+    index.compute_doc_norms(engine.body_dir)
+    try:
+        np.testing.assert_allclose(index.doc_norm.lookup(doc_ids), want, rtol=1e-6)
+    finally:
+        index.doc_norm = norms
+
+
+def test_search_body_ranks_by_cosine_similarity(engine):
+    engine, terms = engine
+    index = engine.body_index
+    for query in random_queries(terms, n=10, seed=6) + [[terms[3], terms[3], terms[7]], [terms[2], 'unknown']]:
+        query_tf = Counter(query)
+        query_weights = {term: tf * math.log10(index.N / index.df[term]) if term in index.df else 0.0
+                         for term, tf in query_tf.items()}
+        query_norm = math.sqrt(sum(w ** 2 for w in query_weights.values()))
+        dot = Counter()
+        for term, (doc_ids, tfs) in index.read_posting_arrays(engine.body_dir, [t for t in query_tf if t in index.df]).items():
+            idf = math.log10(index.N / index.df[term])
+            for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist()):
+                dot[doc_id] += tf * idf * query_weights[term]
+        cosine = {doc_id: value / (index.doc_norm[doc_id] * query_norm) for doc_id, value in dot.items()}
+        expected = sorted(cosine, key=lambda doc_id: (-cosine[doc_id], doc_id))[:100]
+        stats = Counter()
+        got = engine.search_body(query, 100, stats)
+        assert got == expected
+        assert stats['candidates'] == len(dot)
+    assert engine.search_body([]) == [] and engine.search_body(['unknown']) == []
+
+
+def test_rank_by_distinct_terms_counts_the_terms_of_every_document():
+    rng = np.random.default_rng(7)
+    lists = [np.sort(rng.choice(300, size=size, replace=False)) for size in (120, 80, 200, 5)]
+    counts = Counter(doc_id for doc_ids in lists for doc_id in doc_ids.tolist())
+    doc_ids, got_counts = rank_by_distinct_terms(lists)
+    assert doc_ids.tolist() == sorted(counts, key=lambda doc_id: (-counts[doc_id], doc_id))
+    assert got_counts.tolist() == [counts[doc_id] for doc_id in doc_ids.tolist()]
+    assert len(rank_by_distinct_terms([])[0]) == 0
+
+
+def test_search_distinct_returns_every_document_with_a_query_term(engine):
+    engine, terms = engine
+    index = engine.title_index
+    # a repeated token counts once, an unknown one not at all
+    query = [terms[1], terms[5], terms[1], terms[9], 'unknown']
+    postings = index.read_posting_arrays(engine.title_dir, [terms[1], terms[5], terms[9]])
+    counts = Counter(doc_id for doc_ids, _ in postings.values() for doc_id in doc_ids.tolist())
+    stats = Counter()
+    doc_ids, got_counts = engine.search_distinct(query, index, engine.title_dir, stats)
+    assert doc_ids.tolist() == sorted(counts, key=lambda doc_id: (-counts[doc_id], doc_id))
+    assert got_counts.max() <= 3 and stats['candidates'] == len(counts)
+    assert len(engine.search_distinct(['unknown'], index, engine.title_dir)[0]) == 0
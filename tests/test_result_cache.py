@@ -0,0 +1,91 @@
+import posting_cache
+from posting_cache import ResultCache, normalized_query
+from query_engine import QueryEngine
+from text_Modification import analyze, tokenize
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hits_and_least_recently_used_eviction():
+    cache = ResultCache(2, ttl=60)
+    cache.put('a', 1, [1])
+    cache.put('b', 1, [2])
+    assert cache.get('a', 1) == [1]
+    cache.put('c', 1, [3])
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == [1] and cache.get('c', 1) == [3]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (3, 1, 1, 2)
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(posting_cache.time, 'monotonic', clock)
+    cache = ResultCache(10, ttl=60)
+    cache.put('a', 1, [1])
+    clock.now += 59
+    assert cache.get('a', 1) == [1]
+    clock.now += 2
+    assert cache.get('a', 1) is None
+    assert cache.stats()['expirations'] == 1 and cache.stats()['entries'] == 0
+
+
+def test_a_new_version_only_misses_the_entries_of_the_old_one():
+    cache = ResultCache(10, ttl=60)
+    cache.put('a', 'old', [1])
+    cache.put('b', 'old', [2])
+    # a new engine: 'a' is computed again, 'b' was not looked up yet
+    assert cache.get('a', 'new') is None
+    cache.put('a', 'new', [10])
+    assert cache.get('a', 'new') == [10]
+    assert cache.get('b', 'old') == [2]
+    assert cache.stats()['invalidations'] == 1
+    # a request still running on the old engine does not drop the new result
+    assert cache.get('a', 'old') is None
+    assert cache.get('a', 'new') == [10]
+
+
+def test_the_ranking_version_changes_with_the_engine_and_its_tuning(tmp_path, build_engine):
+    engine, _ = build_engine(tmp_path, n_terms=8)
+    # a new engine over the same indices, like after a swap
+    other = QueryEngine(engine.body_index, engine.body_dir, engine.title_index, engine.title_dir,
+                        engine.bm25_body, engine.bm25_title, engine.page_views, engine.pagerank_scores,
+                        engine.fetch_postings)
+    try:
+        version = engine.ranking_version()
+        assert engine.ranking_version() == version
+        assert other.ranking_version() != version
+        engine.page_rank_tuner += 0.1
+        assert engine.ranking_version() != version
+        engine.page_rank_tuner -= 0.1
+        engine.bm25_body.k1 += 0.1
+        assert engine.ranking_version() != version
+    finally:
+        engine.close()
+        other.close()
+
+
+def test_clear():
+    cache = ResultCache(10, ttl=60)
+    cache.put('a', 1, [1])
+    cache.clear()
+    assert cache.get('a', 1) is None
+
+
+def test_reorderings_share_a_key_and_repeats_do_not():
+    assert normalized_query(tokenize('hello world')) == normalized_query(tokenize('World, HELLO'))
+    assert normalized_query(tokenize('hello world')) != normalized_query(tokenize('hello world hello'))
+
+
+def test_analyze_is_tokenize_memoized():
+    analyze.cache_clear()
+    tokens = analyze('The Running Dogs')
+    assert tokens == tuple(tokenize('The Running Dogs'))
+    assert analyze('The Running Dogs') is tokens
+    assert analyze.cache_info().hits == 1
@@ -0,0 +1,156 @@
+import random
+import numpy as np
+import pytest
+import segments
+from segments import SegmentSet, add_segment, init, merge_segments, pick_merge
+from BM25 import BM25
+from index_builder import build_index
+from inverted_index_gcp import InvertedIndex
+from posting_cache import PostingCache, prewarm
+from query_engine import BODY_K1, TITLE_B, QueryEngine
+from text_Modification import tokenize
+
+rng = random.Random(0)
+VOCAB = [''.join(rng.choice('bcdfghjklmnprstvz') + rng.choice('aeiou') for _ in range(3)) for _ in range(500)]
+WEIGHTS = [1 / (i + 1) for i in range(len(VOCAB))]
+
+
+def text(rng, n):
+    return ' '.join(rng.choices(VOCAB, WEIGHTS, k=n))
+
+
+def doc(rng, doc_id):
+    return doc_id, text(rng, rng.randint(1, 4)), text(rng, rng.randint(10, 80))
+
+
+def engine(body, body_dir, title, title_dir):
+    bm25_body = BM25(body.doc_len, body.df, body.N, body.unique_terms)
+    bm25_body.k1 = BODY_K1
+    bm25_title = BM25(title.doc_len, title.df, title.N, title.unique_terms)
+    bm25_title.b = TITLE_B
+    static = {doc_id: (doc_id % 97) / 10 for doc_id in range(2000)}
+    return QueryEngine(body, body_dir, title, title_dir, bm25_body, bm25_title, static, static,
+                       fetch_postings=lambda index, terms, dir_name: index.read_posting_arrays(dir_name, terms))
+
+
+def build_fields(docs, out_dir):
+    return {field: build_index(((doc_id, title if field == 'title' else body) for doc_id, title, body in docs),
+                               out_dir / index_dir, name, workers=2)
+            for field, index_dir, name in segments.FIELDS}
+
+
+def assert_same_as_rebuild(segment_set, docs, out_dir, queries):
+    """ Searching the segments gives the results (and scores) of one index of the live documents. """
+    indices = build_fields(docs.values(), out_dir)
+    rebuilt = engine(indices['body'], str(out_dir / 'body_index'), indices['title'], str(out_dir / 'title_index'))
+    segmented = engine(segment_set.body, segment_set.body.dir_name, segment_set.title, segment_set.title.dir_name)
+    try:
+        assert segment_set.body.N == len(docs)
+        for query in queries:
+            for method in ('exhaustive', 'bmw'):
+                got = segmented.search(query, 50, method, with_scores=True)
+                expected = rebuilt.search(query, 50, method, with_scores=True)
+                assert [doc_id for doc_id, _ in got] == [doc_id for doc_id, _ in expected]
+                np.testing.assert_allclose([s for _, s in got], [s for _, s in expected])
+    finally:
+        segmented.close()
+        rebuilt.close()
+
+
+@pytest.fixture
+def segment_root(tmp_path):
+    rng = random.Random(1)
+    docs = {doc_id: doc(rng, doc_id) for doc_id in range(400)}
+    build_fields(docs.values(), tmp_path / 'base')
+    init(tmp_path / 'root', tmp_path / 'base')
+
+    def add(new, deletes=()):
+        for doc_id in deletes:
+            docs.pop(doc_id, None)
+        docs.update((d[0], d) for d in new)
+        add_segment(tmp_path / 'root', new, deletes)
+    # new documents, edits of old ones, deletes of old ones and of a new one
+    add([doc(rng, doc_id) for doc_id in list(range(400, 450)) + list(range(0, 20))], list(range(20, 40)))
+    add([doc(rng, doc_id) for doc_id in range(400, 410)], [445, 100, 101])
+    add([], list(range(200, 300)))
+    queries = [tokenize(' '.join(rng.sample(VOCAB[:100], rng.randint(1, 3)))) for _ in range(25)]
+    return tmp_path, docs, queries
+
+
+def test_tombstones_hide_old_and_deleted_documents(segment_root):
+    tmp_path, docs, queries = segment_root
+    segment_set = SegmentSet(tmp_path / 'root')
+    assert len(segment_set.segments) == 4
+    assert [s['live'] for s in segment_set.stats()] == [400 - 20 - 20 - 2 - 100, 70 - 10 - 1, 10, 0]
+    # the base has no titles of its own, the server passes the titles of the whole corpus
+    titles = segment_set.titles({doc_id: 'base title' for doc_id in range(400)})
+    assert all(titles.get(doc_id) == (docs[doc_id][1] if doc_id < 20 or doc_id >= 400 else 'base title')
+               for doc_id in docs)
+    assert_same_as_rebuild(segment_set, docs, tmp_path / 'rebuilt', queries)
+
+
+def test_the_live_df_is_counted_when_the_segments_open(segment_root, monkeypatch):
+    tmp_path, docs, _ = segment_root
+    segment_set = SegmentSet(tmp_path / 'root')
+    rebuilt = build_fields(docs.values(), tmp_path / 'rebuilt')
+    # looking up the df reads no posting list
+    monkeypatch.setattr(InvertedIndex, 'read_posting_arrays', None)
+    for field in ('body', 'title'):
+        assert all(getattr(segment_set, field).df[w] == df for w, df in rebuilt[field].df.items())
+    # a new segment that deletes nothing old does not scan the older segments again
+    monkeypatch.undo()
+    rng = random.Random(2)
+    new = [doc(rng, doc_id) for doc_id in range(1000, 1010)]
+    add_segment(tmp_path / 'root', new)
+    monkeypatch.setattr(InvertedIndex, 'posting_arrays_iter', None)
+    reopened = segment_set.reopen()
+    term = tokenize(VOCAB[0])[0]
+    assert reopened.body.df[term] == segment_set.body.df[term] + sum(term in tokenize(body) for _, _, body in new)
+
+
+def test_the_live_df_is_a_mapping_of_the_live_terms(segment_root):
+    tmp_path, docs, _ = segment_root
+    segment_set = SegmentSet(tmp_path / 'root')
+    rebuilt = build_fields(docs.values(), tmp_path / 'rebuilt')
+    for field in ('body', 'title'):
+        df = getattr(segment_set, field).df
+        assert dict(df) == dict(rebuilt[field].df) and len(df) == len(rebuilt[field].df)
+    cache = PostingCache(2 ** 20)
+    assert prewarm(cache, 'body', segment_set.body, None, list(rebuilt['body'].df)[:5] + ['unknown']) == 5
+
+
+def test_merged_segments_search_like_a_rebuild(segment_root):
+    tmp_path, docs, queries = segment_root
+    segment_set = SegmentSet(tmp_path / 'root')
+    manifest = merge_segments(segment_set, [1, 2, 3])
+    assert len(manifest['segments']) == 2
+    assert [entry['name'] for entry in manifest['retired']] == [s.name for s in segment_set.segments[1:]]
+    merged = segment_set.reopen()
+    # the base did not change, so it is not opened again
+    assert merged.segments[0] is segment_set.segments[0]
+    assert [s['docs'] for s in merged.stats()][1] == 59 + 10
+    assert_same_as_rebuild(merged, docs, tmp_path / 'rebuilt', queries)
+    # merging the base drops its dead documents
+    manifest = merge_segments(merged, [0, 1])
+    assert len(manifest['segments']) == 1
+    assert_same_as_rebuild(merged.reopen(), docs, tmp_path / 'rebuilt_all', queries)
+
+
+def test_the_indices_of_two_generations_do_not_share_state(segment_root):
+    tmp_path, _, _ = segment_root
+    first = SegmentSet(tmp_path / 'root')
+    second = SegmentSet(tmp_path / 'root')
+    first.body.block_max['x'] = None
+    assert second.body.block_max == {} and first.title.block_max == {}
+    assert first.body.champions is not second.body.champions
+
+
+def test_pick_merge():
+    many = segments.MIN_SEGMENT_DOCS * segments.MERGE_FACTOR ** 2
+    small = [segments.MIN_SEGMENT_DOCS // 2] * segments.MERGE_FACTOR
+    assert pick_merge([many], [many]) == []
+    # too many deleted documents
+    assert pick_merge([many, 10], [many // 2, 10]) == [0]
+    # MERGE_FACTOR small segments of the same tier after a big one
+    assert pick_merge([many] + small, [many] + small) == list(range(1, 1 + segments.MERGE_FACTOR))
+    assert pick_merge([many] + small[1:], [many] + small[1:]) == []
@@ -0,0 +1,155 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pickle
+import threading
+import time
+import numpy as np
+import pytest
+from BM25 import BM25
+from doc_table import read_pagerank_csv
+from inverted_index_gcp import InvertedIndex, LocalBucket
+from load_test import QUERIES_FILE, generate_corpus
+from query_engine import BODY_K1, TITLE_B, QueryEngine
+from sharding import (GLOBAL_STATS_FILE, INDICES, PAGE_VIEWS_PATH, PAGERANK_PATH, Coordinator, Shard, _ShardClient,
+                      merge_top_k, shard_app, split_data)
+from text_Modification import tokenize
+
+
+def test_merge_top_k_orders_by_score_then_doc_id():
+    shards = [[[5, 3.0, 'a'], [1, 1.0, 'b']], [[2, 3.0, 'c'], [9, 2.0, 'd']], []]
+    assert [r[0] for r in merge_top_k(shards, 10)] == [2, 5, 9, 1]
+    assert merge_top_k(shards, 2) == [[2, 3.0, 'c'], [5, 3.0, 'a']]
+    assert merge_top_k([[], []], 5) == []
+
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('corpus')
+    generate_corpus(data_dir, n_docs=4_000, vocab_size=3_000, body_len=60)
+    shard_dirs = split_data(data_dir, data_dir / 'shards', 3)
+    return data_dir, shard_dirs
+
+
+def unsharded_engine(data_dir):
+    """ The engine search_frontend.py runs over the whole corpus. """
+    bucket = LocalBucket(data_dir)
+    indices, bm25 = {}, {}
+    for name, index_dir, index_name in INDICES:
+        index = InvertedIndex.read_index(index_dir, index_name, bucket)
+        indices[name] = index
+        bm25[name] = BM25(doc_len=index.doc_len, df=index.df, N=index.N, total_terms=index.unique_terms)
+    bm25['body'].k1 = BODY_K1
+    bm25['title'].b = TITLE_B
+    with open(data_dir / PAGE_VIEWS_PATH, 'rb') as f:
+        page_views = pickle.load(f)
+    with open(data_dir / PAGERANK_PATH, 'rb') as f:
+        pagerank = read_pagerank_csv(f)
+    return QueryEngine(indices['body'], 'body_index', indices['title'], 'title_index',
+                       bm25['body'], bm25['title'], page_views, pagerank,
+                       lambda index, terms, dir_name: index.read_posting_arrays(dir_name, terms, bucket))
+
+
+@pytest.mark.parametrize('method', ['exhaustive', 'bmw'])
+def test_shards_merge_into_the_unsharded_top_k(corpus, method):
+    data_dir, shard_dirs = corpus
+    shards = [Shard(shard_dir) for shard_dir in shard_dirs]
+    engine = unsharded_engine(data_dir)
+    with open(data_dir / 'shards' / GLOBAL_STATS_FILE, 'rb') as f:
+        global_stats = pickle.load(f)
+    with open(data_dir / QUERIES_FILE) as f:
+        queries = [tokenize(query) for mix in json.load(f).values() for query in mix[:15]]
+    try:
+        for tokens in filter(None, queries):
+            # the coordinator sends the collection wide df of the query terms
+            df = {name: {term: stats['df'].get(term, 0) for term in tokens} for name, stats in global_stats.items()}
+            got = merge_top_k([shard.search(tokens, 50, method, df) for shard in shards], 50)
+            expected = engine.search(tokens, 50, method, with_scores=True)
+            assert [doc_id for doc_id, _, _ in got] == [doc_id for doc_id, _ in expected]
+            np.testing.assert_allclose([score for _, score, _ in got], [score for _, score in expected])
+    finally:
+        engine.close()
+        for shard in shards:
+            shard.engine.close()
+
+
+class FakeShard(ThreadingHTTPServer):
+    """ Answers every POST with `answers` in turn (results, seconds to wait first) and keeps the payloads. """
+    daemon_threads = True
+
+    def __init__(self, answers):
+        self.answers, self.payloads = list(answers), []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(handler):
+                self.payloads.append(json.loads(handler.rfile.read(int(handler.headers['Content-Length']))))
+                results, delay = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+                time.sleep(delay)
+                body = json.dumps(results).encode()
+                try:
+                    handler.send_response(200)
+                    handler.send_header('Content-Length', str(len(body)))
+                    handler.end_headers()
+                    handler.wfile.write(body)
+                except OSError:
+                    pass
+
+            def log_message(handler, *args):
+                pass
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+def test_a_shard_client_drops_a_connection_that_timed_out():
+    shard = FakeShard([([1], 0.5), ([2], 0)])
+    try:
+        client = _ShardClient(shard.url)
+        with pytest.raises(TimeoutError):
+            client.post('/shard_search', {}, timeout=0.1)
+        assert client._local.conn is None
+        # the late answer of the first request is not read as the answer of the second
+        assert client.post('/shard_search', {})[0] == [2]
+    finally:
+        shard.shutdown()
+
+
+def test_the_coordinator_sends_the_budget_left_and_skips_late_shards():
+    fast, slow = FakeShard([([[7, 2.0, 'a'], [3, 1.0, 'b']], 0)]), FakeShard([([[1, 3.0, 'c']], 2)])
+    collection = {'df': {'x': 5}}
+    coordinator = Coordinator([fast.url, slow.url], {'body': collection, 'title': collection})
+    try:
+        assert coordinator.search(['x'], 10) == [[1, 3.0, 'c'], [7, 2.0, 'a'], [3, 1.0, 'b']]
+        assert 'budget_ms' not in fast.payloads[-1]
+        stats = {'shards_skipped': 0, 'deadline_hit': 0}
+        t_start = time.perf_counter()
+        assert coordinator.search(['x'], 10, deadline=t_start + 0.2, stats=stats) == [[7, 2.0, 'a'], [3, 1.0, 'b']]
+        assert time.perf_counter() - t_start < 1
+        assert stats == {'shards_skipped': 1, 'deadline_hit': 1}
+        assert 0 < fast.payloads[-1]['budget_ms'] <= 200
+    finally:
+        coordinator.executor.shutdown(wait=False)
+        fast.shutdown()
+        slow.shutdown()
+
+
+def test_a_shard_searches_within_the_budget_it_is_sent():
+    calls = []
+
+    class RecordingShard:
+        def search(self, tokens, k, method, df, deadline, stats):
+            calls.append(deadline)
+            stats['deadline_hit'] += deadline is not None
+            return [[1, 1.0, 'a']]
+    client = shard_app(RecordingShard()).test_client()
+    response = client.post('/shard_search', json={'tokens': ['x'], 'k': 5})
+    assert response.get_json() == [[1, 1.0, 'a']] and response.headers['X-Search-Degraded'] == 'false'
+    t_start = time.perf_counter()
+    response = client.post('/shard_search', json={'tokens': ['x'], 'k': 5, 'budget_ms': 300})
+    assert response.headers['X-Search-Degraded'] == 'true'
+    assert calls[0] is None and t_start < calls[1] <= time.perf_counter() + 0.3
+    assert client.post('/shard_search', json={'tokens': ['x'], 'budget_ms': -1}).status_code == 400
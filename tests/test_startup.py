@@ -0,0 +1,103 @@
+import threading
+import time
+import numpy as np
+import pytest
+from startup import ArtifactLoader, approx_size
+
+
+def test_artifacts_get_their_dependencies_in_order():
+    loader = ArtifactLoader()
+    loader.add('a', lambda: 2)
+    loader.add('b', lambda: 3)
+    loader.add('c', lambda b, a: b - a, deps=['b', 'a'])
+    assert loader.start().wait(5)
+    assert loader.get('c') == 1
+    with pytest.raises(ValueError):
+        loader.add('a', lambda: 0)
+    with pytest.raises(ValueError):
+        loader.add('d', lambda x: x, deps=['unknown'])
+
+
+def test_independent_artifacts_load_at_the_same_time():
+    barrier = threading.Barrier(3, timeout=5)
+    loader = ArtifactLoader(max_workers=3)
+    for name in 'abc':
+        # each load only returns once all three are loading
+        loader.add(name, lambda: barrier.wait())
+    assert loader.start().wait(10)
+
+
+def test_lazy_artifacts_load_on_first_use():
+    calls = []
+    loader = ArtifactLoader()
+    loader.add('index', lambda: calls.append('index') or 'index')
+    loader.add('extra', lambda index: calls.append('extra') or index + '+extra', deps=['index'], lazy=True)
+    loader.add('uses_lazy', lambda: calls.append('lazy_dep') or 1, lazy=True)
+    assert loader.start().wait(5) and loader.ready()
+    assert calls == ['index'] and loader.report()['artifacts']['extra']['state'] == 'pending'
+    assert loader.get('extra') == 'index+extra' and calls == ['index', 'extra']
+    assert loader.report()['artifacts']['uses_lazy']['required'] is False
+
+
+def test_an_eager_artifact_loads_its_lazy_dependencies():
+    loader = ArtifactLoader()
+    loader.add('lazy', lambda: 1, lazy=True)
+    loader.add('eager', lambda lazy: lazy + 1, deps=['lazy'])
+    assert loader.start().wait(5) and loader.get('eager') == 2 and loader.loaded('lazy')
+
+
+def test_failures_reach_the_dependent_artifacts():
+    def broken():
+        raise OSError("no such bucket")
+    loader = ArtifactLoader()
+    loader.add('index', broken)
+    loader.add('engine', lambda index: index, deps=['index'])
+    loader.add('prewarm', broken, required=False)
+    loader.add('titles', lambda: {})
+    assert not loader.start().wait(5)
+    assert sorted(loader.failed()) == ['engine', 'index', 'prewarm']
+    with pytest.raises(RuntimeError) as e:
+        loader.get('index')
+    assert isinstance(e.value.__cause__, OSError)
+    report = loader.report()
+    assert not report['ready'] and 'no such bucket' in report['artifacts']['index']['error']
+    assert report['artifacts']['titles']['state'] == 'loaded'
+
+
+def test_an_optional_artifact_does_not_hold_back_readiness():
+    release = threading.Event()
+    loader = ArtifactLoader()
+    loader.add('index', lambda: 'index')
+    loader.add('slow', lambda: release.wait(5), required=False)
+    loader.add('slower', lambda: release.wait(5))
+    loader.start()
+    assert not loader.wait(0.1)
+    with pytest.raises(TimeoutError):
+        loader.get('slower', timeout=0.01)
+    release.set()
+    assert loader.wait(5)
+    report = loader.report()['artifacts']
+    assert report['slower']['seconds'] >= 0.1 and report['index']['bytes'] > 0
+
+
+def test_replace_swaps_loaded_values():
+    loader = ArtifactLoader()
+    loader.add('index', lambda: 'old')
+    loader.add('engine', lambda index: f'engine({index})', deps=['index'])
+    loader.add('lazy', lambda: 1, lazy=True)
+    loader.start().wait(5)
+    engine = loader.get('engine')
+    loader.replace({'index': 'new', 'engine': 'engine(new)'})
+    assert (loader.get('index'), loader.get('engine'), engine) == ('new', 'engine(new)', 'engine(old)')
+    with pytest.raises(ValueError):
+        loader.replace({'lazy': 2})
+
+
+def test_approx_size(tmp_path):
+    array = np.zeros(10_000)
+    assert approx_size(array) >= array.nbytes
+    # a mapped file lives in the page cache
+    np.save(tmp_path / 'a.npy', array)
+    assert approx_size(np.load(tmp_path / 'a.npy', mmap_mode='r')) < 1_000
+    small, big = {i: float(i) for i in range(100)}, {i: float(i) for i in range(100_000)}
+    assert 500 * approx_size(small) < approx_size(big) < 2_000 * approx_size(small)
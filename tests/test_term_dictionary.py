@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from inverted_index_gcp import InvertedIndex
+from term_dictionary import SAMPLE_RATE, TermDictionary
+
+
+@pytest.fixture
+def term_dicts():
+    rng = np.random.default_rng(0)
+    # more terms than a few samples, non ascii ones, and prefixes of each other
+    terms = [f'w{i}' for i in range(10 * SAMPLE_RATE + 3)] + ['é', 'éé', '中文', 'a', 'ab', 'zzÿ']
+    posting_locs, df, nbytes = {}, {}, {}
+    for i, w in enumerate(terms):
+        # some lists continue in the next posting file
+        n_files = 1 + (i % 7 == 0)
+        posting_locs[w] = [(f'{(i + j) // 50}_000.bin', int(rng.integers(0, 2 ** 21))) for j in range(n_files)]
+        df[w] = int(rng.integers(1, 2 ** 31))
+        nbytes[w] = int(rng.integers(1, 2 ** 40))
+    return posting_locs, df, nbytes
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_the_dictionary_reads_like_the_dicts(tmp_path, term_dicts, mmap):
+    posting_locs, df, nbytes = term_dicts
+    TermDictionary.build(tmp_path, posting_locs, df, nbytes)
+    terms = TermDictionary(tmp_path, mmap=mmap)
+    assert len(terms) == len(posting_locs) and sorted(terms) == sorted(posting_locs)
+    # the terms are stored in the order of their utf-8 bytes
+    assert list(terms) == sorted(posting_locs, key=lambda w: w.encode('utf-8'))
+    for column, expected in ((terms.posting_locs, posting_locs), (terms.df, df), (terms.posting_nbytes, nbytes)):
+        assert dict(column) == expected
+    for missing in ('', 'A', 'w', 'w99999', 'zzz', '\U0001f600', 7, None):
+        assert terms.find(missing) == -1 and missing not in terms.df
+        with pytest.raises(KeyError):
+            terms.posting_locs[missing]
+    assert terms.df.get('missing', 0) == 0
+
+
+def test_an_empty_dictionary(tmp_path):
+    terms = TermDictionary.build(tmp_path, {}, {}, {})
+    assert len(terms) == 0 and list(terms.df) == [] and 'a' not in terms.posting_locs
+
+
+def test_an_index_reads_through_the_dictionary(tmp_path, build_engine):
+    engine, terms = build_engine(tmp_path, n_terms=40)
+    try:
+        queries = [terms[i:i + 3] for i in range(0, 40, 4)]
+        expected = [engine.search(query, 100, with_scores=True) for query in queries]
+        for name, index in (('body', engine.body_index), ('title', engine.title_index)):
+            built = TermDictionary.build(tmp_path / f'{name}_terms', index.posting_locs, index.df, index.posting_nbytes_of)
+            index.attach_term_dictionary(built)
+        assert [engine.search(query, 100, with_scores=True) for query in queries] == expected
+        # the slim pickle leaves out what the dictionary replaces
+        engine.body_index.write_slim(engine.body_dir, 'body', drop=['posting_locs', 'df', 'posting_nbytes'])
+        slim = InvertedIndex.read_index(engine.body_dir, 'body_slim')
+        assert not {'posting_locs', 'df', 'document_frequencey_per_term', 'posting_nbytes'} & set(vars(slim))
+        assert slim.N == engine.body_index.N
+    finally:
+        engine.close()
@@ -1,3 +1,4 @@
+from functools import lru_cache
 import re
 from nltk.stem.porter import PorterStemmer
 from nltk.corpus import stopwords
@@ -13,5 +14,21 @@ corpus_stopwords = {
 all_stopwords = english_stopwords.union(corpus_stopwords)
 RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
 ps = PorterStemmer()
+# the stems of this many distinct words are remembered, words repeat a lot in queries and documents
+STEM_CACHE_SIZE = 2 ** 16
+# the tokens of this many distinct query strings are remembered by analyze()
+QUERY_CACHE_SIZE = 10_000
+stem = lru_cache(maxsize=STEM_CACHE_SIZE)(ps.stem)
 
 
+def tokenize(text):
+    """ Turns a query (or any text) into the list of stemmed tokens used by the indices:
+        regex tokenization, stopword removal and Porter stemming. """
+    return [stem(m.group()) for m in RE_WORD.finditer(text.lower()) if m.group() not in all_stopwords]
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def analyze(query):
+    """ tokenize() for queries, memoized for the QUERY_CACHE_SIZE most recent distinct queries.
+        Returns the tokens as a tuple, which the callers share. """
+    return tuple(tokenize(query))